@@ -0,0 +1,290 @@
+"""loudness analysis for cmusic"""
+
+import os
+import sys
+import math
+import time
+import signal
+import multiprocessing
+
+from . import db
+from .player import load_queue
+from .constants import config, LOG_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Info, Error
+
+import numpy as np
+import pygame
+import pygame.sndarray
+
+from . import dsp
+
+# this file measures how loud every song is (cmusic analyze), so the numpy player backend can play them
+# all at about the same loudness (see gain_db in the index).
+# loudness is measured like ITU-R BS.1770 (and EBU R128, ReplayGain 2.0) say:
+#   - the song is K-weighted (a high shelf and a high pass, roughly how loud we hear each frequency),
+#     with an FftFilter, on big chunks of samples at a time
+#   - the mean square of every 400ms block (overlapping by 75%) is taken from sums over 100ms steps
+#   - blocks under -70 LUFS, then blocks more than 10 LU under the loudness of what's left, are ignored,
+#     the loudness of the rest is the song's integrated loudness
+# the sample peak is kept too, a song is never turned up so far that it would clip.
+# songs are decoded and measured by a pool of worker processes, results are written in small batches, so
+# an interrupted analysis keeps what it did. a song is analyzed again when its size or mtime changes.
+
+log = objlog.LogNode("ANALYSIS", log_file=LOG_FILE)
+
+# sample rate songs are decoded at for analysis
+ANALYSIS_RATE = 44100
+
+# length (frames) of the K-weighting filter
+K_TAPS = 8192
+
+# steps (100ms each) filtered at a time, 5 steps and the filter fit a 32768 point FFT at 44.1kHz
+# (bigger FFTs cost more per sample, they don't fit in the CPU's cache)
+CHUNK_STEPS = 5
+
+# results are written to the index at least this often (seconds)
+COMMIT_INTERVAL = 2.0
+
+# silence, and the absolute gate of BS.1770
+ABSOLUTE_GATE = -70.0
+
+
+def k_weighting(rate: int):
+    """the biquads (b, a) of the K-weighting filter at a sample rate (from libebur128's formulas)"""
+    # stage 1, high shelf (the head)
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh**0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        np.array([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]),
+        np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]),
+    )
+    # stage 2, high pass (RLB)
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    high_pass = (
+        np.array([1.0, -2.0, 1.0]),
+        np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]),
+    )
+    return shelf, high_pass
+
+
+def k_filter(rate: int, channels: int):
+    """a K-weighting FftFilter"""
+    response = np.ones(K_TAPS // 2 + 1, dtype=np.complex128)
+    for b, a in k_weighting(rate):
+        response *= dsp.biquad_response(b, a, K_TAPS)
+    return dsp.FftFilter(np.fft.irfft(response, K_TAPS), channels)
+
+
+def measure(samples, rate: int):
+    """measure decoded samples (frames x channels, int16), returns (loudness in LUFS, peak in dBFS)
+
+    either is None for silence (or a song shorter than a block).
+    """
+    frames, channels = samples.shape
+    step = rate // 10
+    chunk = step * CHUNK_STEPS
+    k = k_filter(rate, channels)
+    # sum of squares of the K-weighted samples of every 100ms step, per channel
+    steps = []
+    for start in range(0, frames, chunk):
+        filtered = k.process(samples[start : start + chunk])
+        whole = len(filtered) // step * step
+        filtered = filtered[:whole].astype(np.float64) / 32768
+        steps.append((filtered * filtered).reshape(-1, step, channels).sum(axis=1))
+    steps = np.concatenate(steps) if steps else np.zeros((0, channels))
+
+    peak = max(int(samples.max(initial=0)), -int(samples.min(initial=0))) / 32768
+    peak_db = 20 * math.log10(peak) if peak > 0 else None
+    if len(steps) < 4:
+        return None, peak_db
+
+    # 400ms blocks, a new one every 100ms: mean square per block, summed over the channels (all weighted 1)
+    blocks = (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]).sum(axis=1) / (4 * step)
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(blocks)
+    gated = block_loudness > ABSOLUTE_GATE
+    if not gated.any():
+        return None, peak_db
+    relative_gate = -0.691 + 10 * math.log10(blocks[gated].mean()) - 10
+    gated &= block_loudness > relative_gate
+    return -0.691 + 10 * math.log10(blocks[gated].mean()), peak_db
+
+
+def _init_worker():
+    """set up a process to decode songs (the mixer does the decoding, it never plays anything)"""
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    # SDL would swallow SIGTERM otherwise, and the pool couldn't stop its workers
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(frequency=ANALYSIS_RATE, size=-16, channels=2)
+
+
+def _analyze(task: tuple):
+    """decode a song and measure it, used by the worker processes, returns (task, result, error)"""
+    path = task[1]
+    try:
+        samples = pygame.sndarray.samples(pygame.mixer.Sound(path))
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        return task, measure(samples, pygame.mixer.get_init()[0]), None
+    except Exception as e:
+        # don't let one broken file take down the whole pool, analyze() logs it
+        return task, None, str(e) or type(e).__name__
+
+
+def gain(loudness: float, peak_db: float, target: float):
+    """the gain (dB) that brings a song to the target loudness without clipping"""
+    if loudness is None:
+        return None
+    return min(target - loudness, -peak_db)
+
+
+def update_gains(c, target: float):
+    """recompute the gains of analyzed songs for a (new) target loudness, returns how many changed"""
+    c.execute(
+        "UPDATE songs SET gain_db = MIN(? - loudness, -peak_db) WHERE loudness IS NOT NULL AND gain_db IS NOT MIN(? - loudness, -peak_db)",
+        (target, target),
+    )
+    return c.rowcount
+
+
+def pending_songs(library_file: str, first: list = None):
+    """the songs that weren't analyzed, or changed since (by size and mtime), the ones in first go first"""
+    c = db.cursor(library_file)
+    songs = c.execute(
+        "SELECT id, path, size, mtime_ns, duration FROM songs WHERE analyzed_size IS NOT size OR analyzed_mtime_ns IS NOT mtime_ns ORDER BY id"
+    ).fetchall()
+    if first:
+        first = set(first)
+        songs.sort(key=lambda song: song[0] not in first)
+    return songs
+
+
+def queued_songs():
+    """IDs of the songs in the player's queue (they're about to be played, so they're analyzed first)"""
+    try:
+        return load_queue()
+    except (OSError, ValueError):
+        return []
+
+
+def analyze(library_file: str, workers: int = None, idle: bool = False):
+    """measure the loudness of every song that needs it, returns the number of songs analyzed
+
+    idle runs one worker at the lowest priority, without any output (the player runs it in the background).
+    """
+    target = config["loudness_target"]
+    with db.transaction(library_file) as c:
+        changed = update_gains(c, target)
+    if changed:
+        log.log(Info(f"Updated the gain of {changed} songs for a target of {target} LUFS."))
+
+    if idle:
+        os.nice(19)
+        workers = 1
+        # the player stops it with SIGTERM when it quits, keep what was analyzed (see below)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    player = os.getppid()
+    workers = workers or config["index_workers"] or os.cpu_count() or 1
+    songs = pending_songs(library_file, queued_songs() if idle else None)
+    if not songs:
+        log.log(Info("Every song is analyzed."))
+        if not idle:
+            print("Every song is analyzed.")
+        return 0
+    log.log(Info(f"Analyzing {len(songs)} songs with {workers} workers."))
+
+    pool = multiprocessing.Pool(workers, _init_worker) if workers > 1 and len(songs) > 1 else None
+    if pool is None:
+        _init_worker()
+    started = time.time()
+    analyzed = failed = 0
+    seconds = 0.0
+    batch = []
+    last_commit = last_progress = time.time()
+
+    def commit():
+        with db.transaction(library_file) as c:
+            c.executemany(
+                "UPDATE songs SET loudness = ?, peak_db = ?, gain_db = ?, analyzed_size = ?, analyzed_mtime_ns = ? WHERE id = ?",
+                batch,
+            )
+        batch.clear()
+
+    try:
+        if pool is not None:
+            # one song at a time, songs take long enough that chunks would only hold results back
+            results = pool.imap_unordered(_analyze, songs, 1)
+        else:
+            results = map(_analyze, songs)
+        for (song_id, path, size, mtime_ns, duration), result, error in results:
+            if idle and os.getppid() != player:
+                # the player is gone (it crashed, or was killed), so is the reason to run
+                log.log(Info("The player is gone, stopping the analysis."))
+                break
+            if result is None:
+                log.log(Error(f"Unable to analyze '{path}' ({error}), skipping."))
+                # it's only tried again once the file changes
+                batch.append((None, None, None, size, mtime_ns, song_id))
+                failed += 1
+            else:
+                loudness, peak_db = result
+                log.log(Debug(f"'{path}': {loudness} LUFS, peak {peak_db} dBFS"))
+                batch.append((loudness, peak_db, gain(loudness, peak_db, target), size, mtime_ns, song_id))
+                analyzed += 1
+                seconds += duration or 0
+            if time.time() - last_commit > COMMIT_INTERVAL:
+                commit()
+                last_commit = time.time()
+            if not idle and time.time() - last_progress > 0.2:
+                progress(analyzed + failed, len(songs), seconds, started)
+                last_progress = time.time()
+        commit()
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        # what's done stays done, running it again picks up from there
+        commit()
+        if not idle:
+            print()
+            print("Analysis interrupted, run the same command again to resume.")
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    elapsed = max(time.time() - started, 1e-6)
+    message = (
+        f"Analyzed {analyzed} songs in {elapsed:.1f}s ({(analyzed + failed) / elapsed:.2f} tracks/s, "
+        f"{seconds / elapsed:.0f}x real time), {failed} failed."
+    )
+    log.log(Info(message))
+    if not idle:
+        progress(analyzed + failed, len(songs), seconds, started)
+        print()
+        print(message)
+    return analyzed
+
+
+def progress(done: int, total: int, seconds: float, started: float):
+    """print the progress line (overwritten in place)"""
+    elapsed = max(time.time() - started, 1e-6)
+    rate = done / elapsed
+    left = (total - done) / rate if rate > 0 else 0
+    line = (
+        f"\r{done}/{total} analyzed | {rate:.2f} tracks/s, {seconds / elapsed:.0f}x real time"
+        f" | {int(left // 3600)}:{int(left % 3600 // 60):02}:{int(left % 60):02} left "
+    )
+    sys.stdout.write(line)
+    sys.stdout.flush()
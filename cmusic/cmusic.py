@@ -20,6 +20,7 @@ from cmusic import constants
 from objlog import LogNode
 from objlog.LogMessages import Debug, Info, Warn, Error, Fatal
 from cmusic import main as central
+from cmusic import query
 
 BOOTLOADER = LogNode(name="BOOTLOADER", log_file=constants.LOG_FILE)
 try:
@@ -122,7 +123,21 @@ def main():
 
     # this may break everything
     # god take the wheel
-    parser = argparse.ArgumentParser(description="cMusic, for all your music needs.")
+    # flags that take a value, they're parsed again after the command (see below)
+    value_options = argparse.ArgumentParser(add_help=False)
+    value_options.add_argument("--workers", help="Number of worker processes used when indexing or analyzing (default: one per core)",
+                               type=int, default=None)
+    value_options.add_argument("--batch-size", help="Number of songs written to the index per batch when indexing",
+                               type=int, default=None)
+    value_options.add_argument("--limit", help="With list or search, show at most this many songs", type=int,
+                               default=None)
+    value_options.add_argument("--offset", help="With list or search, skip this many songs first", type=int, default=0)
+    value_options.add_argument("--sort", help="With list or search, sort by these fields (e.g. --sort=artist,-year)",
+                               default=None)
+    value_options.add_argument("--format", help="With list or search, the output format", default="text",
+                               choices=["text", "jsonl", "tsv", "ids"])
+
+    parser = argparse.ArgumentParser(description="cMusic, for all your music needs.", parents=[value_options])
     command_subparsers = parser.add_subparsers(dest="command", help="The command to run.", required=True)
 
     command_subparsers.add_parser("play", help="Play a song.")
@@ -134,11 +149,18 @@ def main():
     command_subparsers.add_parser("p", help="Pause the background session.")
     command_subparsers.add_parser("v", help="Change the volume of the background session.")
     command_subparsers.add_parser("q", help="Quit the background session.")
+    command_subparsers.add_parser("status", help="Show what the background session is playing.")
+    command_subparsers.add_parser("skip", help="Skip the song the background session is playing.")
+    command_subparsers.add_parser("seek", help="Jump to a position (seconds or m:ss) in the current song.")
+    command_subparsers.add_parser("eq", help="Show the equalizer presets, pick one, or save a new one.")
     command_subparsers.add_parser("edit", help="Edit a song.")
     command_subparsers.add_parser("info", help="Show song information.")
     command_subparsers.add_parser("flush", help="Flush the logs.")
     command_subparsers.add_parser("del", help="Delete a song.")
     command_subparsers.add_parser("queue", help="Add a song to queue")
+    command_subparsers.add_parser("watch", help="Keep the index up to date while the library changes.")
+    command_subparsers.add_parser("dedupe", help="List songs that are in the library more than once.")
+    command_subparsers.add_parser("analyze", help="Measure the loudness of the songs, for loudness normalization.")
 
     playlist_parser = command_subparsers.add_parser("playlist", help="Manage playlists.")
     playlist_subparsers = playlist_parser.add_subparsers(dest="playlist_command", help="The playlist command to "
@@ -160,12 +182,20 @@ def main():
     parser.add_argument("--background", help="Makes the song play, but doesn't stop you from controlling the terminal.",
                         action="store_true")
     parser.add_argument("--reindex", help="Re-index the whole library", action="store_true")
+    parser.add_argument("--sync", help="Bring the index up to date with the library, only re-reading changed files",
+                        action="store_true")
     parser.add_argument("--reformat",
                         help="Reformat the library, actually edits the files, is done automatically before re-indexing.",
                         action="store_true")
     parser.add_argument("--cleanup",
                         help="Clean up the library, removing any files that are not in the index, or vice-versa",
                         action="store_true")
+    parser.add_argument("--batch", help="Import songs without asking for their tags (always on for folders and globs)",
+                        action="store_true")
+    parser.add_argument("--dry-run", help="With --cleanup, only report what would be removed",
+                        action="store_true")
+    parser.add_argument("--idle", help="With analyze, use one process at the lowest priority and print nothing",
+                        action="store_true")
     parser.add_argument("--_background_process", help="Internal use only, do not use.", action="store_true")
     parser.add_argument("--_crash", help="Crash the program for testing purposes", action="store_true")
     parser.add_argument("--playlist", help="whether to execute the command in the context of a playlist or not",
@@ -173,6 +203,9 @@ def main():
 
     # capture subsequent arguments
     args, unknown_args = parser.parse_known_args()
+    # the subcommands don't know the flags, so the ones with a value that come after the command
+    # (cmusic list --limit 10) end up with the unknown arguments, give those another go
+    args, unknown_args = value_options.parse_known_args(unknown_args, namespace=args)
 
     args = vars(args)
     args_list = [args["command"]]
@@ -187,7 +220,8 @@ def main():
             args[arg[2:]] = True
             # remove the flag from the unknown_args
             unknown_args.remove(arg)
-        elif arg.startswith("-"):
+        elif arg.startswith("-") and not arg[1:].replace(".", "", 1).isdigit() and not query.is_field(arg):
+            # (negative numbers aren't flags, cmusic eq takes them, and -field:value is a query, NOT field:value)
             args[arg[1:]] = True
             # also remove the flag from the unknown_args
             unknown_args.remove(arg)
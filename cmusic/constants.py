@@ -24,12 +24,85 @@ MAIN = objlog.LogNode("CMUSIC")
 
 QUEUE_FILE = os.path.join(CMUSIC_DIR, "queue.json")
 
+# the renames/tag writes reformat() is in the middle of, replayed on the next start if it crashed
+REFORMAT_JOURNAL = os.path.join(CMUSIC_DIR, "reformat.journal.json")
+
+# the songs a bulk import already finished, so an interrupted import can resume
+IMPORT_JOURNAL = os.path.join(CMUSIC_DIR, "import.journal")
+
+# search results cached across runs (if search_cache_disk is on in the config)
+SEARCH_CACHE_FILE = os.path.join(CMUSIC_DIR, "search_cache.db")
+
+# the player listens for commands (cmusic p, v, q, status, ...) on this socket, see daemon.py
+SOCKET_FILE = os.path.join(CMUSIC_DIR, "player.sock")
+
+
+def write_config(data: dict):
+    """write the config file atomically, whoever reads it at the same time sees the old or the new file, never half of one"""
+    temporary = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        f.write(json.dumps(data, indent=4))
+    os.replace(temporary, CONFIG_FILE)
+
+
 # default config
 # this is the default config that is written to the config file if it doesn't exist
 
 DEFAULT_CONFIG = {
     "library": os.path.join(os.path.expanduser("~"), "cMusic Library"),
     "volume": 100,
+    # number of worker processes used to read tags when re-indexing (0 = one per cpu core)
+    "index_workers": 0,
+    # number of songs written to the index per batch when re-indexing
+    "index_batch_size": 500,
+    # number of threads reading the directories of the library at the same time (more helps on a NAS)
+    "walk_workers": 8,
+    # how long (seconds) the library has to be quiet before cmusic watch updates the index
+    "watch_debounce": 1.0,
+    # how often (seconds) cmusic watch checks the library when it can't use inotify
+    "watch_poll_interval": 10,
+    # number of threads used to rename and retag files when reformatting
+    "reformat_workers": 8,
+    # number of threads copying files into the library during a bulk import
+    "import_threads": 4,
+    # how similar (0-1) a misspelled song name has to be to a title or artist to still match it
+    "fuzzy_threshold": 0.3,
+    # number of searches whose results are kept in memory (0 turns the search cache off)
+    "search_cache_size": 256,
+    # also keep search results on disk, so the next run of cmusic can use them
+    "search_cache_disk": False,
+    # what plays the songs: "music" (pygame.mixer.music) or "numpy" (crossfades, needs numpy, cmusic[dsp])
+    "player_backend": "music",
+    # how long (seconds) songs overlap when the numpy backend goes from one to the next (0 = gapless)
+    "crossfade": 4.0,
+    # number of frames the numpy backend mixes at a time (bigger blocks wake the player up less often)
+    "dsp_block_size": 8192,
+    # play every song at about the same loudness (numpy backend, for songs cmusic analyze measured)
+    "normalize_loudness": True,
+    # the loudness (LUFS) cmusic analyze sets the songs' gains for (-18 is ReplayGain's reference)
+    "loudness_target": -18.0,
+    # analyze the library in the background (one process, lowest priority) while the numpy backend plays
+    "analyze_while_playing": True,
+    # the equalizer preset the numpy backend uses (one of eq_presets)
+    "eq_preset": "flat",
+    # equalizer presets, the gain (dB) of each band: 31, 62, 125, 250, 500, 1k, 2k, 4k, 8k and 16k Hz
+    "eq_presets": {
+        "flat": [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        "bass": [6, 5, 4, 2, 0, 0, 0, 0, 0, 0],
+        "treble": [0, 0, 0, 0, 0, 0, 2, 4, 5, 6],
+        "vocal": [-2, -2, -1, 0, 2, 3, 3, 2, 0, -1],
+        "loudness": [5, 4, 2, 0, -1, -1, 0, 2, 4, 5],
+    },
+    # pragmas applied to every connection to the index (WAL lets the player read while something else writes)
+    "sqlite_pragmas": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "busy_timeout": 5000,
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        "temp_store": "memory",
+        "foreign_keys": "on",
+    },
 }
 
 # check if the cmusic directory exists
@@ -38,18 +111,18 @@ if not os.path.exists(CMUSIC_DIR):
     os.makedirs(CMUSIC_DIR)
 
 if not os.path.exists(CONFIG_FILE):
-    with open(CONFIG_FILE, "w") as f:
-        f.write(json.dumps(DEFAULT_CONFIG, indent=4))
+    write_config(DEFAULT_CONFIG)
     MAIN.log(Info("Created config file"))
 else:
     # assure all fields are present
     config = json.load(open(CONFIG_FILE))
-    for key in DEFAULT_CONFIG:
-        if key not in config:
-            config[key] = DEFAULT_CONFIG[key]
-            MAIN.log(Info(f"Added missing field to config: {key}"))
-    with open(CONFIG_FILE, "w") as f:
-        f.write(json.dumps(config, indent=4))
+    missing = [key for key in DEFAULT_CONFIG if key not in config]
+    for key in missing:
+        config[key] = DEFAULT_CONFIG[key]
+        MAIN.log(Info(f"Added missing field to config: {key}"))
+    # only written when something was added, a running player watches the file
+    if missing:
+        write_config(config)
 
 if not os.path.exists(QUEUE_FILE):
     MAIN.log(Info("generating queue file"))
@@ -0,0 +1,211 @@
+"""content hashes for cmusic"""
+
+import os
+import hashlib
+import multiprocessing
+
+from . import db
+from .constants import config, LOG_FILE
+
+import objlog
+from objlog.LogMessages import Info, Error
+
+# this file hashes the audio of songs, to find the same song twice (in the library, or when importing).
+# only the audio is hashed, the ID3 tags (v2 at the start, v1 at the end) are skipped, so a retagged
+# copy of a song has the same hash as the original.
+# hashes are cached in the hash_cache table by (path, size, mtime), a file is only hashed again once it changed.
+
+log = objlog.LogNode("HASHER", log_file=LOG_FILE)
+
+# how much of a file is read at a time when hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def audio_range(f, size: int):
+    """find where the audio of an (open) mp3 file starts and ends, returns (start, end)"""
+    start = 0
+    # ID3v2 tags, there can be more than one
+    while True:
+        f.seek(start)
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b"ID3":
+            break
+        # the size is "syncsafe" (7 bits per byte), and doesn't include the header (or the footer)
+        tag_size = 0
+        for byte in header[6:10]:
+            tag_size = (tag_size << 7) | (byte & 0x7F)
+        start += 10 + tag_size + (10 if header[5] & 0x10 else 0)
+    end = size
+    # ID3v1 tag, the last 128 bytes
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b"TAG":
+            end -= 128
+    return min(start, end), end
+
+
+def file_hash(path: str):
+    """hash the audio of a file, returns (size, mtime_ns, content_hash)"""
+    st = os.stat(path)
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        start, end = audio_range(f, st.st_size)
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return st.st_size, st.st_mtime_ns, digest.hexdigest()
+
+
+def _hash_file(path: str):
+    """hash a single file, used by the hashing worker processes"""
+    try:
+        return (path,) + file_hash(path) + (None,)
+    except OSError as e:
+        return path, None, None, None, str(e)
+
+
+def cached_hashes(library_file: str, paths: list):
+    """get the hashes of the files whose cache entry is still valid, returns {path: content_hash}"""
+    c = db.cursor(library_file)
+    hashes = {}
+    for path in paths:
+        entry = c.execute(
+            "SELECT size, mtime_ns, content_hash FROM hash_cache WHERE path = ?", (path,)
+        ).fetchone()
+        if entry is None:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns) == entry[:2]:
+            hashes[path] = entry[2]
+    return hashes
+
+
+def remember(c, path: str, content_hash: str, stat: tuple = None):
+    """add (or replace) the cache entry of a file, stat is its (size, mtime_ns) if already known"""
+    if stat is None:
+        st = os.stat(path)
+        stat = (st.st_size, st.st_mtime_ns)
+    c.execute(
+        "INSERT OR REPLACE INTO hash_cache (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+        (path, stat[0], stat[1], content_hash),
+    )
+
+
+def hash_files(library_file: str, paths: list, workers: int = None):
+    """get the hashes of many files, returns {path: content_hash}
+
+    only the files without a valid cache entry are hashed, by a pool of worker processes.
+    files that can't be read are logged and left out.
+    """
+    hashes = cached_hashes(library_file, paths)
+    todo = [path for path in paths if path not in hashes]
+    if not todo:
+        return hashes
+    log.log(Info(f"Hashing {len(todo)} files ({len(hashes)} cached)"))
+    workers = workers or config["index_workers"] or os.cpu_count() or 1
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(todo) > 1 else None
+    try:
+        if pool is not None:
+            chunksize = max(1, min(16, len(todo) // (workers * 4)))
+            results = pool.imap_unordered(_hash_file, todo, chunksize)
+        else:
+            results = map(_hash_file, todo)
+        entries = []
+        for path, size, mtime_ns, content_hash, error in results:
+            if content_hash is None:
+                log.log(Error(f"Unable to hash '{path}' ({error}), skipping."))
+                continue
+            hashes[path] = content_hash
+            entries.append((path, size, mtime_ns, content_hash))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    with db.transaction(library_file) as c:
+        c.executemany(
+            "INSERT OR REPLACE INTO hash_cache (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+            entries,
+        )
+    return hashes
+
+
+def apply_cache(c):
+    """fill in the content hashes of songs from the cache (where it's still valid for them)"""
+    c.execute(
+        """
+    UPDATE songs SET content_hash = (
+        SELECT content_hash FROM hash_cache h
+        WHERE h.path = songs.path AND h.size = songs.size AND h.mtime_ns = songs.mtime_ns
+    )
+    WHERE content_hash IS NULL
+    """
+    )
+
+
+def refresh_library_hashes(library_file: str, workers: int = None):
+    """hash every song in the index that doesn't have a content hash yet"""
+    with db.transaction(library_file) as c:
+        apply_cache(c)
+    c = db.cursor(library_file)
+    paths = [row[0] for row in c.execute("SELECT path FROM songs WHERE content_hash IS NULL")]
+    if not paths:
+        return
+    hashes = hash_files(library_file, paths, workers)
+    with db.transaction(library_file) as c:
+        c.executemany(
+            "UPDATE songs SET content_hash = ? WHERE path = ?",
+            [(content_hash, path) for path, content_hash in hashes.items()],
+        )
+
+
+def find_song(library_file: str, content_hash: str):
+    """get the song in the index with this content hash (or None)"""
+    c = db.cursor(library_file)
+    c.execute("SELECT * FROM songs WHERE content_hash = ? LIMIT 1", (content_hash,))
+    return c.fetchone()
+
+
+def duplicate_groups(library_file: str, workers: int = None):
+    """find the songs that are in the library more than once, returns a list of groups of songs"""
+    refresh_library_hashes(library_file, workers)
+    c = db.cursor(library_file)
+    c.execute(
+        """
+    SELECT songs.content_hash, songs.* FROM songs
+    JOIN (
+        SELECT content_hash FROM songs
+        WHERE content_hash IS NOT NULL
+        GROUP BY content_hash HAVING COUNT(*) > 1
+    ) dupes ON dupes.content_hash = songs.content_hash
+    ORDER BY songs.content_hash, songs.id
+    """
+    )
+    groups = {}
+    for row in c.fetchall():
+        groups.setdefault(row[0], []).append(row[1:])
+    return list(groups.values())
+
+
+def dedupe_report(library_file: str, workers: int = None):
+    """print the groups of duplicate songs in the library"""
+    groups = duplicate_groups(library_file, workers)
+    if not groups:
+        print("No duplicate songs found.")
+        return groups
+    for group in groups:
+        print(f"{len(group)} copies of '{group[0][2]}' by {group[0][3]}:")
+        for song in group:
+            print(f"  [{song[0]}] {song[1]}")
+    print(
+        f"{len(groups)} songs are in the library more than once "
+        f"({sum(len(group) - 1 for group in groups)} extra copies)."
+    )
+    return groups
@@ -0,0 +1,159 @@
+"""player control socket for cmusic"""
+
+import os
+import json
+import socket
+
+from .constants import LOG_FILE, SOCKET_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Info, Warn
+
+# the player (cmusic play) listens on a unix socket, the other commands (p, v, q, status, skip, seek,
+# queue) are clients that send it one request and read one response, instead of poking at it through tmux.
+# the protocol is one JSON object per line:
+#   -> {"cmd": "volume", "volume": 70}
+#   <- {"ok": true, "volume": 70}
+#   <- {"ok": false, "error": "..."}
+# commands: play (ids), enqueue (ids), pause (paused, optional, toggles), volume (volume), skip,
+# seek (position, seconds), status, quit.
+# tmux is only there to show the player's interface (cmusic c), it's not needed to control it.
+
+log = objlog.LogNode("DAEMON", log_file=LOG_FILE)
+
+# how long (seconds) a client waits for the player to answer
+REQUEST_TIMEOUT = 2.0
+
+# a request bigger than this is not one of ours
+MAX_REQUEST = 1024 * 1024
+
+
+class PlayerNotRunning(Exception):
+    """there's no player to talk to"""
+
+
+class ControlServer:
+    """the player's end of the control socket, run from the player's select() loop"""
+
+    def __init__(self, path: str = SOCKET_FILE):
+        self.path = path
+        if os.path.exists(path):
+            try:
+                request("status", path=path)
+            except PlayerNotRunning:
+                # left behind by a player that crashed
+                os.unlink(path)
+            else:
+                raise RuntimeError("Another player is already running.")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only we get to control our player
+        old_umask = os.umask(0o077)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        # client: what it sent so far
+        self.clients = {}
+        log.log(Info(f"Listening on '{path}'"))
+
+    def fds(self):
+        """the sockets to select() on"""
+        return [self.sock] + list(self.clients)
+
+    def handle(self, ready, handler):
+        """deal with a socket select() said is readable, handler(request) returns the response"""
+        if ready is self.sock:
+            try:
+                client, _ = self.sock.accept()
+            except BlockingIOError:
+                return
+            client.setblocking(False)
+            self.clients[client] = b""
+            return
+        try:
+            data = ready.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(ready)
+            return
+        buffer = self.clients[ready] + data
+        if b"\n" not in buffer:
+            if len(buffer) > MAX_REQUEST:
+                self.drop(ready)
+            else:
+                self.clients[ready] = buffer
+            return
+        line = buffer.split(b"\n", 1)[0]
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("a request is a JSON object")
+            log.log(Debug(f"Request: {message}"))
+            response = handler(message)
+        except ValueError as e:
+            response = {"ok": False, "error": f"Bad request ({e})"}
+        try:
+            # responses are small, a short blocking send is fine
+            ready.settimeout(REQUEST_TIMEOUT)
+            ready.sendall(json.dumps(response).encode() + b"\n")
+        except OSError as e:
+            log.log(Warn(f"Unable to answer a request ({e})"))
+        self.drop(ready)
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def request(cmd: str, path: str = SOCKET_FILE, **fields):
+    """send a request to the player, returns its response (a dict)
+
+    raises PlayerNotRunning if there's no player, and RuntimeError if it didn't like the request.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REQUEST_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise PlayerNotRunning(str(e))
+        sock.sendall(json.dumps({"cmd": cmd, **fields}).encode() + b"\n")
+        response = b""
+        while b"\n" not in response:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    except socket.timeout:
+        raise PlayerNotRunning("The player didn't answer.")
+    finally:
+        sock.close()
+    if not response:
+        raise PlayerNotRunning("The player hung up.")
+    response = json.loads(response)
+    if not response.get("ok"):
+        raise RuntimeError(response.get("error", "Request failed."))
+    return response
+
+
+def is_running():
+    """check if a player is running"""
+    try:
+        request("status")
+    except PlayerNotRunning:
+        return False
+    return True
@@ -0,0 +1,106 @@
+"""database connections for cmusic"""
+
+import os
+import sqlite3
+import threading
+import contextlib
+
+from .constants import config, LOG_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Info
+
+# this file manages the connections to the index of a library.
+# connections are cached per thread and per index file, so every function in indexlib shares one
+# connection instead of opening its own, and every connection gets the pragmas from the config
+# (WAL by default, so readers never block the writer and the other way around).
+
+log = objlog.LogNode("DATABASE", log_file=LOG_FILE)
+
+# the index of a library, and the shadow index a full re-index is built in before it replaces it
+INDEX_FILE = "index.db"
+REBUILD_FILE = "index.rebuild.db"
+
+# connections are not shared between threads (sqlite3 doesn't like that), each thread gets its own
+_local = threading.local()
+
+
+def index_path(library_file: str, index_name: str = INDEX_FILE):
+    """get the path of the index file of a library"""
+    return os.path.abspath(os.path.join(library_file, index_name))
+
+
+def is_index_file(filename: str):
+    """check if a file in the library belongs to the index (the database and its WAL/journal files)"""
+    for name in (INDEX_FILE, REBUILD_FILE):
+        if filename in (name, name + "-wal", name + "-shm", name + "-journal"):
+            return True
+    return filename.endswith(".db")
+
+
+def apply_pragmas(conn):
+    """apply the pragmas from the config to a connection"""
+    for name, value in config["sqlite_pragmas"].items():
+        result = conn.execute(f"PRAGMA {name} = {value}").fetchone()
+        log.log(Debug(f"PRAGMA {name} = {value} -> {result}"))
+
+
+def connect(library_file: str, index_name: str = INDEX_FILE):
+    """get the connection to the index of a library (opened once per thread, then reused)
+
+    the connection is in autocommit mode, use transaction() to group writes together.
+    """
+    path = index_path(library_file, index_name)
+    connections = _local.__dict__.setdefault("connections", {})
+    conn = connections.get(path)
+    if conn is None:
+        log.log(Info(f"Opening index '{path}'"))
+        conn = sqlite3.connect(path, isolation_level=None)
+        apply_pragmas(conn)
+        connections[path] = conn
+    return conn
+
+
+def cursor(library_file: str, index_name: str = INDEX_FILE):
+    """get a cursor on the (cached) connection to the index of a library"""
+    return connect(library_file, index_name).cursor()
+
+
+@contextlib.contextmanager
+def transaction(library_file: str, c=None, index_name: str = INDEX_FILE):
+    """run a block of writes in one transaction, yields a cursor
+
+    if a cursor is passed in (c), or a transaction is already open on this thread's connection,
+    the block joins that transaction instead of starting (and committing) its own, so functions
+    that take a cursor can be called as a part of something bigger.
+    """
+    if c is not None:
+        yield c
+        return
+    conn = connect(library_file, index_name)
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    # IMMEDIATE takes the write lock right away, so two writers wait on each other (busy_timeout)
+    # instead of failing halfway through with "database is locked"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close(library_file: str = None, index_name: str = INDEX_FILE):
+    """close this thread's cached connection to an index (or all of them)"""
+    connections = _local.__dict__.setdefault("connections", {})
+    if library_file is None:
+        paths = list(connections)
+    else:
+        paths = [index_path(library_file, index_name)]
+    for path in paths:
+        conn = connections.pop(path, None)
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,440 @@
+"""numpy playback engine for cmusic (crossfades between songs)"""
+
+import sys
+import math
+import time
+import concurrent.futures
+
+import numpy as np
+import pygame
+import pygame.sndarray
+
+from .constants import LOG_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Warn
+
+# this file is the "numpy" player backend (player_backend in the config), the default one streams the song
+# with pygame.mixer.music, which plays one file at a time and never shows us the samples.
+# here songs are decoded into memory (pygame.mixer.Sound, about 10 MB per minute) and mixed by us, a block
+# (dsp_block_size frames) at a time, into a mixer channel:
+#   - the channel plays one block while the next one waits in its queue, blocks follow each other without a gap
+#   - the next song is decoded in a background thread while the current one plays
+#   - when the current song is `crossfade` seconds from its end, the next one fades in while it fades out
+#     (equal power, the loudness stays the same), with crossfade 0 the next song starts on the very next sample
+#   - every song is multiplied by its gain (gain_db in the index), so they all play about as loud
+#   - the mix goes through a 10-band equalizer (eq_preset in the config)
+# all the processing is done on whole blocks with numpy, there's no python loop per sample, run
+# `python -m cmusic.dsp` to see how long a second of audio takes to mix.
+
+log = objlog.LogNode("DSP", log_file=LOG_FILE)
+
+# center frequencies (Hz) of the equalizer's bands, an octave apart
+EQ_BANDS = (31.25, 62.5, 125, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# bandwidth of the bands (one octave)
+EQ_Q = math.sqrt(2)
+
+# length (frames) of the filter the bands are turned into, long enough for the lowest band to ring out
+EQ_TAPS = 8192
+
+
+class Track:
+    """a decoded song: its samples (frames x channels, int16) and how far it's been played"""
+
+    def __init__(self, path: str, samples, sound=None, gain_db: float = 0.0):
+        self.path = path
+        self.samples = samples
+        # linear, multiplied into every block
+        self.gain = 10 ** (gain_db / 20)
+        # samples() of a Sound point into its buffer, so the Sound has to stay around
+        self.sound = sound
+        self.cursor = 0
+        # (first frame, length in frames, fading in) while a crossfade runs
+        self.fade = None
+
+    @property
+    def frames(self):
+        return len(self.samples)
+
+    @property
+    def remaining(self):
+        return len(self.samples) - self.cursor
+
+    def read(self, frames: int):
+        """the next frames (float32, gain and fade applied), fewer at the end of the song"""
+        chunk = self.samples[self.cursor : self.cursor + frames].astype(np.float32)
+        if self.gain != 1.0:
+            chunk *= self.gain
+        if self.fade is not None:
+            first, length, fading_in = self.fade
+            progress = np.arange(self.cursor - first, self.cursor - first + len(chunk), dtype=np.float32)
+            progress /= length
+            np.clip(progress, 0.0, 1.0, out=progress)
+            progress *= np.pi / 2
+            gain = np.sin(progress) if fading_in else np.cos(progress)
+            chunk *= gain[:, np.newaxis]
+            if fading_in and self.cursor + len(chunk) >= first + length:
+                self.fade = None
+        self.cursor += len(chunk)
+        return chunk
+
+
+def decode(path: str, gain_db: float = 0.0):
+    """decode a song into a Track (at the mixer's sample rate and channels)"""
+    sound = pygame.mixer.Sound(path)
+    samples = pygame.sndarray.samples(sound)
+    if samples.ndim == 1:
+        # mono mixer
+        samples = samples[:, np.newaxis]
+    return Track(path, samples, sound, gain_db)
+
+
+def to_int16(block):
+    """convert a mixed block to what the mixer plays (two songs at once can go over full scale)"""
+    return np.clip(block, -32768, 32767).astype(np.int16)
+
+
+def peaking(frequency: float, gain_db: float, q: float, rate: int):
+    """coefficients (b, a) of a peaking EQ biquad (from RBJ's audio EQ cookbook), a[0] is 1"""
+    amplitude = 10 ** (gain_db / 40)
+    w0 = 2 * math.pi * frequency / rate
+    alpha = math.sin(w0) / (2 * q)
+    b = np.array([1 + alpha * amplitude, -2 * math.cos(w0), 1 - alpha * amplitude])
+    a = np.array([1 + alpha / amplitude, -2 * math.cos(w0), 1 - alpha / amplitude])
+    return b / a[0], a / a[0]
+
+
+def biquad_response(b, a, size: int):
+    """frequency response of a biquad, at the frequencies of an rfft of size frames"""
+    # e^-jw for every frequency
+    z = np.exp(-1j * np.pi * np.arange(size // 2 + 1) / (size // 2))
+    return (b[0] + b[1] * z + b[2] * z**2) / (a[0] + a[1] * z + a[2] * z**2)
+
+
+def eq_response(gains: list, rate: int, size: int):
+    """frequency response of the equalizer's bands in series, at the frequencies of an rfft of size frames"""
+    response = np.ones(size // 2 + 1, dtype=np.complex128)
+    for frequency, gain in zip(EQ_BANDS, gains):
+        if gain == 0 or frequency >= rate / 2:
+            continue
+        response *= biquad_response(*peaking(frequency, gain, EQ_Q, rate), size)
+    return response
+
+
+class FftFilter:
+    """a filter (given by its impulse response) applied to blocks of samples
+
+    every block is filtered in one go with FFT convolution (overlap-add), there's no loop per sample.
+    filters made of biquads pass in the impulse response of the biquads in series (irfft of their response).
+    """
+
+    def __init__(self, impulse, channels: int):
+        self.impulse = impulse
+        self.taps = len(impulse)
+        # what the blocks so far ring into the next one
+        self.tail = np.zeros((self.taps - 1, channels), dtype=np.float32)
+        # FFT size: spectrum of the filter
+        self.spectra = {}
+
+    def process(self, block):
+        """filter a block (the next one after the last block processed), returns float32 samples"""
+        frames = len(block)
+        size = 1 << (frames + self.taps - 2).bit_length()
+        spectrum = self.spectra.get(size)
+        if spectrum is None:
+            spectrum = self.spectra[size] = np.fft.rfft(self.impulse, size)
+        # one channel per row, an FFT over contiguous samples is a lot faster than one across interleaved ones
+        channels = np.ascontiguousarray(block.T, dtype=np.float64)
+        filtered = np.fft.irfft(np.fft.rfft(channels, size) * spectrum, size).T
+        filtered = filtered[: frames + self.taps - 1]
+        filtered[: self.taps - 1] += self.tail
+        self.tail = filtered[frames:].astype(np.float32)
+        return filtered[:frames].astype(np.float32, order="C")
+
+    def reset(self):
+        """forget the ringing of the last block (the next one doesn't follow it)"""
+        self.tail[:] = 0
+
+
+class Equalizer(FftFilter):
+    """a 10-band equalizer for blocks of samples (the biquads of the bands, as one FftFilter)"""
+
+    def __init__(self, gains: list, rate: int, channels: int):
+        self.gains = list(gains)
+        impulse = np.fft.irfft(eq_response(self.gains, rate, EQ_TAPS), EQ_TAPS)
+        # everything is turned down by the biggest boost, so a boosted band can't clip
+        impulse *= 10 ** (-max(max(self.gains), 0) / 20)
+        super().__init__(impulse, channels)
+
+
+class Crossfader:
+    """mixes the current song (and the one fading out) into blocks of samples, doesn't need a mixer"""
+
+    def __init__(self, frequency: int, channels: int, crossfade: float):
+        self.frequency = frequency
+        self.channels = channels
+        # in frames
+        self.crossfade = max(int(crossfade * frequency), 0)
+        self.current = None
+        # the song fading out (while the current one fades in)
+        self.outgoing = None
+        # the song after the current one, once it's decoded
+        self.upcoming = None
+
+    def fade_length(self):
+        """how long (frames) the crossfade into the upcoming song is"""
+        return min(self.crossfade, self.current.remaining, self.upcoming.frames)
+
+    def start_fade(self):
+        """the upcoming song becomes the current one, fading in while the old one fades out"""
+        length = self.fade_length()
+        if length > 0:
+            self.current.fade = (self.current.cursor, length, False)
+            self.upcoming.fade = (0, length, True)
+            self.outgoing = self.current
+        self.current = self.upcoming
+        self.upcoming = None
+        log.log(Debug(f"Crossfading into '{self.current.path}' ({length / self.frequency:.2f}s)"))
+
+    def render(self, frames: int):
+        """mix the next block, returns (block, switched) or None once everything was played
+
+        switched is True if the upcoming song became the current one in this block.
+        """
+        block = np.zeros((frames, self.channels), dtype=np.float32)
+        position = 0
+        switched = False
+        while position < frames and (self.current is not None or self.outgoing is not None):
+            size = frames - position
+            if self.outgoing is not None:
+                # one crossfade at a time
+                size = min(size, self.outgoing.remaining)
+            elif self.current is not None and self.upcoming is not None:
+                until = self.current.remaining - self.fade_length()
+                if until <= 0:
+                    # the fade starts on this exact frame
+                    self.start_fade()
+                    switched = True
+                    continue
+                size = min(size, until)
+            mixed = 0
+            for track in (self.current, self.outgoing):
+                if track is not None:
+                    chunk = track.read(size)
+                    block[position : position + len(chunk)] += chunk
+                    mixed = max(mixed, len(chunk))
+            position += mixed
+            if self.outgoing is not None and self.outgoing.remaining == 0:
+                self.outgoing = None
+            if self.current is not None and self.current.remaining == 0 and self.upcoming is None:
+                # nothing to go on with, that's the last block
+                self.current = None
+                if self.outgoing is None:
+                    break
+        if position == 0:
+            return None
+        return block[:position], switched
+
+
+class Engine:
+    """a player backend, plays songs through a mixer channel in blocks mixed by a Crossfader
+
+    the same interface as player.MusicBackend.
+    """
+
+    def __init__(self, crossfade: float, block_size: int):
+        frequency, _, channels = pygame.mixer.get_init()
+        self.frequency = frequency
+        self.channels = channels
+        self.mixer = Crossfader(frequency, channels, crossfade)
+        # None while the equalizer is flat
+        self.equalizer = None
+        self.block_size = block_size
+        # a channel all to ourselves, so a Sound played somewhere else can't take it over
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        # the next song is decoded here while the current one plays (decoding doesn't hold the GIL)
+        self.decoder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.decoding = None
+        self.paused = False
+        # something was started and hasn't been reported as over yet (see advanced())
+        self.playing = False
+        self.switched = False
+        log.log(Debug(f"numpy backend, {frequency} Hz, {channels} channels, blocks of {block_size} frames"))
+
+    def play(self, path: str, gain_db: float = 0.0):
+        """start a song (anything preloaded is dropped)"""
+        self.stop()
+        self.mixer.current = decode(path, gain_db)
+        self.playing = True
+        self.fill()
+
+    def preload(self, path: str, gain_db: float = 0.0):
+        """decode the song that comes after the current one (replaces one preloaded before)"""
+        if self.decoding is not None:
+            self.decoding.cancel()
+        self.mixer.upcoming = None
+        self.decoding = self.decoder.submit(decode, path, gain_db)
+
+    def equalize(self, gains: list):
+        """set the gains (dB) of the equalizer's bands"""
+        if self.equalizer is not None and self.equalizer.gains == list(gains):
+            return
+        if any(gains):
+            self.equalizer = Equalizer(gains, self.frequency, self.channels)
+        else:
+            self.equalizer = None
+        log.log(Debug(f"Equalizer set to {list(gains)}"))
+
+    def collect(self):
+        """wait for the song being decoded, it's up next"""
+        future, self.decoding = self.decoding, None
+        try:
+            self.mixer.upcoming = future.result()
+        except (pygame.error, OSError) as e:
+            log.log(Warn(f"Unable to decode the next song ({e}), it'll be loaded when it's up."))
+        except concurrent.futures.CancelledError:
+            pass
+
+    def fill(self):
+        """mix blocks until the channel has one playing and one waiting"""
+        while self.channel.get_queue() is None:
+            current = self.mixer.current
+            if (
+                self.decoding is not None
+                and current is not None
+                and (self.decoding.done() or current.remaining <= self.mixer.crossfade + self.block_size)
+            ):
+                # decoded, or it's about time for it (waiting for it beats a gap)
+                self.collect()
+            rendered = self.mixer.render(self.block_size)
+            if rendered is None:
+                break
+            block, switched = rendered
+            self.switched = self.switched or switched
+            if self.equalizer is not None:
+                block = self.equalizer.process(block)
+            sound = pygame.sndarray.make_sound(to_int16(block))
+            if self.channel.get_busy():
+                self.channel.queue(sound)
+            else:
+                self.channel.play(sound)
+                if self.paused:
+                    self.channel.pause()
+
+    def service(self):
+        """keep the channel fed, called whenever the player wakes up"""
+        if self.playing:
+            self.fill()
+
+    def timeout(self):
+        """seconds until service() has to be called again (None if it doesn't)"""
+        if self.paused or not self.playing:
+            return None
+        # the block playing is at most this far from its end, the one in the queue is next
+        return self.block_size / self.frequency / 2
+
+    def advanced(self):
+        """check if the current song ended (and the preloaded one, if any, took over) since the last call"""
+        if self.switched:
+            self.switched = False
+            return True
+        if self.playing and self.mixer.current is None and self.mixer.outgoing is None:
+            # everything is mixed, it's over once the channel played it
+            if not self.channel.get_busy():
+                self.playing = False
+                return True
+        return False
+
+    def busy(self):
+        return self.mixer.current is not None
+
+    def position(self):
+        """seconds into the current song (to within half a block, the channel plays behind the mixer)"""
+        current = self.mixer.current
+        if current is None:
+            return 0.0
+        # the mixer is ahead by the block waiting in the channel's queue, and about half the one playing
+        behind = self.block_size * (1.5 if self.channel.get_queue() is not None else 0.5)
+        return max(current.cursor - behind, 0) / self.frequency
+
+    def seek(self, position: float):
+        """jump to a position (seconds) in the current song"""
+        current = self.mixer.current
+        if current is None:
+            return
+        # a crossfade in progress is cut short
+        self.mixer.outgoing = None
+        current.fade = None
+        current.cursor = min(max(int(position * self.frequency), 0), current.frames)
+        self.channel.stop()
+        if self.equalizer is not None:
+            self.equalizer.reset()
+        self.fill()
+
+    def pause(self):
+        self.paused = True
+        self.channel.pause()
+
+    def unpause(self):
+        self.paused = False
+        self.channel.unpause()
+
+    def stop(self):
+        """stop playing, and forget the songs (preloaded too)"""
+        self.channel.stop()
+        if self.decoding is not None:
+            self.decoding.cancel()
+            self.decoding = None
+        self.mixer.current = self.mixer.outgoing = self.mixer.upcoming = None
+        if self.equalizer is not None:
+            self.equalizer.reset()
+        self.playing = False
+        self.switched = False
+
+    def set_volume(self, volume: float):
+        self.channel.set_volume(volume)
+
+    def close(self):
+        self.stop()
+        self.decoder.shutdown(wait=False, cancel_futures=True)
+
+
+def benchmark(
+    seconds: float = 600,
+    block_size: int = 8192,
+    crossfade: float = 5.0,
+    frequency: int = 44100,
+    gains: list = None,
+):
+    """mix `seconds` of (generated) stereo audio, with a crossfade every 30 seconds (and the equalizer)
+
+    returns the processing time (seconds) per second of audio.
+    """
+    song = (np.random.default_rng(0).standard_normal((frequency * 30, 2)) * 3000).astype(np.int16)
+    mixer = Crossfader(frequency, 2, crossfade)
+    mixer.current = Track("benchmark", song, gain_db=-3.0)
+    equalizer = Equalizer(gains, frequency, 2) if gains and any(gains) else None
+    mixed = 0
+    started = time.perf_counter()
+    while mixed < seconds * frequency:
+        if mixer.upcoming is None:
+            mixer.upcoming = Track("benchmark", song, gain_db=2.0)
+        block, _ = mixer.render(block_size)
+        if equalizer is not None:
+            block = equalizer.process(block)
+        to_int16(block)
+        mixed += len(block)
+    return (time.perf_counter() - started) / (mixed / frequency)
+
+
+if __name__ == "__main__":
+    # python -m cmusic.dsp [block size]
+    block_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8192
+    for name, gains in (("crossfade", None), ("crossfade + equalizer", [6, 4, 2, 0, -2, 0, 2, 3, 4, 5])):
+        per_second = benchmark(block_size=block_size, gains=gains)
+        print(
+            f"{name}, blocks of {block_size} frames: {per_second * 1000:.3f} ms per second of audio "
+            f"({1 / per_second:.0f}x faster than real time)"
+        )
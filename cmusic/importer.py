@@ -0,0 +1,306 @@
+"""bulk song importer for cmusic"""
+
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import threading
+
+from . import db
+from . import indexlib
+from . import contenthash
+from . import walker
+from .constants import config, LOG_FILE, IMPORT_JOURNAL
+
+import objlog
+from objlog.LogMessages import Debug, Info, Warn, Error
+
+# this file imports whole folders of songs into the library without asking anything.
+# it's a pipeline, every stage runs at the same time and hands songs to the next one through a queue:
+#   parse (worker processes) -> copy (threads) -> write tags (thread) -> insert (this thread)
+# every song that made it into the index is written to a journal, so an interrupted import can be
+# run again and picks up where it stopped. so is every file copied into the library (before it's copied),
+# so the next run knows which files it may overwrite: anything else already in the library is left alone.
+
+log = objlog.LogNode("IMPORTER", log_file=LOG_FILE)
+
+# marks the end of a queue
+_DONE = object()
+
+
+def expand_sources(sources: list):
+    """turn files, directories and glob patterns into a sorted list of mp3 files"""
+    found = set()
+    for source in sources:
+        if glob.has_magic(source):
+            matches = glob.glob(os.path.expanduser(source), recursive=True)
+        else:
+            matches = [os.path.expanduser(source)]
+        if not matches:
+            log.log(Warn(f"Nothing matches '{source}', skipping."))
+        for match in matches:
+            if os.path.isdir(match):
+                found.update(walker.walk(os.path.abspath(match)).files)
+            elif match.endswith(".mp3") and os.path.isfile(match):
+                found.add(os.path.abspath(match))
+            elif not os.path.exists(match):
+                log.log(Warn(f"'{match}' not found, skipping."))
+    return sorted(found)
+
+
+def _parse(task: tuple):
+    """read the tags of a file and hash its audio (unless the hash is cached), used by the worker processes"""
+    path, content_hash = task
+    path, tags, error = indexlib._read_tags(path)
+    if tags is None:
+        return path, None, error
+    stat = None
+    if content_hash is None:
+        try:
+            size, mtime_ns, content_hash = contenthash.file_hash(path)
+        except OSError as e:
+            return path, None, str(e)
+        stat = (size, mtime_ns)
+    return path, (tags, content_hash, stat), None
+
+
+def load_journal(sources: list):
+    """get what a previous (interrupted) import of the same sources did, returns (done, copied)
+
+    done are the sources it finished, copied the files it wrote into the library (finished or not).
+    """
+    if not os.path.exists(IMPORT_JOURNAL):
+        return set(), set()
+    with open(IMPORT_JOURNAL) as f:
+        lines = f.read().splitlines()
+    try:
+        header = json.loads(lines[0])
+    except (IndexError, ValueError):
+        return set(), set()
+    if header.get("sources") != sources or header.get("library") != config["library"]:
+        log.log(Warn("Found the journal of a different import, starting over."))
+        return set(), set()
+    done = set()
+    copied = set()
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+            if "copied" in entry:
+                copied.add(entry["copied"])
+            else:
+                done.add(entry["source"])
+        except (ValueError, KeyError):
+            # the last line can be cut short by a crash, that song just gets imported again
+            continue
+    log.log(Info(f"Resuming import, {len(done)} songs already imported."))
+    return done, copied
+
+
+def import_songs(sources: list, workers: int = None, batch_size: int = None):
+    """import songs (files, directories or glob patterns) into the library, without prompting
+
+    songs that are already in the index (same audio, see contenthash) are skipped.
+    returns the number of songs imported.
+    """
+    library = config["library"]
+    batch_size = batch_size or config["index_batch_size"]
+    copy_threads = config["import_threads"]
+    started = time.time()
+
+    files = expand_sources(sources)
+    done, copied_before = load_journal(sources)
+    journal = open(IMPORT_JOURNAL, "a" if done or copied_before else "w")
+    if not (done or copied_before):
+        journal.write(json.dumps({"library": library, "sources": sources}) + "\n")
+    pending = [path for path in files if path not in done]
+    log.log(Info(f"Importing {len(pending)} songs ({len(files) - len(pending)} already done)."))
+
+    # what's already there: paths are taken, content hashes are duplicates
+    contenthash.refresh_library_hashes(library, workers)
+    c = db.cursor(library)
+    taken = set()
+    known = set()
+    for path, content_hash in c.execute("SELECT path, content_hash FROM songs"):
+        taken.add(path)
+        known.add(content_hash)
+    # files imported (or looked at) before don't have to be hashed again
+    cached = contenthash.cached_hashes(library, pending)
+    # guards the names taken, the counters and the journal, which the copy and tag threads share
+    lock = threading.Lock()
+
+    # small queues, so a fast stage can't run away from a slow one (and memory stays bounded)
+    to_copy = queue.Queue(maxsize=256)
+    to_tag = queue.Queue(maxsize=256)
+    to_insert = queue.Queue(maxsize=256)
+    stats = {"skipped": 0, "failed": 0, "bytes": 0}
+    stop = threading.Event()
+
+    def parse():
+        """stage 1: read the tags and hash the audio (worker processes), and drop duplicates"""
+        hashed = []
+        tasks = [(path, cached.get(path)) for path in pending]
+        try:
+            for path, (tags, content_hash, stat) in indexlib.read_tags_parallel(
+                tasks, workers, reader=_parse
+            ):
+                if stop.is_set():
+                    break
+                if stat is not None:
+                    hashed.append((path,) + stat + (content_hash,))
+                if content_hash in known:
+                    log.log(Debug(f"'{path}' is already in the library, skipping."))
+                    with lock:
+                        stats["skipped"] += 1
+                    continue
+                known.add(content_hash)
+                to_copy.put((path, tags, content_hash))
+        finally:
+            for _ in range(copy_threads):
+                to_copy.put(_DONE)
+            with db.transaction(library) as c:
+                c.executemany(
+                    "INSERT OR REPLACE INTO hash_cache (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                    hashed,
+                )
+
+    def copy():
+        """stage 2: copy the file into the library, under a name no other song has"""
+        while (item := to_copy.get()) is not _DONE:
+            path, tags, content_hash = item
+            if stop.is_set():
+                continue
+            if tags[0] is not None:
+                name = indexlib.safe(tags[0])
+            else:
+                name = os.path.splitext(os.path.basename(path))[0]
+            with lock:
+                for candidate in indexlib.name_candidates(name):
+                    destination = os.path.join(library, candidate)
+                    if destination in taken:
+                        continue
+                    # a file that isn't in the index (yet) is only overwritten if this import wrote it
+                    # (before it was interrupted), it could be a song waiting for cmusic list --sync
+                    if not os.path.exists(destination) or destination in copied_before:
+                        break
+                taken.add(destination)
+                journal.write(json.dumps({"copied": destination}) + "\n")
+                journal.flush()
+            try:
+                copied = indexlib.copy_file(path, destination)
+            except OSError as e:
+                log.log(Error(f"Unable to copy '{path}' ({e}), skipping."))
+                with lock:
+                    stats["failed"] += 1
+                continue
+            with lock:
+                stats["bytes"] += copied
+            to_tag.put((path, destination, tags, content_hash))
+        to_tag.put(_DONE)
+
+    def tag():
+        """stage 3: write the tags the index will have into the copy (only the ones that differ)"""
+        finished = 0
+        while finished < copy_threads:
+            item = to_tag.get()
+            if item is _DONE:
+                finished += 1
+                continue
+            path, destination, tags, content_hash = item
+            if stop.is_set():
+                continue
+            title, artist, album, duration, genre, year = tags
+            try:
+                _, _, frames = indexlib.plan_song(
+                    (None, destination, title, artist, album, duration, genre, year)
+                )
+                if frames:
+                    indexlib.write_tags(destination, frames)
+            except Exception as e:
+                log.log(Error(f"Unable to write the tags of '{destination}' ({e}), skipping."))
+                os.remove(destination)
+                with lock:
+                    stats["failed"] += 1
+                continue
+            to_insert.put((path, destination, tags, content_hash))
+        to_insert.put(_DONE)
+
+    stages = [threading.Thread(target=parse, daemon=True)]
+    stages += [threading.Thread(target=copy, daemon=True) for _ in range(copy_threads)]
+    stages += [threading.Thread(target=tag, daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    # stage 4: insert into the index, one transaction (and one journal flush) per batch
+    imported = 0
+    batch = []
+    last_progress = 0
+
+    def commit():
+        rows = []
+        for _, destination, tags, content_hash in batch:
+            rows.append((destination,) + tuple(tags) + indexlib.file_stat(destination) + (content_hash,))
+        with db.transaction(library) as c:
+            c.executemany(
+                "INSERT INTO songs (path, title, artist, album, duration, genre, year, size, mtime_ns, inode, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            # the copies have the same audio, only their tags changed
+            c.executemany(
+                "INSERT OR REPLACE INTO hash_cache (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                [(row[0], row[7], row[8], row[10]) for row in rows],
+            )
+        with lock:
+            for path, destination, _, _ in batch:
+                journal.write(json.dumps({"source": path, "path": destination}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        batch.clear()
+
+    try:
+        while (item := to_insert.get()) is not _DONE:
+            batch.append(item)
+            imported += 1
+            if len(batch) >= batch_size:
+                commit()
+            if time.time() - last_progress > 0.1:
+                progress(imported, len(pending), stats, started)
+                last_progress = time.time()
+        commit()
+    except BaseException:
+        stop.set()
+        # let the stages wind down, so nothing is copied after the last commit
+        # (the other stages skip what's left in their queue, only the insert queue has no one reading it)
+        while any(stage.is_alive() for stage in stages):
+            try:
+                while True:
+                    to_insert.get_nowait()
+            except queue.Empty:
+                time.sleep(0.01)
+        journal.close()
+        print()
+        print("Import interrupted, run the same command again to resume.")
+        raise
+
+    journal.close()
+    os.remove(IMPORT_JOURNAL)
+    progress(imported, len(pending), stats, started)
+    print()
+    log.log(
+        Info(
+            f"Imported {imported} songs ({stats['skipped']} duplicates skipped, {stats['failed']} failed)."
+        )
+    )
+    return imported
+
+
+def progress(imported: int, total: int, stats: dict, started: float):
+    """print the progress line (overwritten in place)"""
+    elapsed = max(time.time() - started, 1e-6)
+    line = (
+        f"\r{imported}/{total} imported, {stats['skipped']} skipped, {stats['failed']} failed"
+        f" | {imported / elapsed:.1f} songs/s, {stats['bytes'] / elapsed / 1024 / 1024:.1f} MB/s"
+    )
+    sys.stdout.write(line)
+    sys.stdout.flush()
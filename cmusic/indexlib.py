@@ -2,15 +2,29 @@
 
 import re
 import os
+import math
+import unicodedata
+import time
+import json
+import atexit
+import collections
+import multiprocessing
+import concurrent.futures
 import tinytag
 import sqlite3
 import mutagen
 import mutagen.id3
+import mutagen.mp3
 from tinytag import TinyTag
 
 import inquirer
 
-from .constants import config
+from .constants import config, REFORMAT_JOURNAL, SEARCH_CACHE_FILE
+from . import db
+from . import schema
+from . import contenthash
+from . import walker
+from .db import INDEX_FILE, REBUILD_FILE
 
 import objlog
 from objlog.LogMessages import Debug, Info, Warn, Error, Fatal
@@ -33,115 +47,846 @@ def safe(filename):
     return re.sub(r'[\\/*?:"<>| ]', "_", filename)
 
 
-def init_index(library_file: str):
-    """initialize an index file for a library"""
-    conn = sqlite3.connect(os.path.join(library_file, "index.db"))
-    c = conn.cursor()
-    # create table to link tags to file paths
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, path TEXT, title TEXT, artist TEXT, album TEXT, duration REAL, genre TEXT, year INTEGER)"
-    )
-    conn.commit()
-    # playlists (many to many)
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, name TEXT)"
-    )
-    conn.commit()
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS playlist_songs (playlist_id INTEGER, song_id INTEGER)"
-    )
-    conn.commit()
-    conn.close()
+def init_index(library_file: str, index_name: str = INDEX_FILE, search_indexes: bool = True):
+    """initialize an index file for a library
 
+    search_indexes=False leaves out the full-text and fuzzy indexes (and their triggers), which is
+    a lot faster for bulk inserts. creating them later builds them from the songs in one go.
+    """
+    with db.transaction(library_file, index_name=index_name) as c:
+        # tables and indexes (see schema.py)
+        schema.migrate(c)
+        if search_indexes:
+            create_search_index(c)
+            create_fuzzy_index(c)
 
-def index_library(library_file: str):
-    """creates a new library or re-index an existing one"""
-    if os.path.exists(os.path.join(library_file, "index.db")):
-        log.log(Warn("Library already indexed, deleting old index"))
-        os.remove(os.path.join(library_file, "index.db"))
 
-    conn = sqlite3.connect(os.path.join(library_file, "index.db"))
-    c = conn.cursor()
-    # create table to link tags to file paths
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, path TEXT, title TEXT, artist TEXT, album TEXT, duration REAL, genre TEXT, year INTEGER)"
+def file_stat(path: str):
+    """get the (size, mtime_ns, inode) of a file, as stored in the index"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+# how much is copied per call when copying files into the library
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_file(source: str, destination: str):
+    """copy a file without loading it into memory
+
+    the kernel copies the data when it can (copy_file_range, then sendfile), otherwise it's copied
+    in chunks of COPY_CHUNK_SIZE.
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            try:
+                while copied < size:
+                    if method == "copy_file_range":
+                        n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                    else:
+                        n = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                return copied
+            except OSError as e:
+                # not supported here (other filesystem, old kernel, ...), nothing was copied by this method
+                log.log(Debug(f"{method} unavailable ({e}), falling back"))
+                if copied:
+                    raise
+        src.seek(copied)
+        dst.seek(copied)
+        while True:
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+            copied += len(chunk)
+    return copied
+
+
+def _read_tags(path: str):
+    """read the tags of a single file, used by the indexing worker processes"""
+    try:
+        tags = tinytag.TinyTag.get(path)
+    except Exception as e:
+        # don't let one broken file take down the whole pool, the writer logs it
+        return path, None, str(e)
+    return (
+        path,
+        (tags.title, tags.artist, tags.album, tags.duration, tags.genre, tags.year),
+        None,
     )
-    conn.commit()
+
+
+def read_tags_parallel(paths: list, workers: int = None, reader=None):
+    """read the tags of many files with a pool of worker processes
+
+    yields (path, (title, artist, album, duration, genre, year)) as soon as each file is parsed,
+    in no particular order. files that can't be read are logged and skipped.
+    a different reader (a module level function, returning (path, result, error) like _read_tags)
+    can be passed in to read more than the tags in the same pass.
+    """
+    reader = reader or _read_tags
+    workers = workers or config["index_workers"] or os.cpu_count() or 1
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(paths) > 1 else None
+    try:
+        if pool is not None:
+            # small chunks keep the workers busy without holding results back for too long
+            chunksize = max(1, min(64, len(paths) // (workers * 4)))
+            results = pool.imap_unordered(reader, paths, chunksize)
+        else:
+            results = map(reader, paths)
+        for path, tags, error in results:
+            if tags is None:
+                log.log(Error(f"Unable to read tags of '{path}' ({error}), skipping."))
+                continue
+            yield path, tags
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def index_library(library_file: str, workers: int = None, batch_size: int = None):
+    """creates a new library or re-index an existing one
+
+    tags are parsed by a pool of worker processes and streamed back to this process, which writes
+    them in batches into a shadow index next to the real one. once everything is indexed, the
+    playlists are carried over and the shadow index is copied over the old one in a single
+    transaction (sqlite's backup API), so readers see either the old index or the new one and the
+    old index stays usable the whole time. every batch is a checkpoint: if the rebuild is interrupted,
+    running it again picks up where it stopped.
+    """
+    workers = workers or config["index_workers"] or os.cpu_count() or 1
+    batch_size = batch_size or config["index_batch_size"]
+
+    live_path = db.index_path(library_file)
+    rebuild_path = db.index_path(library_file, REBUILD_FILE)
+
+    # the search indexes are built once all songs are in, instead of row by row
+    init_index(library_file, REBUILD_FILE, search_indexes=False)
+    with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS rebuild_checkpoint (library TEXT, started REAL)"
+        )
+        checkpoint = c.execute("SELECT library FROM rebuild_checkpoint").fetchone()
+        if checkpoint is not None and checkpoint[0] == library_file:
+            log.log(Info("Found an interrupted re-index, resuming it"))
+        else:
+            # a stale (or foreign) shadow index, start over
+            c.execute("DELETE FROM songs")
+            c.execute("DELETE FROM rebuild_checkpoint")
+            c.execute(
+                "INSERT INTO rebuild_checkpoint (library, started) VALUES (?, ?)",
+                (library_file, time.time()),
+            )
 
     # get all files in the library
-    for root, _, files in os.walk(library_file):
-        for file in files:
-            if file.endswith(".mp3"):
-                path = os.path.join(root, file)
-                # get the tags of the file
-                tags = tinytag.TinyTag.get(path)
-                log.log(Info(f"Indexing {tags.title} by {tags.artist}"))
-                # insert the tags into the database
+    walk = walker.walk(library_file)
+    files = walk.files
+    with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+        done = {row[0] for row in c.execute("SELECT path FROM songs")}
+        # forget anything the interrupted run indexed that has since disappeared
+        c.executemany(
+            "DELETE FROM songs WHERE path = ?",
+            [(path,) for path in done if path not in files],
+        )
+    todo = [path for path in files if path not in done]
+
+    # songs keep the ID they have in the old index (matched by path), the queue refers to songs by ID.
+    # new songs get IDs after every ID either index has used, so an ID never ends up on another song
+    old_ids = {}
+    next_id = 1
+    if os.path.exists(live_path):
+        c = db.cursor(library_file)
+        old_ids = dict(c.execute("SELECT path, id FROM songs"))
+        next_id = (c.execute("SELECT MAX(id) FROM songs").fetchone()[0] or 0) + 1
+    # IDs an interrupted run already gave out (the live index can give one of them to a song imported since)
+    used = {row[0] for row in db.cursor(library_file, REBUILD_FILE).execute("SELECT id FROM songs")}
+    next_id = max([next_id] + [song_id + 1 for song_id in used])
+
+    log.log(
+        Info(
+            f"Indexing {len(todo)} files ({len(files) - len(todo)} already done) with {workers} workers "
+            f"(batch size {batch_size})"
+        )
+    )
+    start = time.perf_counter()
+    indexed = 0
+    batch = []
+    try:
+        for path, tags in read_tags_parallel(todo, workers):
+            song_id = old_ids.get(path)
+            if song_id is None or song_id in used:
+                song_id = next_id
+                next_id += 1
+            batch.append((song_id, path) + tags + files[path])
+            if len(batch) >= batch_size:
+                # insert the tags into the shadow index, every commit is a checkpoint
+                with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+                    c.executemany(
+                        "INSERT INTO songs (id, path, title, artist, album, duration, genre, year, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        batch,
+                    )
+                indexed += len(batch)
+                batch = []
+        with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+            c.executemany(
+                "INSERT INTO songs (id, path, title, artist, album, duration, genre, year, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+        indexed += len(batch)
+
+        shadow = db.connect(library_file, REBUILD_FILE)
+        # carry the playlists over from the old index, songs are matched by path (their IDs are kept,
+        # the join drops the songs that are gone)
+        if os.path.exists(live_path):
+            shadow.execute("ATTACH DATABASE ? AS old", (live_path,))
+            with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+                c.execute("DELETE FROM playlists")
+                c.execute("DELETE FROM playlist_songs")
+                c.execute(
+                    "INSERT INTO playlists (id, name) SELECT id, name FROM old.playlists"
+                )
                 c.execute(
-                    "INSERT INTO songs (path, title, artist, album, duration, genre, year) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        path,
-                        tags.title,
-                        tags.artist,
-                        tags.album,
-                        tags.duration,
-                        tags.genre,
-                        tags.year,
-                    ),
+                    """
+                INSERT INTO playlist_songs (playlist_id, song_id)
+                SELECT ps.playlist_id, new.id
+                FROM old.playlist_songs ps
+                JOIN old.songs prev ON prev.id = ps.song_id
+                JOIN main.songs new ON new.path = prev.path
+                ORDER BY ps.rowid
+                """
                 )
-                conn.commit()
-    conn.close()
+                # and the hash cache, so files don't have to be hashed again
+                if c.execute(
+                    "SELECT 1 FROM old.sqlite_master WHERE type = 'table' AND name = 'hash_cache'"
+                ).fetchone():
+                    c.execute("INSERT OR REPLACE INTO main.hash_cache SELECT * FROM old.hash_cache")
+                contenthash.apply_cache(c)
+                # keep counting up from the old index's generation, results cached for it must not look current
+                if c.execute(
+                    "SELECT 1 FROM old.sqlite_master WHERE type = 'table' AND name = 'generation'"
+                ).fetchone():
+                    c.execute(
+                        "UPDATE main.generation SET value = value + (SELECT value FROM old.generation) + 1"
+                    )
+                # and the loudness analysis of songs that didn't change, so they aren't analyzed again
+                if "analyzed_size" in [column[1] for column in c.execute("PRAGMA old.table_info(songs)")]:
+                    c.execute(
+                        """
+                    UPDATE main.songs SET (loudness, peak_db, gain_db, analyzed_size, analyzed_mtime_ns) = (
+                        SELECT prev.loudness, prev.peak_db, prev.gain_db, prev.analyzed_size, prev.analyzed_mtime_ns
+                        FROM old.songs prev WHERE prev.path = songs.path
+                    )
+                    WHERE EXISTS (
+                        SELECT 1 FROM old.songs prev
+                        WHERE prev.path = songs.path AND prev.analyzed_size = songs.size AND prev.analyzed_mtime_ns = songs.mtime_ns
+                    )
+                    """
+                    )
+            shadow.execute("DETACH DATABASE old")
+        with db.transaction(library_file, index_name=REBUILD_FILE) as c:
+            create_search_index(c)
+            create_fuzzy_index(c)
+            walker.save_dirs(c, walk)
+            c.execute("DROP TABLE rebuild_checkpoint")
+    except KeyboardInterrupt:
+        log.log(Warn(f"Re-index interrupted after {indexed} files, checkpoint kept"))
+        print("Re-index interrupted, run it again to resume where it stopped.")
+        raise
 
+    # swap the new index in. the index runs in WAL mode, where replacing the file under other
+    # open connections would corrupt it, so the shadow is copied in through the backup API
+    # instead: that's one write transaction, readers see either the old index or the new one.
+    shadow.backup(db.connect(library_file))
+    db.close(library_file, REBUILD_FILE)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(rebuild_path + suffix):
+            os.remove(rebuild_path + suffix)
 
-def index_file(library_file: str, file: str):
-    """index a single song file"""
-    conn = sqlite3.connect(os.path.join(library_file, "index.db"))
-    c = conn.cursor()
-    # create table to link tags to file paths
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, path TEXT, title TEXT, artist TEXT, album TEXT, duration REAL, genre TEXT, year INTEGER)"
+    elapsed = time.perf_counter() - start
+    rate = indexed / elapsed if elapsed > 0 else float(indexed)
+    log.log(Info(f"Indexed {indexed} files in {elapsed:.2f}s ({rate:.1f} files/s)"))
+    print(f"Indexed {indexed} files in {elapsed:.2f}s ({rate:.1f} files/s)")
+
+
+def sync_library(library_file: str, workers: int = None, batch_size: int = None, quiet: bool = False):
+    """incrementally bring the index up to date with the files in the library
+
+    only files whose size, mtime or inode changed are parsed again, new files are added and
+    vanished ones removed. song IDs are kept, so playlists survive a sync.
+    returns the number of songs added, updated, moved and removed. quiet only prints if something changed.
+    """
+    batch_size = batch_size or config["index_batch_size"]
+    start = time.perf_counter()
+
+    init_index(library_file)
+    c = db.cursor(library_file)
+
+    # directories that didn't change since the last sync aren't read again
+    walk = walker.walk(library_file, walker.load_dirs(c))
+    on_disk = dict(walk.files)
+    indexed = {
+        row[0]: (row[1], (row[2], row[3], row[4]))
+        for row in c.execute("SELECT path, id, size, mtime_ns, inode FROM songs")
+    }
+    # so the songs in them are all still there, but they can have been edited in place (that doesn't
+    # change the directory's mtime), they're stat'ed instead of listed
+    on_disk.update(walker.stat_files([path for path in indexed if os.path.dirname(path) in walk.pruned]))
+
+    vanished = {path: indexed[path] for path in indexed if path not in on_disk}
+    new = [path for path in on_disk if path not in indexed]
+    changed = [
+        path
+        for path in on_disk
+        if path in indexed and indexed[path][1] != on_disk[path]
+    ]
+
+    # files that were moved/renamed inside the library keep their inode and stat,
+    # so they can just be pointed at their new path without parsing them again
+    moved = []
+    by_stat = {stat: (path, song_id) for path, (song_id, stat) in vanished.items()}
+    for path in list(new):
+        if on_disk[path] in by_stat:
+            old_path, song_id = by_stat.pop(on_disk[path])
+            del vanished[old_path]
+            new.remove(path)
+            moved.append((path, song_id))
+
+    log.log(
+        Info(
+            f"Sync: {len(new)} new, {len(changed)} changed, {len(moved)} moved, {len(vanished)} vanished"
+        )
+    )
+
+    # parse first, so the write lock is only held for the writes themselves
+    inserts = []
+    updates = []
+    for path, tags in read_tags_parallel(new + changed, workers):
+        if path in indexed:
+            # re-parsed file, update in place so the ID stays the same
+            updates.append(tags + on_disk[path] + (indexed[path][0],))
+        else:
+            inserts.append((path,) + tags + on_disk[path])
+
+    with db.transaction(library_file) as c:
+        c.executemany(
+            "UPDATE songs SET path = ? WHERE id = ?",
+            moved,
+        )
+        vanished_ids = [(song_id,) for song_id, _ in vanished.values()]
+        c.executemany("DELETE FROM songs WHERE id = ?", vanished_ids)
+        c.executemany("DELETE FROM playlist_songs WHERE song_id = ?", vanished_ids)
+        for i in range(0, max(len(inserts), len(updates)), batch_size):
+            c.executemany(
+                "INSERT INTO songs (path, title, artist, album, duration, genre, year, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                inserts[i : i + batch_size],
+            )
+            c.executemany(
+                "UPDATE songs SET title = ?, artist = ?, album = ?, duration = ?, genre = ?, year = ?, size = ?, mtime_ns = ?, inode = ?, content_hash = NULL WHERE id = ?",
+                updates[i : i + batch_size],
+            )
+        # changed and new files get their hash back from the cache, if it's still valid
+        contenthash.apply_cache(c)
+        walker.save_dirs(c, walk)
+
+    elapsed = time.perf_counter() - start
+    log.log(
+        Info(
+            f"Library synced in {elapsed:.2f}s ({len(walk.files)} files checked, "
+            f"{walk.visited} directories read, {len(walk.pruned)} unchanged)"
+        )
     )
-    conn.commit()
+    changes = {"added": len(new), "updated": len(changed), "moved": len(moved), "removed": len(vanished)}
+    if not quiet or any(changes.values()):
+        print(
+            f"Library synced in {elapsed:.2f}s: {len(new)} added, {len(changed)} updated, "
+            f"{len(moved)} moved, {len(vanished)} removed "
+            f"({walk.visited} directories read, {len(walk.pruned)} unchanged)."
+        )
+    return changes
+
+
+def index_file(library_file: str, file: str, c=None, tags: tuple = None, content_hash: str = None):
+    """index a single song file (or update it, if it's already in the index), returns its ID
 
+    if the tags were already read, pass them in (title, artist, album, duration, genre, year) so the
+    file isn't parsed again. the same goes for the content hash of the file.
+    """
     # get all files in the library
     path = file
     # get the tags of the file
-    tags = tinytag.TinyTag.get(path)
-    log.log(Info(f"Indexing {tags.title} by {tags.artist}"))
-    # insert the tags into the database
+    if tags is None:
+        tags = tinytag.TinyTag.get(path)
+        tags = (tags.title, tags.artist, tags.album, tags.duration, tags.genre, tags.year)
+    # "None" to null, just for cleanliness
+    tags = tuple(None if value == "None" else value for value in tags)
+    log.log(Info(f"Indexing {tags[0]} by {tags[1]}"))
+    with db.transaction(library_file, c) as c:
+        c.execute("SELECT id FROM songs WHERE path = ?", (path,))
+        existing = c.fetchone()
+        if existing is None:
+            # insert the tags into the database
+            c.execute(
+                "INSERT INTO songs (path, title, artist, album, duration, genre, year, size, mtime_ns, inode, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path,) + tags + file_stat(path) + (content_hash,),
+            )
+            id = c.lastrowid
+        else:
+            # already indexed (the file changed), update it in place so the ID stays the same
+            id = existing[0]
+            c.execute(
+                "UPDATE songs SET title = ?, artist = ?, album = ?, duration = ?, genre = ?, year = ?, size = ?, mtime_ns = ?, inode = ?, content_hash = ? WHERE id = ?",
+                tags + file_stat(path) + (content_hash, id),
+            )
+        if content_hash is not None:
+            contenthash.remember(c, path, content_hash)
+    return id
+
+
+def fts5_available():
+    """check (once) if the sqlite build python was compiled against has the FTS5 extension"""
+    global _FTS5_AVAILABLE
+    if _FTS5_AVAILABLE is None:
+        try:
+            conn = sqlite3.connect(":memory:")
+            conn.execute("CREATE VIRTUAL TABLE fts5_check USING fts5(x)")
+            conn.close()
+            _FTS5_AVAILABLE = True
+        except sqlite3.OperationalError:
+            log.log(Warn("SQLite was built without FTS5, searching will be slower"))
+            _FTS5_AVAILABLE = False
+    return _FTS5_AVAILABLE
+
+
+_FTS5_AVAILABLE = None
+
+
+def create_search_index(c):
+    """create the full-text search index (FTS5) that mirrors the songs table, if FTS5 is available"""
+    if not fts5_available():
+        return
+    exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_fts'"
+    ).fetchone()
+    # external content table, so the text isn't stored twice. remove_diacritics makes "beyonce" match "Beyoncé"
     c.execute(
-        "INSERT INTO songs (path, title, artist, album, duration, genre, year) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (
-            path,
-            tags.title,
-            tags.artist,
-            tags.album,
-            tags.duration,
-            tags.genre,
-            tags.year,
-        ),
+        "CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(title, artist, album, genre, content='songs', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
     )
-    conn.commit()
-    id = c.lastrowid
-    None_to_null(id) # just for cleanliness
-    conn.close()
+    # keep it in sync with the songs table
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO songs_fts (rowid, title, artist, album, genre) VALUES (new.id, new.title, new.artist, new.album, new.genre);
+    END
+    """
+    )
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, title, artist, album, genre) VALUES ('delete', old.id, old.title, old.artist, old.album, old.genre);
+    END
+    """
+    )
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE OF title, artist, album, genre ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, title, artist, album, genre) VALUES ('delete', old.id, old.title, old.artist, old.album, old.genre);
+        INSERT INTO songs_fts (rowid, title, artist, album, genre) VALUES (new.id, new.title, new.artist, new.album, new.genre);
+    END
+    """
+    )
+    if not exists:
+        # first time, fill it with whatever is already indexed
+        log.log(Info("Building full-text search index"))
+        c.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')")
+
+
+def fts_query(search_term: str):
+    """turn a search term into an FTS5 query, every word is a prefix and all of them have to match"""
+    words = re.findall(r"\w+", search_term)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def create_fuzzy_index(c):
+    """create the trigram index used to resolve misspelled song names
+
+    it's an FTS5 table with the trigram tokenizer over the titles and artists, kept in sync by
+    triggers like the full-text index. it's only used to find candidates quickly, the actual
+    similarity is scored by fuzzy_search.
+    """
+    if not fts5_available():
+        return
+    exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_trigram'"
+    ).fetchone()
+    if not exists:
+        try:
+            # newer sqlite versions can ignore diacritics here as well
+            c.execute(
+                "CREATE VIRTUAL TABLE songs_trigram USING fts5(title, artist, content='songs', content_rowid='id', tokenize='trigram remove_diacritics 1')"
+            )
+        except sqlite3.OperationalError:
+            try:
+                c.execute(
+                    "CREATE VIRTUAL TABLE songs_trigram USING fts5(title, artist, content='songs', content_rowid='id', tokenize='trigram')"
+                )
+            except sqlite3.OperationalError:
+                log.log(Warn("SQLite has no trigram tokenizer, fuzzy matching is disabled"))
+                return
+    # document frequency of every trigram, so a search can start from the rarest ones
+    c.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS songs_trigram_vocab USING fts5vocab(songs_trigram, 'row')"
+    )
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_trigram_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO songs_trigram (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+    END
+    """
+    )
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_trigram_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO songs_trigram (songs_trigram, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist);
+    END
+    """
+    )
+    c.execute(
+        """
+    CREATE TRIGGER IF NOT EXISTS songs_trigram_update AFTER UPDATE OF title, artist ON songs BEGIN
+        INSERT INTO songs_trigram (songs_trigram, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist);
+        INSERT INTO songs_trigram (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+    END
+    """
+    )
+    if not exists:
+        log.log(Info("Building fuzzy matching index"))
+        c.execute("INSERT INTO songs_trigram (songs_trigram) VALUES ('rebuild')")
 
 
-def search_index(library_file: str, search_term: str):
-    """search the index within a library for a song"""
-    conn = sqlite3.connect(os.path.join(library_file, "index.db"))
-    c = conn.cursor()
+def trigrams(text):
+    """split text into its set of trigrams (lowercase, no diacritics, words padded like pg_trgm)"""
+    if text is None:
+        return set()
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    found = set()
+    for word in re.findall(r"\w+", text):
+        word = f"  {word} "
+        for i in range(len(word) - 2):
+            found.add(word[i : i + 3])
+    return found
+
+
+def similarity(a: set, b: set):
+    """jaccard similarity of two trigram sets (shared / total)"""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+# how many candidates a fuzzy search scores at most, picked by how many of the rare trigrams they share
+FUZZY_CANDIDATES = 200
+
+
+def fuzzy_search(library_file: str, search_term: str, threshold: float = None, limit: int = 10):
+    """find the songs whose title or artist look the most like the search term
+
+    candidates are the songs sharing the most of the query's rarest trigrams (from the trigram
+    index), they are then scored by trigram similarity against their title and artist. songs
+    below the threshold (config["fuzzy_threshold"]) are ignored, best matches come first.
+    """
+    threshold = config["fuzzy_threshold"] if threshold is None else threshold
+    query = trigrams(search_term)
+    # the trigram index only knows the trigrams inside words (no padding)
+    inner = [trigram for trigram in query if " " not in trigram]
+    if not inner:
+        return []
+    c = db.cursor(library_file)
+    if (
+        c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_trigram'"
+        ).fetchone()
+        is None
+    ):
+        return []
+
+    # a song needs at least `needed` shared trigrams to reach the threshold, so it has to contain
+    # at least one of the rarest (len - needed + 1) trigrams of the query, only those are looked up
+    counts = dict(
+        c.execute(
+            f"SELECT term, doc FROM songs_trigram_vocab WHERE term IN ({', '.join('?' * len(inner))})",
+            inner,
+        ).fetchall()
+    )
+    needed = max(1, math.ceil(threshold * len(query)))
+    rarest = sorted(counts, key=counts.get)[: max(1, len(counts) - needed + 1)]
+    if not rarest:
+        return []
     c.execute(
-        "SELECT * FROM songs WHERE title LIKE ? OR artist LIKE ? OR album LIKE ? OR genre LIKE ? OR year LIKE ?",
+        "SELECT songs.* FROM songs_trigram JOIN songs ON songs.id = songs_trigram.rowid WHERE songs_trigram MATCH ? ORDER BY rank LIMIT ?",
         (
-            "%" + search_term + "%",
-            "%" + search_term + "%",
-            "%" + search_term + "%",
-            "%" + search_term + "%",
-            "%" + search_term + "%",
+            " OR ".join('"' + trigram.replace('"', '""') + '"' for trigram in rarest),
+            FUZZY_CANDIDATES,
         ),
     )
-    return c.fetchall()
+    scored = []
+    for song in c.fetchall():
+        score = max(similarity(query, trigrams(song[2])), similarity(query, trigrams(song[3])))
+        if score >= threshold:
+            scored.append((score, song))
+    scored.sort(key=lambda match: match[0], reverse=True)
+    return [song for _, song in scored[:limit]]
+
+
+# what songs can be sorted by (--sort), text is sorted case insensitively (and matches the NOCASE indexes)
+SORT_COLUMNS = {
+    "id": "songs.id",
+    "title": "songs.title COLLATE NOCASE",
+    "artist": "songs.artist COLLATE NOCASE",
+    "album": "songs.album COLLATE NOCASE",
+    "genre": "songs.genre COLLATE NOCASE",
+    "year": "songs.year",
+    "duration": "songs.duration",
+    "path": "songs.path",
+}
+
+
+def order_by(sort: str):
+    """turn a sort spec ("artist,album,-year") into an ORDER BY list (None for no sort)"""
+    if not sort:
+        return None
+    terms = []
+    for key in sort.split(","):
+        key = key.strip()
+        descending = key.startswith("-")
+        column = SORT_COLUMNS.get(key.lstrip("-").lower())
+        if column is None:
+            raise ValueError(
+                f"Can't sort by '{key.lstrip('-')}', use one of {', '.join(SORT_COLUMNS)}"
+            )
+        terms.append(column + (" DESC" if descending else ""))
+    return ", ".join(terms)
+
+
+def limit_clause(limit: int = None, offset: int = 0):
+    """get the LIMIT/OFFSET of a query (and its params)"""
+    if limit is None and not offset:
+        return "", []
+    return " LIMIT ? OFFSET ?", [-1 if limit is None else limit, offset or 0]
+
+
+def search_index(
+    library_file: str, search_term: str, limit: int = None, offset: int = 0, sort: str = None
+):
+    """search the index within a library for a song, yields the matching songs
+
+    uses the full-text index (ranked by bm25) when it exists, falls back to a substring scan when
+    the full-text index has no matches or the sqlite build doesn't support FTS5.
+    rows come straight from the cursor, so nothing is held in memory and the first ones are there
+    before the last ones are found. sort is a sort spec (see order_by), limit and offset page through
+    the results.
+    """
+    order = order_by(sort)
+    # the cursor is our own, other queries can run on the connection while this one is being read
+    c = db.cursor(library_file)
+    if search_term == "":
+        # everything
+        page, params = limit_clause(limit, offset)
+        yield from c.execute(f"SELECT * FROM songs ORDER BY {order or 'songs.id'}{page}", params)
+        return
+
+    query = fts_query(search_term)
+    has_fts = (
+        query is not None
+        and fts5_available()
+        and c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_fts'"
+        ).fetchone()
+        is not None
+    )
+    if has_fts:
+        term = search_term.strip()
+        if term.isdigit():
+            # the year isn't part of the text index, songs that only match by year come after the others
+            sql = (
+                "WITH ranked AS (SELECT rowid AS id, bm25(songs_fts) AS score FROM songs_fts WHERE songs_fts MATCH ?) "
+                "SELECT songs.* FROM songs LEFT JOIN ranked ON ranked.id = songs.id "
+                "WHERE songs.id IN (SELECT id FROM ranked) OR songs.year = ?"
+            )
+            params = [query, int(term)]
+            rank = "songs.title = ? COLLATE NOCASE DESC, ranked.score IS NULL, ranked.score"
+            rank_params = [term]
+        else:
+            # an exact title match always comes first, the rest is ranked by relevance
+            rank = "songs.title = ? COLLATE NOCASE DESC, bm25(songs_fts)"
+            rank_params = [term]
+            sql = "SELECT songs.* FROM songs_fts JOIN songs ON songs.id = songs_fts.rowid WHERE songs_fts MATCH ?"
+            params = [query]
+        if order is not None:
+            rank, rank_params = order, []
+        page, page_params = limit_clause(limit, offset)
+        rows = c.execute(f"{sql} ORDER BY {rank}{page}", params + rank_params + page_params)
+        first = rows.fetchone()
+        if first is not None:
+            yield first
+            yield from rows
+            return
+        if offset:
+            # a page past the end of the full-text matches, not a reason to fall back
+            if c.execute(f"{sql} LIMIT 1", params).fetchone() is not None:
+                return
+
+    pattern = "%" + search_term + "%"
+    page, page_params = limit_clause(limit, offset)
+    yield from c.execute(
+        "SELECT * FROM songs WHERE title LIKE ? OR artist LIKE ? OR album LIKE ? OR genre LIKE ? OR year LIKE ?"
+        f" ORDER BY {order or 'songs.id'}{page}",
+        [pattern] * 5 + page_params,
+    )
+
+
+# the search cache.
+# scan_library resolves every name it's given (a playlist is played by resolving each of its titles), so the
+# same searches run again and again. results are cached by the (normalized) search and the generation of the
+# index, a counter every insert, update and delete of a song bumps (see schema._generation), a result cached
+# under an older generation is never used, so the cache can't return stale songs.
+# the cache lives in memory (an LRU of search_cache_size searches), and optionally on disk too
+# (search_cache_disk), where the next run of cmusic can use it.
+
+# (index path, kind, normalized search): (generation, songs)
+_search_cache = collections.OrderedDict()
+_search_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+# searches kept on disk, the least recently used ones go first
+DISK_CACHE_ENTRIES = 4096
+
+# the letters NOCASE and LIKE ignore the case of (only ASCII), and FTS5 ignores it too
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def normalize_search(search_term: str):
+    """normalize a search, so searches that find the same songs are cached once"""
+    return search_term.strip().translate(_ASCII_LOWER)
+
+
+def index_generation(library_file: str):
+    """get the generation of the index, it goes up with every change to the songs"""
+    row = db.cursor(library_file).execute("SELECT value FROM generation WHERE id = 1").fetchone()
+    return row[0] if row is not None else 0
+
+
+def _disk_cache():
+    """get the connection to the on-disk search cache (None if it's turned off)"""
+    if not config["search_cache_disk"]:
+        return None
+    conn = sqlite3.connect(SEARCH_CACHE_FILE, isolation_level=None, timeout=5)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_cache (library TEXT, key TEXT, generation INTEGER, songs TEXT, used REAL, PRIMARY KEY (library, key))"
+    )
+    return conn
+
+
+def cached_search(library_file: str, search_term: str, kind: str = "search"):
+    """search_index (kind "search"), fuzzy_search ("fuzzy") or query.search ("query") through the search cache
+
+    returns a list of songs, like the uncached search would (as a list).
+    """
+    size = config["search_cache_size"]
+    if kind == "query":
+        # field values are case sensitive in places (path), so only the spaces around it are ignored
+        term = search_term.strip()
+        key = term
+    else:
+        term = normalize_search(search_term)
+        # the threshold decides what fuzzy_search finds, and can change between runs
+        key = f"{term}\0{config['fuzzy_threshold']}" if kind == "fuzzy" else term
+    path = db.index_path(library_file)
+    generation = index_generation(library_file)
+
+    if size > 0:
+        entry = _search_cache.get((path, kind, key))
+        if entry is not None and entry[0] == generation:
+            _search_cache.move_to_end((path, kind, key))
+            _search_cache_stats["hits"] += 1
+            return list(entry[1])
+
+    disk = _disk_cache()
+    songs = None
+    if disk is not None:
+        row = disk.execute(
+            "SELECT songs FROM search_cache WHERE library = ? AND key = ? AND generation = ?",
+            (path, f"{kind}:{key}", generation),
+        ).fetchone()
+        if row is not None:
+            songs = [tuple(song) for song in json.loads(row[0])]
+            disk.execute(
+                "UPDATE search_cache SET used = ? WHERE library = ? AND key = ?",
+                (time.time(), path, f"{kind}:{key}"),
+            )
+            _search_cache_stats["disk_hits"] += 1
+
+    if songs is None:
+        _search_cache_stats["misses"] += 1
+        if kind == "fuzzy":
+            songs = fuzzy_search(library_file, term)
+        elif kind == "query":
+            # imported here, query imports indexlib
+            from . import query
+
+            songs = list(query.search(library_file, term))
+        else:
+            songs = list(search_index(library_file, term))
+        if disk is not None:
+            disk.execute(
+                "INSERT OR REPLACE INTO search_cache (library, key, generation, songs, used) VALUES (?, ?, ?, ?, ?)",
+                (path, f"{kind}:{key}", generation, json.dumps(songs), time.time()),
+            )
+            # what was cached for older generations can never be used again
+            disk.execute(
+                "DELETE FROM search_cache WHERE library = ? AND generation < ?", (path, generation)
+            )
+            disk.execute(
+                "DELETE FROM search_cache WHERE rowid IN (SELECT rowid FROM search_cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (DISK_CACHE_ENTRIES,),
+            )
+
+    if disk is not None:
+        disk.close()
+    if size > 0:
+        _search_cache[(path, kind, key)] = (generation, tuple(songs))
+        _search_cache.move_to_end((path, kind, key))
+        while len(_search_cache) > size:
+            _search_cache.popitem(last=False)
+    return songs
+
+
+def search_cache_stats():
+    """get the hit/miss counters of the search cache"""
+    return dict(_search_cache_stats)
+
+
+@atexit.register
+def _report_search_cache():
+    stats = _search_cache_stats
+    lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+    if lookups:
+        log.log(
+            Info(
+                f"Search cache: {stats['hits']} hits, {stats['disk_hits']} disk hits, {stats['misses']} misses "
+                f"({(stats['hits'] + stats['disk_hits']) / lookups:.0%} hit rate)"
+            )
+        )
+
 
 def tag_edit(song_file: str):
     """Allows the user to edit the tags of a song"""
@@ -222,6 +967,19 @@ def tag_edit(song_file: str):
 
 def index(song_file):
     """index a single song and allow the user to edit the info"""
+    # don't import a song that's already in the library (retagged copies included)
+    try:
+        content_hash = contenthash.hash_files(config["library"], [os.path.abspath(song_file)])[
+            os.path.abspath(song_file)
+        ]
+    except KeyError:
+        content_hash = None  # couldn't be read, tag_edit reports it
+    else:
+        duplicate = contenthash.find_song(config["library"], content_hash)
+        if duplicate is not None:
+            log.log(Warn(f"'{song_file}' is already in the library as '{duplicate[1]}'."))
+            print(f"'{song_file}' is already in the library ('{duplicate[2]}' by {duplicate[3]}), not indexing it.")
+            return
     try:
         data = tag_edit(song_file)
     except TypeError:
@@ -238,17 +996,15 @@ def index(song_file):
     album = data[2]
     year = data[3]
     genre = data[4]
-    song_path = os.path.join(config["library"], safe(song_name) + "." + song_file.split(".")[-1])
-    # copy the file to the library
+    # songs with the same name get a number instead of overwriting each other
+    for candidate in name_candidates(safe(song_name) if song_name else os.path.splitext(os.path.basename(song_file))[0]):
+        song_path = os.path.join(config["library"], candidate)
+        if not os.path.exists(song_path):
+            break
+    # copy the file to the library (streamed, the file is never loaded into memory)
     log.log(Info(f"Copying '{song_file}' to library..."))
-    with open(song_file, "rb") as f:
-        with open(song_path, "wb") as f2:
-            f2.write(f.read())
-    # load metadata into the mp3 file (post write, because mutagen doesn't like writing to open files)
-    tags = TinyTag.get(song_path)
-    tags.artist = artist
-    tags.album = album
-    # save the metadata (mutagen)
+    copy_file(song_file, song_path)
+    # write the metadata into the copy, in one mutagen pass (post copy, because mutagen doesn't like writing to open files)
     try:
         muta = mutagen.File(song_path)
     except mutagen.mp3.HeaderNotFoundError:
@@ -256,141 +1012,361 @@ def index(song_file):
         print(
             f"Unable to read file '{song_name}', is it a valid mp3 file? try playing it with an external player."
         )
+        os.remove(song_path)
         return
+    if muta.tags is None:
+        muta.add_tags()
     muta["TPE1"] = mutagen.id3.TPE1(encoding=3, text=["{}".format(artist)])
     muta["TALB"] = mutagen.id3.TALB(encoding=3, text=["{}".format(album)])
     muta["TIT2"] = mutagen.id3.TIT2(encoding=3, text=["{}".format(song_name)])
-    muta["TDRC"] = mutagen.id3.TDRC(encoding=3, text=["{}".format(tags.year)])
-    muta["TCON"] = mutagen.id3.TCON(encoding=3, text=["{}".format(tags.genre)])
+    muta["TDRC"] = mutagen.id3.TDRC(encoding=3, text=["{}".format(year)])
+    muta["TCON"] = mutagen.id3.TCON(encoding=3, text=["{}".format(genre)])
 
     log.log(Debug(f"Values: {artist}, {album}, {song_name}, {year}, {genre}"))
 
     muta.save()
 
     log.log(Info(f"File '{song_name}' copied to library."))
-    index_file(config["library"], str(song_path))
+    # index from the values that were just written, the duration comes from the same mutagen parse
+    index_file(
+        config["library"],
+        str(song_path),
+        tags=(song_name, artist, album, muta.info.length, genre, year),
+        content_hash=content_hash,
+    )
     print(f"File '{song_name}' copied to library.")
 
 
-def reformat():
-    """reformat all audio files in the library according to the index"""
-    cleanup()  # clean up the library first (remove ghost files)
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM songs")
-    songs = c.fetchall()
+# the tags reformat() writes, as (frame, column of the songs table)
+REFORMAT_FRAMES = (("TIT2", 2), ("TPE1", 3), ("TALB", 4), ("TDRC", 7), ("TCON", 6))
 
-    for song in songs:
-        try:
-            new_name = f"{safe(song[2])}.mp3"
-        except TypeError:
-            # no song name, get from file
-            tags = TinyTag.get(song[1])
-            if tags.title is None:
-                # no title, use file name
-                new_name = os.path.basename(song[1])
-            else:
-                new_name = f"{safe(tags.title)}.mp3"
-
-        new_path = os.path.join(config["library"], new_name)
-        log.log(Info(f"Reformatting '{song[2]}'..."))
-        # rename the file
-        os.rename(song[1], new_path)
-        muta = mutagen.File(new_path)
-        # set title
-        muta["TIT2"] = mutagen.id3.TIT2(encoding=3, text=["{}".format(song[2])])
-        # set artist
-        muta["TPE1"] = mutagen.id3.TPE1(encoding=3, text=["{}".format(song[3])])
-        # set album
-        muta["TALB"] = mutagen.id3.TALB(encoding=3, text=["{}".format(song[4])])
-        # set year
-        muta["TDRC"] = mutagen.id3.TDRC(encoding=3, text=["{}".format(song[7])])
-        # set genre
-        muta["TCON"] = mutagen.id3.TCON(encoding=3, text=["{}".format(song[6])])
-        muta.save()
-        log.log(Info(f"File '{song[2]}' reformatted."))
-        # update the index (song paths)
+
+def name_candidates(name: str):
+    """the file names a song named name can get, 'name.mp3', 'name (1).mp3', 'name (2).mp3', ..."""
+    yield f"{name}.mp3"
+    n = 1
+    while True:
+        yield f"{name} ({n}).mp3"
+        n += 1
+
+
+def plan_song(song):
+    """compare a song in the index with its file, returns (song, base name, tags to write) (run in a thread)"""
+    try:
+        tags = mutagen.id3.ID3(song[1])
+    except mutagen.id3.ID3NoHeaderError:
+        tags = mutagen.id3.ID3()
+
+    if song[2] is not None:
+        name = safe(song[2])
+    elif tags.get("TIT2") is not None:
+        # no song name, get from file
+        name = safe(str(tags["TIT2"]))
+    else:
+        # no title, use file name
+        name = os.path.splitext(os.path.basename(song[1]))[0]
+
+    # only the frames that differ from the index are written
+    write = {}
+    for frame, column in REFORMAT_FRAMES:
+        target = "{}".format(song[column])
+        current = tags.get(frame)
+        if current is None or [str(text) for text in current.text] != [target]:
+            write[frame] = target
+    return song, name, write
+
+
+def plan_reformat(songs: list, workers: int = None):
+    """work out what reformat() has to do to a list of songs, without changing anything
+
+    returns a list of operations, {"id", "old", "new", "tags"}, only for the songs that need to be
+    renamed or retagged. file names that collide get a number ('name (1).mp3') instead of overwriting
+    each other.
+    """
+    library = config["library"]
+    workers = workers or config["reformat_workers"]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        planned = list(pool.map(plan_song, songs))
+
+    # every path in the index is taken by its song, a rename never overwrites another song
+    c = db.cursor(library)
+    taken = {row[0] for row in c.execute("SELECT path FROM songs")}
+    renames = []
+    operations = {}
+    for song, name, write in planned:
+        # songs that already have one of their names keep it (so names are stable between runs)
+        directory, filename = os.path.split(song[1])
+        if os.path.abspath(directory) == os.path.abspath(library) and (
+            filename == f"{name}.mp3" or re.fullmatch(re.escape(name) + r" \(\d+\)\.mp3", filename)
+        ):
+            new_path = song[1]
+        else:
+            new_path = None
+            renames.append((song, name))
+        operations[song[0]] = {"id": song[0], "old": song[1], "new": new_path, "tags": write}
+
+    for song, name in renames:
+        for candidate in name_candidates(name):
+            new_path = os.path.join(library, candidate)
+            if new_path not in taken and not os.path.exists(new_path):
+                break
+        taken.add(new_path)
+        operations[song[0]]["new"] = new_path
+
+    return [op for op in operations.values() if op["old"] != op["new"] or op["tags"]]
+
+
+def write_tags(path: str, frames: dict):
+    """write ID3 text frames ({"TIT2": "title", ...}) into a file, in one pass"""
+    try:
+        tags = mutagen.id3.ID3(path)
+    except mutagen.id3.ID3NoHeaderError:
+        tags = mutagen.id3.ID3()
+    for frame, text in frames.items():
+        tags[frame] = getattr(mutagen.id3, frame)(encoding=3, text=[text])
+    tags.save(path)
+
+
+def _apply_operation(operation: dict):
+    """rename and retag one file (run in a thread), safe to run again on a half-applied operation"""
+    old, new = operation["old"], operation["new"]
+    if old != new and os.path.exists(old) and not os.path.exists(new):
+        os.rename(old, new)
+    if operation["tags"]:
+        write_tags(new, operation["tags"])
+    return operation["id"], new, file_stat(new)
+
+
+def apply_reformat(operations: list, workers: int = None):
+    """apply planned operations, through the journal so a crash halfway can be rolled forward"""
+    library = config["library"]
+    # write-ahead: the journal is on disk before the first file is touched
+    with open(REFORMAT_JOURNAL + ".tmp", "w") as f:
+        json.dump({"library": library, "operations": operations}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(REFORMAT_JOURNAL + ".tmp", REFORMAT_JOURNAL)
+
+    workers = workers or config["reformat_workers"]
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(_apply_operation, op) for op in operations]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except (OSError, mutagen.MutagenError) as e:
+                log.log(Error(f"Unable to reformat a song ({e}), skipping."))
+
+    # update the index (song paths, and the new stat so the next sync doesn't parse it again)
+    with db.transaction(library) as c:
+        c.executemany(
+            "UPDATE songs SET path = ?, size = ?, mtime_ns = ?, inode = ? WHERE id = ?",
+            ((path,) + stat + (songid,) for songid, path, stat in results),
+        )
+    os.remove(REFORMAT_JOURNAL)
+    return len(results)
+
+
+def recover_reformat():
+    """roll forward a reformat that was interrupted (if there is one)"""
+    if not os.path.exists(REFORMAT_JOURNAL):
+        return
+    try:
+        with open(REFORMAT_JOURNAL) as f:
+            journal = json.load(f)
+    except ValueError:
+        # the crash happened while writing the journal, so no file was touched yet
+        log.log(Warn("Discarding incomplete reformat journal."))
+        os.remove(REFORMAT_JOURNAL)
+        return
+    if journal["library"] != config["library"]:
+        log.log(Warn("Reformat journal is for another library, not replaying it."))
+        return
+    log.log(Info(f"Finishing interrupted reformat ({len(journal['operations'])} songs)..."))
+    apply_reformat(journal["operations"])
+
+
+def reformat(song_ids: list = None, workers: int = None):
+    """reformat audio files in the library according to the index (all of them, or only song_ids)
+
+    only the files whose name or tags differ from the index are touched.
+    """
+    library = config["library"]
+    recover_reformat()
+    if song_ids is None:
+        cleanup()  # clean up the library first (remove ghost files)
+
+    with db.transaction(library) as c:
+        None_to_null_many(song_ids, c)
+        if song_ids is None:
+            c.execute("SELECT * FROM songs")
+            songs = c.fetchall()
+        else:
+            songs = []
+            for placeholders, chunk in id_chunks(song_ids):
+                c.execute(f"SELECT * FROM songs WHERE id IN ({placeholders})", chunk)
+                songs += c.fetchall()
+
+    operations = plan_reformat(songs, workers)
+    log.log(Info(f"{len(operations)} of {len(songs)} songs need reformatting."))
+    if operations:
+        done = apply_reformat(operations, workers)
+        log.log(Info(f"{done} songs reformatted."))
+    log.log(Info("All songs reformatted."))
+
+
+# how many IDs go into one "id IN (...)" (sqlite limits the number of parameters of a query)
+ID_CHUNK_SIZE = 500
+
+
+def id_chunks(ids: list):
+    """split a list of IDs for "id IN (...)" queries, yields (placeholders, ids)"""
+    ids = list(ids)
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        chunk = ids[i : i + ID_CHUNK_SIZE]
+        yield ", ".join("?" * len(chunk)), chunk
+
+
+def None_to_null_many(song_ids: list = None, c=None):
+    """None_to_null for many songs (or all of them) at once, returns the number of songs changed"""
+    query = """
+    UPDATE songs
+    SET title = NULLIF(title, 'None'), artist = NULLIF(artist, 'None'), album = NULLIF(album, 'None'),
+        year = NULLIF(year, 'None'), genre = NULLIF(genre, 'None')
+    WHERE 'None' IN (title, artist, album, year, genre)
+    """
+    changed = 0
+    with db.transaction(config["library"], c) as c:
+        if song_ids is None:
+            c.execute(query)
+            changed = c.rowcount
+        else:
+            for placeholders, chunk in id_chunks(song_ids):
+                c.execute(query + f" AND id IN ({placeholders})", chunk)
+                changed += c.rowcount
+    return changed
+
+
+def None_to_null(songid: int, c=None):
+    """takes any strings that are None and converts them to a null value"""
+    with db.transaction(config["library"], c) as c:
+        c.execute("SELECT * FROM songs WHERE id = ?", (songid,))
+        song = c.fetchone()
+        if song is None:
+            log.log(Error(f"Song not found."))
+            print("Song not found.")
+            return
+        else:
+            log.log(Info(f"Converting NULL values to null for song '{song[2]}'..."))
+        song = list(song)
+        for index, field in enumerate(song):
+            if field == "None":
+                song[index] = None
+
+        # update the index
         c.execute(
             """
         UPDATE songs
-        SET path = ?
+        SET title = ?, artist = ?, album = ?, year = ?, genre = ?
         WHERE id = ?
         """,
-            (new_path, song[0]),
+            (song[2], song[3], song[4], song[7], song[6], songid),
         )
-        conn.commit()
-        None_to_null(song[0])
-    conn.close()
-    log.log(Info("All songs reformatted."))
+    log.log(Info(f"Song '{song[2]}' edited."))
+    print(f"Song '{song[2]}' edited.")
 
-def None_to_null(songid: int):
-    """takes any strings that are None and converts them to a null value"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM songs WHERE id = ?", (songid,))
-    song = list(c.fetchone())
-    if song is None:
-        log.log(Error(f"Song not found."))
-        print("Song not found.")
-        return
-    else:
-        log.log(Info(f"Converting NULL values to null for song '{song[2]}'..."))
-    for index, field in enumerate(song):
-        if field == "None":
-            song[index] = None
 
-    # update the index
-    c.execute(
+def cleanup(dry_run: bool = False):
+    """clean up the library, ghost files, etc.
+
+    the files on disk and the index are compared as two sets: songs in the index whose file is gone are
+    removed from it, files that are not in the index (and anything that isn't an mp3) are deleted.
+    with dry_run, nothing is changed and the report of what would be done is only printed.
+    returns the report, {"missing": [(id, path, title), ...], "untracked": [path, ...], "foreign": [path, ...]}
+    """
+    library = config["library"]
+    # one pass over the library, no open() per song or query per file
+    walk = walker.walk(library)
+    on_disk = walk.files
+    foreign = walk.others
+
+    with db.transaction(library) as c:
+        # load the paths on disk into a temp table, so both differences are a single query each
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS disk_paths (path TEXT PRIMARY KEY)")
+        c.execute("DELETE FROM temp.disk_paths")
+        c.executemany(
+            "INSERT OR IGNORE INTO temp.disk_paths (path) VALUES (?)",
+            ((path,) for path in on_disk),
+        )
+
+        # in the index, not on disk
+        c.execute(
+            """
+        SELECT id, path, title FROM songs
+        WHERE NOT EXISTS (SELECT 1 FROM temp.disk_paths WHERE disk_paths.path = songs.path)
+        ORDER BY path
         """
-    UPDATE songs
-    SET title = ?, artist = ?, album = ?, year = ?, genre = ?
-    WHERE id = ?
-    """,
-        (song[2], song[3], song[4], song[7], song[6], songid),
-    )
-    conn.commit()
-    conn.close()
-    log.log(Info(f"Song '{song[2]}' edited."))
-    print(f"Song '{song[2]}' edited.")
+        )
+        missing = c.fetchall()
+        # on disk, not in the index (uses the songs_path index)
+        c.execute(
+            """
+        SELECT path FROM temp.disk_paths
+        WHERE NOT EXISTS (SELECT 1 FROM songs WHERE songs.path = disk_paths.path)
+        ORDER BY path
+        """
+        )
+        untracked = [row[0] for row in c.fetchall()]
 
+        if not dry_run and missing:
+            # playlist entries go with them (ON DELETE CASCADE)
+            c.execute(
+                "DELETE FROM songs WHERE NOT EXISTS (SELECT 1 FROM temp.disk_paths WHERE disk_paths.path = songs.path)"
+            )
+        c.execute("DELETE FROM temp.disk_paths")
+
+    report = {"missing": missing, "untracked": untracked, "foreign": sorted(foreign)}
 
-def cleanup():
-    """clean up the library, ghost files, etc."""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM songs")
-    songs = c.fetchall()
+    if dry_run:
+        print("Dry run, nothing will be changed.")
+        for song in missing:
+            print(f"Would remove '{song[2]}' from the index (file '{song[1]}' not found)")
+        for path in untracked:
+            print(f"Would delete '{path}' (not in index)")
+        for path in report["foreign"]:
+            print(f"Would delete '{path}' (not an mp3 or database file)")
+        print(
+            f"{len(missing)} missing, {len(untracked)} untracked, {len(foreign)} other files."
+        )
+        return report
 
-    for song in songs:
+    for song in missing:
+        log.log(Warn(f"File '{song[2]}' not found, removed from index."))
+    # the index is committed first, deleting files can't be rolled back anyway
+    for path in untracked:
+        log.log(Warn(f"File '{path}' not in index, removing."))
         try:
-            with open(song[1], "rb") as f:
-                pass
+            os.remove(path)
         except FileNotFoundError:
-            log.log(Warn(f"File '{song[2]}' not found, removing from index."))
-            c.execute("DELETE FROM songs WHERE id = ?", (song[0],))
-
-    # remove any files that are not in the index
-    for root, _, files in os.walk(config["library"]):
-        for file in files:
-            if file.endswith(".mp3"):
-                path = os.path.join(root, file)
-                c.execute("SELECT * FROM songs WHERE path = ?", (path,))
-                if c.fetchone() is None:
-                    log.log(Warn(f"File '{path}' not in index, removing."))
-                    os.remove(path)
-            elif not file.endswith(".db"):
-                log.log(Warn(f"File '{file}' not an mp3 or database file, removing."))
-                os.remove(os.path.join(root, file))
-
-    conn.commit()
-    conn.close()
-    log.log(Info("Library cleaned up."))
+            pass
+    for path in report["foreign"]:
+        log.log(Warn(f"File '{path}' not an mp3 or database file, removing."))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    log.log(
+        Info(
+            f"Library cleaned up ({len(missing)} missing, {len(untracked)} untracked, {len(foreign)} other files)."
+        )
+    )
+    return report
 
 
 def edit_tags(id: int):
     """edit the tags of a song"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
+    c = db.cursor(config["library"])
     c.execute("SELECT * FROM songs WHERE id = ?", (id,))
     song = c.fetchone()
     if song is None:
@@ -421,143 +1397,160 @@ def edit_tags(id: int):
         )
     )
     # update the index
-    c.execute(
-        """
-    UPDATE songs
-    SET title = ?, artist = ?, album = ?, year = ?, genre = ?
-    WHERE id = ?
-    """,
-        (new_title, new_artist, new_album, new_year, new_genre, id),
-    )
-    conn.commit()
-    conn.close()
+    with db.transaction(config["library"]) as c:
+        c.execute(
+            """
+        UPDATE songs
+        SET title = ?, artist = ?, album = ?, year = ?, genre = ?
+        WHERE id = ?
+        """,
+            (new_title, new_artist, new_album, new_year, new_genre, id),
+        )
     log.log(Info(f"Song '{song[2]}' edited."))
     print(f"Song '{song[2]}' edited.")
-    reformat()  # reformat the library to apply changes
+    reformat([id])  # reformat the song to apply changes
 
 
-def create_playlist(name: str, songs: list):
+def create_playlist(name: str, songs: list, c=None):
     """create a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM playlists WHERE name = ?", (name,))
-    if c.fetchone() is not None:
-        log.log(Warn(f"Playlist '{name}' already exists."))
-        print(f"Playlist '{name}' already exists.")
-        return
-    c.execute("INSERT INTO playlists (name) VALUES (?)", (name,))
-    conn.commit()
-    c.execute("SELECT * FROM playlists WHERE name = ?", (name,))
-    playlist_id = c.fetchone()[0]
-    for song in songs:
-        c.execute(
-            "INSERT INTO playlist_songs (playlist_id, song_id) VALUES (?, ?)",
-            (playlist_id, song[0]),
-        )
-        conn.commit()
-    conn.close()
+    with db.transaction(config["library"], c) as c:
+        c.execute("SELECT * FROM playlists WHERE name = ?", (name,))
+        if c.fetchone() is not None:
+            log.log(Warn(f"Playlist '{name}' already exists."))
+            print(f"Playlist '{name}' already exists.")
+            return
+        c.execute("INSERT INTO playlists (name) VALUES (?)", (name,))
+        add_many_to_playlist((c.lastrowid, name), [song[0] for song in songs], c)
     log.log(Info(f"Playlist '{name}' created."))
 
 
-def delete_playlist(playlist: tuple):
+def delete_playlist(playlist: tuple, c=None):
     """delete a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("DELETE FROM playlists WHERE id = ?", (playlist[0],))
-    conn.commit()
-    # delete all songs in the playlist
-    c.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (playlist[0],))
-    conn.close()
+    with db.transaction(config["library"], c) as c:
+        c.execute("DELETE FROM playlists WHERE id = ?", (playlist[0],))
+        # delete all songs in the playlist
+        c.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (playlist[0],))
     log.log(Info(f"Playlist '{playlist[1]}' deleted."))
 
 
 def list_playlists():
     """list all playlists"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
+    c = db.cursor(config["library"])
     c.execute("SELECT * FROM playlists")
     playlists = c.fetchall()
-    conn.close()
     return playlists
 
 
 def list_playlist(playlist: tuple):
     """list all songs in a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM playlist_songs WHERE playlist_id = ?", (playlist[0],))
-    songs = c.fetchall()
-    song_data = []
-    for song in songs:
-        c.execute("SELECT * FROM songs WHERE id = ?", (song[1],))
-        song_info = c.fetchone()
-        song_data.append(song_info)
-    conn.close()
-    return song_data
-
-
-def add_to_playlist(playlist: tuple, song: tuple):
-    """add a song to a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
+    c = db.cursor(config["library"])
     c.execute(
-        "INSERT INTO playlist_songs (playlist_id, song_id) VALUES (?, ?)",
-        (playlist[0], song[0]),
+        "SELECT songs.* FROM playlist_songs JOIN songs ON songs.id = playlist_songs.song_id WHERE playlist_songs.playlist_id = ? ORDER BY playlist_songs.rowid",
+        (playlist[0],),
     )
-    conn.commit()
-    conn.close()
+    return c.fetchall()
+
+
+def add_to_playlist(playlist: tuple, song: tuple, c=None):
+    """add a song to a playlist"""
+    add_many_to_playlist(playlist, [song[0]], c)
     log.log(Info(f"Song '{song}' added to playlist '{playlist[1]}'."))
 
 
-def remove_from_playlist(playlist: tuple, song: tuple):
+def add_many_to_playlist(playlist: tuple, song_ids: list, c=None):
+    """add songs (by ID) to the end of a playlist, in order and in one transaction"""
+    with db.transaction(config["library"], c) as c:
+        c.executemany(
+            "INSERT INTO playlist_songs (playlist_id, song_id) VALUES (?, ?)",
+            [(playlist[0], song_id) for song_id in song_ids],
+        )
+    log.log(Info(f"{len(song_ids)} songs added to playlist '{playlist[1]}'."))
+    return len(song_ids)
+
+
+def remove_from_playlist(playlist: tuple, song: tuple, c=None):
     """remove a song from a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute(
-        "DELETE FROM playlist_songs WHERE playlist_id = ? AND song_id = ?",
-        (playlist[0], song[0]),
-    )
-    conn.commit()
-    conn.close()
+    remove_many_from_playlist(playlist, [song[0]], c)
     log.log(Info(f"Song '{song}' removed from playlist '{playlist[1]}'."))
 
 
-def edit_playlist_name(playlist: tuple, new_name: str):
+def remove_many_from_playlist(playlist: tuple, song_ids: list, c=None):
+    """remove songs (by ID) from a playlist in one transaction, returns the number of entries removed"""
+    with db.transaction(config["library"], c) as c:
+        c.executemany(
+            "DELETE FROM playlist_songs WHERE playlist_id = ? AND song_id = ?",
+            [(playlist[0], song_id) for song_id in song_ids],
+        )
+        removed = c.rowcount
+    log.log(Info(f"{removed} songs removed from playlist '{playlist[1]}'."))
+    return removed
+
+
+def edit_playlist_name(playlist: tuple, new_name: str, c=None):
     """edit a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("UPDATE playlists SET name = ? WHERE id = ?", (new_name, playlist[0]))
-    conn.commit()
-    conn.close()
+    with db.transaction(config["library"], c) as c:
+        c.execute("UPDATE playlists SET name = ? WHERE id = ?", (new_name, playlist[0]))
     log.log(Info(f"Playlist '{playlist[1]}' edited to '{new_name}'."))
 
 
+def get_songs(song_ids: list, c=None):
+    """get songs by their IDs with one query, in the order of song_ids
+
+    IDs can repeat (a queue can have a song twice), IDs of songs that no longer exist are left out.
+    """
+    c = c or db.cursor(config["library"])
+    # the IDs go into a temp table (any number of them, in order), then it's one join
+    c.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS wanted_songs (position INTEGER PRIMARY KEY, song_id INTEGER)"
+    )
+    # a plain (deferred) transaction, only the temp table is written so the index isn't locked
+    own = not c.connection.in_transaction
+    if own:
+        c.execute("BEGIN")
+    try:
+        c.execute("DELETE FROM temp.wanted_songs")
+        c.executemany(
+            "INSERT INTO temp.wanted_songs (song_id) VALUES (?)", ((song_id,) for song_id in song_ids)
+        )
+        c.execute(
+            "SELECT songs.* FROM temp.wanted_songs JOIN songs ON songs.id = wanted_songs.song_id ORDER BY wanted_songs.position"
+        )
+        songs = c.fetchall()
+        c.execute("DELETE FROM temp.wanted_songs")
+    finally:
+        if own:
+            c.execute("COMMIT")
+    return songs
+
+
+def get_gain(song_id: int):
+    """get the gain (dB) that normalizes a song's loudness (None if it wasn't analyzed)"""
+    row = db.cursor(config["library"]).execute(
+        "SELECT gain_db FROM songs WHERE id = ?", (song_id,)
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
 def get_playlist_contents(playlist: tuple):
     """get the contents of a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
+    c = db.cursor(config["library"])
     if playlist is None:
         log.log(Warn(f"Playlist not found."))
         print(f"Playlist not found.")
         return
-    c.execute("SELECT * FROM playlist_songs WHERE playlist_id = ?", (playlist[0],))
-    songs = c.fetchall()
-    song_data = []
-    for song in songs:
-        c.execute("SELECT * FROM songs WHERE id = ?", (song[1],))
-        song_info = c.fetchone()
-        song_data.append(song_info)
-    conn.close()
-    return song_data
+    # one query, in playlist order
+    c.execute(
+        "SELECT songs.* FROM playlist_songs JOIN songs ON songs.id = playlist_songs.song_id WHERE playlist_songs.playlist_id = ? ORDER BY playlist_songs.rowid",
+        (playlist[0],),
+    )
+    return c.fetchall()
 
 
 def search_playlist(name: str):
     """search for the data of a playlist"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
+    c = db.cursor(config["library"])
     c.execute("SELECT * FROM playlists WHERE name LIKE ?", (name,))
     playlist = c.fetchall()
-    conn.close()
     # if multiple playlists, ask the user to choose
     if len(playlist) > 1:
         playlists = []
@@ -570,8 +1563,8 @@ def search_playlist(name: str):
                 choices=playlists,
             )
         ]
-        playlist = inquirer.prompt(inquirer_questions)["playlist"]
-        return playlist
+        choice = inquirer.prompt(inquirer_questions)["playlist"]
+        return next(p for p in playlist if p[1] == choice)
     elif len(playlist) == 0:
         log.log(Warn(f"Playlist '{name}' not found."))
         print(f"Playlist '{name}' not found.")
@@ -580,20 +1573,30 @@ def search_playlist(name: str):
         return playlist[0]
 
 
-def delete_song(song):
+def delete_song(song, c=None):
     """delete a song from the cmusic library"""
-    conn = sqlite3.connect(os.path.join(config["library"], "index.db"))
-    c = conn.cursor()
-    c.execute("SELECT * FROM songs WHERE id = ?", (song[0],))
-    song = c.fetchone()
-    if song is None:
+    if not delete_songs([song[0]], c):
         log.log(Error(f"Song not found."))
         print("Song not found.")
-        return
-    else:
+
+
+def delete_songs(song_ids: list, c=None):
+    """delete songs (by ID) from the cmusic library, index and files, returns the songs deleted
+
+    the index is changed in one transaction, the files are removed once it's committed.
+    """
+    deleted = []
+    with db.transaction(config["library"], c) as c:
+        for placeholders, chunk in id_chunks(song_ids):
+            c.execute(f"SELECT * FROM songs WHERE id IN ({placeholders})", chunk)
+            deleted += c.fetchall()
+        # playlist entries go with them (ON DELETE CASCADE)
+        c.executemany("DELETE FROM songs WHERE id = ?", [(song[0],) for song in deleted])
+    for song in deleted:
         log.log(Info(f"Deleting song '{song[2]}'..."))
-    c.execute("DELETE FROM songs WHERE id = ?", (song[0],))
-    conn.commit()
-    os.remove(song[1])
-    conn.close()
-    log.log(Info(f"Song '{song[2]}' deleted."))
\ No newline at end of file
+        try:
+            os.remove(song[1])
+        except FileNotFoundError:
+            log.log(Warn(f"File '{song[1]}' was already gone."))
+        log.log(Info(f"Song '{song[2]}' deleted."))
+    return deleted
\ No newline at end of file
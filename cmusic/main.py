@@ -10,22 +10,28 @@ extra = "Stable"
 # make sure to add any new commands to the case statement in the main function.
 
 import os
+import sys
+import time
+import re
+import glob
 import subprocess
 
 # local package imports
 from . import indexlib
-from . import bg_threads
-from .constants import MAIN, config, CONFIG_FILE, LIBRARY, QUEUE_FILE
+from . import importer
+from . import contenthash
+from . import watcher
+from . import query
+from . import player
+from . import daemon
+from .constants import MAIN, config, write_config, LIBRARY
 
-import math
 import random
 import json
 
 from objlog.LogMessages import Debug, Info, Warn, Error, Fatal
 
 import inquirer
-import pygame
-from tinytag import TinyTag
 
 
 def main(args: dict):
@@ -35,172 +41,151 @@ def main(args: dict):
         raise Exception("Manual Crash Triggered.")
 
     indexlib.init_index(LIBRARY)
+    # finish a reformat that crashed halfway
+    indexlib.recover_reformat()
+
+    if args["cleanup"]:
+        # reconcile the index with the library
+        indexlib.cleanup(dry_run=args["dry_run"])
 
     if args["reformat"]:
         # reformat the library
         indexlib.reformat()
 
     if args["reindex"]:
-        indexlib.index_library(config["library"])
+        indexlib.index_library(
+            config["library"], workers=args["workers"], batch_size=args["batch_size"]
+        )
+    elif args["sync"]:
+        indexlib.sync_library(
+            config["library"], workers=args["workers"], batch_size=args["batch_size"]
+        )
 
     match args["command"]:
         case "play":
-
-            # check if the background process is running
-            if not args["_background_process"]:
-                MAIN.log(
-                    Info(
-                        "This is a direct call to play a song, creating a new tmux session."
-                    )
-                )
-                # activate tmux session (same command as this one, but with the _background_process flag and no
-                # --background flag)
-                args["_background_process"] = True
-                background = args["background"]
-                args["background"] = False
-                # load tmux session
-
-                # get all flags from the args dict
-                flags = [f"--{flag}" for flag in args if args[flag] is True]
-                # get all args from the args dict
-                args = [args["command"]] + [
-                    arg for arg in args["args"] if "--" + arg not in flags
-                ]
-
-                MAIN.log(Debug(f"args: {args}"))
-                MAIN.log(Debug(f"flags: {flags}"))
-
-                constructed_command = (
-                        ["tmux", "new-session", "-d", "-s", "cmusic_background", "cmusic"]
-                        + args
-                        + flags
-                )
-
-                MAIN.log(Debug(f"Running command: {constructed_command}"))
-
-                tmux = subprocess.run(constructed_command, stderr=subprocess.PIPE)
-                if tmux.returncode != 0:
-                    MAIN.log(Error("Failed to start background process."))
-                    MAIN.log(Error(tmux.stderr.decode("utf-8")))
-                    print(
-                        f"Failed to Initiate song playback. ({tmux.stderr.decode('utf-8')})"
-                    )
-                    exit(0)
-                subprocess.run(
-                    ["tmux", "detach", "-t", "cmusic_background"],
-                    stderr=subprocess.PIPE,
-                )
-
-                if not background:
-                    MAIN.log(Info("Pulling session to foreground."))
-                    pull_session("cmusic_background")
-                MAIN.log(Info("Background process started, peace out."))
+            if args["_background_process"]:
+                # this is the player itself (inside tmux), it plays the queue and listens for commands
+                MAIN.log(Info("Starting cMusic (for real this time)"))
+                if args["_crash"]:
+                    raise Exception("Manual Crash Triggered.")
+                try:
+                    player.run(args["loop"], args["shuffle"])
+                except (
+                        KeyboardInterrupt
+                ):  # catch the KeyboardInterrupt so the program can exit
+                    MAIN.log(Info("User shutdown Program"))
+                    print("User shutdown Program")
                 exit(0)
-            MAIN.log(Info("Starting cMusic (for real this time)"))
-            if args["_crash"]:
-                raise Exception("Manual Crash Triggered.")
 
-            # check if --playlist was provided
+            # the songs are found here (so any questions are asked in this terminal), the player gets their IDs
             if args["playlist"]:
-                # change song args to the playlist contents
+                # the playlist's songs, by ID (one query, no searching for their titles again)
                 playlist = indexlib.search_playlist(args["args"][0])
                 if playlist is None:
                     MAIN.log(Warn(f"Playlist '{args['args'][0]}' not found."))
                     print(f"Playlist '{args['args'][0]}' not found.")
                     exit(1)
                 songs = indexlib.get_playlist_contents(playlist)
-                if songs is None:
+                if not songs:
                     MAIN.log(Warn(f"Playlist '{args['args'][0]}' is empty."))
                     print(f"Playlist '{args['args'][0]}' is empty.")
                     exit(1)
-                MAIN.log(Info(f"Playlist '{args['args'][0]}' found, playing songs."))
-                args["args"] = [song[2] for song in songs]
-
-            # convert the song names to paths & data (tuple)
-            songs = [scan_library(song) for song in args["args"] if song is not None]
-            # remove any None values from the list
-            songs = [song for song in songs if song is not None]
-            # find any lists in the song list and add them to the song list
-            for song in songs:
-                if isinstance(song, list):
-                    songs += song
-                    songs.remove(song)
-            songs = [list(song) for song in songs]
+                MAIN.log(Info(f"Playlist '{args['args'][0]}' found, playing {len(songs)} songs."))
+            else:
+                # convert the song names to paths & data (tuple)
+                songs = flatten_songs([scan_library(song) for song in args["args"] if song is not None])
 
             if args["shuffle"]:
                 random.shuffle(songs)
 
-            # play the songs
             if not songs:
                 MAIN.log(Warn("No songs found to play."))
-                os.system("clear")
                 print("No songs found to play.")
-                input("Press enter to continue.")
-            else:
-                # load songs into queue
-                with open(QUEUE_FILE, "w+") as f:
-                    MAIN.log(Debug(songs))
-                    json.dump(songs, f)
-                try:
-                    # TODO: make more readable
-                    while True:  # we want to loop through the songs indefinitely (unless loop is set to False)
-                        with open(QUEUE_FILE) as f:
-                            songs = json.load(f)
-                            MAIN.log(Debug(songs))
-                        for song in songs:
-                            play(song[1], song, args["loop"], args["shuffle"], config)
-                            if not args["loop"]:
-                                songs.remove(song)
-                            with open(QUEUE_FILE) as f:
-                                new = json.load(f)
-                                for stored in new:
-                                    if stored == song:
-                                        new.remove(stored)
-                                        # if loop is on, add the song back to the queue at the end
-                                        if args["loop"]:
-                                            new.append(song)
-                                with open(QUEUE_FILE, "w") as f:
-                                    json.dump(new, f)
-                                break
-
-                        if not args["loop"] and len(new) <= 0:
-                            break
-                except (
-                        KeyboardInterrupt
-                ):  # catch the KeyboardInterrupt so the program can exit
-                    MAIN.log(Info("User shutdown Program"))
-                    print("User shutdown Program")
-                    exit(0)
-
-        case "index":
-            # add a file to the library
-            for song_file in args["args"]:
-                if os.path.exists(song_file) and song_file.endswith(".mp3"):
-                    indexlib.index(song_file)
+                exit(1)
 
-        case "version":
-            print(f"cMusic v{__version__} {extra}")
+            ids = [song[0] for song in songs]
+            try:
+                # a player is already running, it just gets a new queue
+                daemon.request("play", ids=ids)
+                MAIN.log(Info(f"Sent {len(ids)} songs to the running player."))
+                print(f"Playing {player.describe(songs[0])}" + (f" (+{len(ids) - 1} more)" if len(ids) > 1 else ""))
+                exit(0)
+            except daemon.PlayerNotRunning:
+                pass
 
-        case "list":
-            # list all songs in the library (through the index)
-            songs = indexlib.search_index(config["library"], "")
-            for song in songs:
-                print(
-                    f"{song[2]} by {song[3]} {f'({song[4]})' if song[4] not in [None, 'None'] else ''}"
-                )
-        case "search":
-            # search for a song in the library
-            songs = indexlib.search_index(config["library"], args["args"][0])
-            MAIN.log(Info(f"Found {len(songs)} songs."))
+            # load songs into queue, the player starts with them
+            player.save_queue(ids)
             MAIN.log(
-                Debug(
-                    f"Songs IDs: {', '.join([str(song[0]) for song in songs]).strip()}"
+                Info(
+                    "This is a direct call to play a song, creating a new tmux session."
                 )
             )
-            for song in songs:
+            # start the player in a tmux session (same command, but with the _background_process flag, no
+            # --background flag and no songs, they're in the queue), tmux is only there to show its interface
+            flags = ["--_background_process"] + [
+                f"--{flag}" for flag in ("loop", "shuffle") if args[flag]
+            ]
+            constructed_command = (
+                    ["tmux", "new-session", "-d", "-s", "cmusic_background", "cmusic", "play"]
+                    + flags
+            )
+
+            MAIN.log(Debug(f"Running command: {constructed_command}"))
+
+            tmux = subprocess.run(constructed_command, stderr=subprocess.PIPE)
+            if tmux.returncode != 0:
+                MAIN.log(Error("Failed to start background process."))
+                MAIN.log(Error(tmux.stderr.decode("utf-8")))
                 print(
-                    f"{song[2]} by {song[3]} {f'({song[4]})' if song[4] not in [None, 'None'] else ''}"
+                    f"Failed to Initiate song playback. ({tmux.stderr.decode('utf-8')})"
+                )
+                exit(0)
+
+            if not args["background"]:
+                MAIN.log(Info("Pulling session to foreground."))
+                pull_session("cmusic_background")
+            MAIN.log(Info("Background process started, peace out."))
+            exit(0)
+
+        case "index":
+            # directories, glob patterns (or --batch) import everything without asking anything
+            if args["batch"] or any(
+                os.path.isdir(source) or glob.has_magic(source) for source in args["args"]
+            ):
+                importer.import_songs(
+                    args["args"], workers=args["workers"], batch_size=args["batch_size"]
                 )
+            else:
+                # add a file to the library
+                for song_file in args["args"]:
+                    if os.path.exists(song_file) and song_file.endswith(".mp3"):
+                        indexlib.index(song_file)
+
+        case "version":
+            print(f"cMusic v{__version__} {extra}")
+
+        case "list" | "search":
+            # list all songs in the library (through the index), or search for songs in it.
+            # songs are printed as they're read from the index, so big libraries start printing right away
+            try:
+                indexlib.order_by(args["sort"])
+            except ValueError as e:
+                print(e)
+                return
+            page = {"limit": args["limit"], "offset": args["offset"], "sort": args["sort"]}
+            if args["command"] == "list":
+                # list takes a query (optionally), so it's everything after the command
+                term = " ".join(args["args"])
+            else:
+                term = args["args"][0]
+            if term and (args["command"] == "list" or query.is_query(term)):
+                songs = run_query(term, **page)
+                if songs is None:
+                    return
+            else:
+                songs = indexlib.search_index(config["library"], term, **page)
+            count = print_songs(songs, args["format"])
+            MAIN.log(Info(f"Printed {count} songs."))
 
         case "c":
             try:
@@ -210,18 +195,11 @@ def main(args: dict):
                 print("Background process not found, is it running?")
 
         case "p":
-            # toggle the background process
-            # check if the background process is running
-            tmux_check = subprocess.run(
-                ["tmux", "has-session", "-t", "cmusic_background"],
-                stdout=subprocess.PIPE,
-            )
-            if tmux_check.returncode == 0:
-                # session exists, send space to the session
-                subprocess.run(
-                    ["tmux", "send-keys", "-t", "cmusic_background", " ", "C-m"]
-                )
-            else:
+            # pause/unpause the player
+            try:
+                status = daemon.request("pause")
+                print("Paused." if status["paused"] else "Playing.")
+            except daemon.PlayerNotRunning:
                 print("Background process not found, is it running?")
 
         case "v":
@@ -234,10 +212,13 @@ def main(args: dict):
                 elif volume < 0:
                     volume = 0
                     MAIN.log(Warn("Volume must be between 0 and 100, correcting."))
-                with open(CONFIG_FILE, "w") as f:
+                try:
+                    # the player saves it to the config file too
+                    daemon.request("volume", volume=volume)
+                except daemon.PlayerNotRunning:
                     config["volume"] = volume
-                    f.write(json.dumps(config, indent=4))
-                    MAIN.log(Info(f"Volume set to {volume}"))
+                    write_config(config)
+                MAIN.log(Info(f"Volume set to {volume}"))
             except ValueError:
                 MAIN.log(Warn("Volume must be an integer."))
                 print("Volume must be an integer.")
@@ -247,15 +228,83 @@ def main(args: dict):
 
         case "q":
             # quit the background process
-            status = subprocess.run(
-                ["tmux", "kill-session", "-t", "cmusic_background"],
-                stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-            )
-            if status.returncode != 0:
+            try:
+                daemon.request("quit")
+            except daemon.PlayerNotRunning:
                 MAIN.log(Warn("Background process not found."))
                 print("Background process not found.")
 
+        case "status":
+            # what the player is doing
+            try:
+                status = daemon.request("status")
+            except daemon.PlayerNotRunning:
+                print("Background process not found, is it running?")
+                return
+            song = status["song"]
+            if song is None:
+                print(f"Nothing playing, volume {status['volume']}%.")
+            else:
+                print(
+                    f"{'Paused' if status['paused'] else 'Playing'}: {song['title']} by {song['artist']} "
+                    f"{format_time(status['position'])} / {format_time(status['duration'])}, "
+                    f"volume {status['volume']}%, {status['queue'] - 1} more in the queue."
+                )
+
+        case "skip":
+            # skip the current song
+            try:
+                daemon.request("skip")
+            except daemon.PlayerNotRunning:
+                print("Background process not found, is it running?")
+            except RuntimeError as e:
+                print(e)
+
+        case "seek":
+            # jump to a position in the current song (seconds or m:ss)
+            try:
+                position = args["args"][0]
+                if ":" in position:
+                    minutes, seconds = position.split(":", 1)
+                    position = int(minutes) * 60 + float(seconds)
+                daemon.request("seek", position=float(position))
+            except (IndexError, ValueError):
+                print("Usage: cmusic seek <seconds or m:ss>")
+            except daemon.PlayerNotRunning:
+                print("Background process not found, is it running?")
+            except RuntimeError as e:
+                print(e)
+
+        case "eq":
+            # show the equalizer presets, pick one, or save a new one (the player picks it up from the config)
+            presets = config["eq_presets"]
+            if not args["args"]:
+                print("   " + " ".join(f"{band:>4}" for band in EQ_BAND_LABELS))
+                for name, gains in presets.items():
+                    marker = "*" if name == config["eq_preset"] else " "
+                    print(f"{marker}  " + " ".join(f"{gain:>+4g}" for gain in gains) + f"  {name}")
+                return
+            name = args["args"][0]
+            if len(args["args"]) > 1:
+                try:
+                    gains = [float(gain) for gain in args["args"][1:]]
+                except ValueError:
+                    gains = []
+                if len(gains) != len(EQ_BAND_LABELS):
+                    print(f"Usage: cmusic eq <name> <{len(EQ_BAND_LABELS)} gains in dB, {EQ_BAND_LABELS[0]}Hz to {EQ_BAND_LABELS[-1]}Hz>")
+                    return
+                presets[name] = gains
+                MAIN.log(Info(f"Saved equalizer preset '{name}': {gains}"))
+            elif name not in presets:
+                print(f"Unknown equalizer preset '{name}' (cmusic eq lists them).")
+                return
+            config["eq_preset"] = name
+            write_config(config)
+            MAIN.log(Info(f"Equalizer preset set to '{name}'"))
+            print(f"Equalizer preset set to '{name}'.")
+            if config["player_backend"] != "numpy":
+                print('The equalizer only works with the numpy backend (set player_backend to "numpy" in the config).')
+
         case "edit":
             # edit the song's tags
             song = scan_library(args["args"][0])
@@ -318,14 +367,7 @@ def main(args: dict):
                     playlist_name = args["args"][1]
                     songs = args["args"][2:]
                     # get the songs from the library
-                    songs = [scan_library(song) for song in songs]
-                    # find any lists in the song list and add them to the song list
-                    for song in songs:
-                        if isinstance(song, list):
-                            songs += song
-                            songs.remove(song)
-                    # remove any None values from the list
-                    songs = [song for song in songs if song is not None]
+                    songs = flatten_songs([scan_library(song) for song in songs])
                     # create the playlist
                     indexlib.create_playlist(playlist_name, songs)
                     MAIN.log(Info(f"Playlist '{playlist_name}' created."))
@@ -363,18 +405,14 @@ def main(args: dict):
                     # remove a song from a playlist
                     try:
                         playlist_name = args["args"][1]
-                        song_name = args["args"][2]
+                        if len(args["args"]) < 3:
+                            # no song to remove
+                            raise IndexError
                         playlist = indexlib.search_playlist(playlist_name)
-                        songs = [scan_library(song_name) for song in args["args"][2:]]
-                        # add any lists to the songs list
-                        for song in songs:
-                            if isinstance(song, list):
-                                songs += song
-                                songs.remove(song)
-                        # remove any None values from the list
-                        songs = [tuple(song) for song in songs if song is not None]
-                        for song in songs:
-                            indexlib.remove_from_playlist(playlist, song)
+                        songs = flatten_songs([scan_library(song) for song in args["args"][2:]])
+                        # all of them in one transaction
+                        removed = indexlib.remove_many_from_playlist(playlist, [song[0] for song in songs])
+                        print(f"Removed {removed} songs from '{playlist[1]}'.")
                     except IndexError:
                         MAIN.log(Warn("Playlist and song name must be provided."))
                         print("Playlist and song name must be provided.")
@@ -383,17 +421,11 @@ def main(args: dict):
                     # add a song to a playlist
                     try:
                         playlist_name = args["args"][1]
-                        songs = [scan_library(song) for song in args["args"][2:]]
-                        # add any lists to the songs list
-                        for song in songs:
-                            if isinstance(song, list):
-                                songs += song
-                                songs.remove(song)
-                        # remove any None values from the list
-                        songs = [tuple(song) for song in songs if song is not None]
+                        songs = flatten_songs([scan_library(song) for song in args["args"][2:]])
                         playlist = indexlib.search_playlist(playlist_name)
-                        for song in songs:
-                            indexlib.add_to_playlist(playlist, song)
+                        # all of them in one transaction
+                        added = indexlib.add_many_to_playlist(playlist, [song[0] for song in songs])
+                        print(f"Added {added} songs to '{playlist[1]}'.")
                     except IndexError:
                         MAIN.log(Warn("Playlist and song name must be provided."))
                         print("Playlist and song name must be provided.")
@@ -410,20 +442,11 @@ def main(args: dict):
                         return
         case "queue":
             # queue a song to play after
-            songs = [scan_library(song) for song in args["args"]]
-            songs = [song for song in songs if song is not None]
-            for song in songs:
-
-                if isinstance(song, list):
-                    songs += song
-                    songs.remove(song)
-            songs = [list(song) for song in songs]
-            with open(QUEUE_FILE, "r") as f:
-                current = json.load(f)
-            with open(QUEUE_FILE, "w") as f:
-                for song in songs:
-                    current.append(song)
-                json.dump(current, f)
+            songs = flatten_songs([scan_library(song) for song in args["args"]])
+            try:
+                daemon.request("enqueue", ids=[song[0] for song in songs])
+            except daemon.PlayerNotRunning:
+                player.save_queue(player.load_queue() + [song[0] for song in songs])
             MAIN.log(Info(f"Queued {len(songs)} songs."))
             for song in songs:
                 print(
@@ -452,8 +475,8 @@ def main(args: dict):
                 are_you_sure = input("y/n: ")
                 if are_you_sure.lower() == "y":
                     MAIN.log(Info("Multiple songs found, deleting all."))
-                    for s in song:
-                        indexlib.delete_song(s)
+                    deleted = indexlib.delete_songs([s[0] for s in song])
+                    print(f"Deleted {len(deleted)} songs.")
                 else:
                     print("Aborted.")
                     return
@@ -466,6 +489,118 @@ def main(args: dict):
                     MAIN.log(Info("Deleting song."))
                     indexlib.delete_song(song)
 
+        case "watch":
+            # keep the index in sync with the library until stopped
+            watcher.watch(config["library"])
+
+        case "dedupe":
+            # list the songs that are in the library more than once (same audio)
+            contenthash.dedupe_report(config["library"], workers=args["workers"])
+
+        case "analyze":
+            # measure the loudness of the songs that weren't (or changed since), the gains are used by the numpy backend
+            try:
+                from . import analysis
+            except ImportError as e:
+                MAIN.log(Error(f"Loudness analysis needs numpy ({e}), install cmusic[dsp]."))
+                print("Loudness analysis needs numpy, install cmusic[dsp].")
+                return
+            try:
+                analysis.analyze(config["library"], workers=args["workers"], idle=args["idle"])
+            except KeyboardInterrupt:
+                # what was analyzed is kept, analyze said how to resume
+                pass
+
+
+def flatten_songs(results: list):
+    """flatten what scan_library returned for several names (songs, lists of songs and Nones) into a list of songs"""
+    songs = []
+    for result in results:
+        if isinstance(result, list):
+            songs += [tuple(song) for song in result]
+        elif result is not None:
+            songs.append(tuple(result))
+    return songs
+
+
+def format_time(seconds):
+    """format seconds as m:ss"""
+    seconds = int(seconds or 0)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def run_query(text, limit=None, offset=0, sort=None):
+    """run a search query (see query.py), returns the songs it matches (None if it's invalid)"""
+    try:
+        return query.search(config["library"], text, limit=limit, offset=offset, sort=sort)
+    except query.QueryError as e:
+        MAIN.log(Warn(f"Invalid query '{text}' ({e})."))
+        print(f"Invalid query '{text}': {e}")
+        return None
+
+
+# the equalizer's bands (Hz), as cmusic eq shows them
+EQ_BAND_LABELS = ("31", "62", "125", "250", "500", "1k", "2k", "4k", "8k", "16k")
+
+# columns of the machine readable output formats, (name, index in a songs row)
+OUTPUT_COLUMNS = (
+    ("id", 0),
+    ("title", 2),
+    ("artist", 3),
+    ("album", 4),
+    ("year", 7),
+    ("genre", 6),
+    ("duration", 5),
+    ("path", 1),
+)
+
+# lines printed at a time by print_songs
+OUTPUT_CHUNK = 500
+
+
+def format_song(song, output_format):
+    """format a song as a line of output (text, jsonl, tsv or ids)"""
+    match output_format:
+        case "ids":
+            return f"{song[0]}\n"
+        case "jsonl":
+            return json.dumps({name: song[index] for name, index in OUTPUT_COLUMNS}) + "\n"
+        case "tsv":
+            # tabs and newlines in tags would break the columns
+            return "\t".join(
+                "" if song[index] is None else re.sub(r"[\t\r\n]", " ", str(song[index]))
+                for _, index in OUTPUT_COLUMNS
+            ) + "\n"
+        case _:
+            return f"{song[2]} by {song[3]} {f'({song[4]})' if song[4] not in [None, 'None'] else ''}\n"
+
+
+def print_songs(songs, output_format="text"):
+    """print songs as they come in (flushed in chunks), returns how many were printed
+
+    stops quietly when whatever reads the output goes away (| head).
+    """
+    count = 0
+    chunk = []
+    # the first song is printed right away
+    last_flush = 0
+    try:
+        for song in songs:
+            chunk.append(format_song(song, output_format))
+            count += 1
+            if len(chunk) >= OUTPUT_CHUNK or time.monotonic() - last_flush > 0.1:
+                sys.stdout.write("".join(chunk))
+                sys.stdout.flush()
+                chunk.clear()
+                last_flush = time.monotonic()
+        sys.stdout.write("".join(chunk))
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # python flushes stdout again on exit, which would fail the same way, so point it at /dev/null
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        MAIN.log(Debug(f"Output closed after {count} songs."))
+    return count
+
 
 def scan_library(songname):
     """
@@ -477,8 +612,28 @@ def scan_library(songname):
 
     # get the library path
     library = config["library"]
+    if query.is_query(songname):
+        # a query (artist:"Daft Punk" year:>=2000 ...) means every song it matches, no questions asked
+        try:
+            songs = indexlib.cached_search(library, songname, kind="query")
+        except query.QueryError as e:
+            MAIN.log(Warn(f"Invalid query '{songname}' ({e})."))
+            print(f"Invalid query '{songname}': {e}")
+            return None
+        if not songs:
+            MAIN.log(Warn(f"No songs match '{songname}'."))
+            return None
+        MAIN.log(Info(f"{len(songs)} songs match '{songname}'."))
+        return songs[0] if len(songs) == 1 else songs
     # scan the library via the index
-    songs = indexlib.search_index(library, songname)
+    songs = indexlib.cached_search(library, songname)
+    if len(songs) == 0:
+        # nothing matched exactly, maybe it's a typo (exact and substring hits always win over these)
+        songs = indexlib.cached_search(library, songname, kind="fuzzy")
+        if songs:
+            MAIN.log(
+                Info(f"No exact match for '{songname}', using {len(songs)} fuzzy matches.")
+            )
     # use Inquirer to ask the user which song they want to play (if there are multiple matches) else, just play
     # the song.
     if len(songs) == 0:
@@ -519,149 +674,6 @@ def scan_library(songname):
                     return song
 
 
-def proper(time_int):
-    """
-    returns a proper time string (xx) from an integer
-
-    :param time_int:
-    :return:
-    """
-    # TODO: make this work for hours and up
-    return time_int if len(str(time_int)) >= 2 else "0" + str(time_int)
-
-
-def draw_interface(tags, song_data, looped, shuffle):
-    """draw the music player interface once."""
-    # play the song
-    # set volume from config
-    pygame.mixer.music.set_volume(config["volume"] / 100)
-
-    # build music player
-    # figure out percentage of song done
-    elapsed = pygame.mixer.music.get_pos()
-    duration = tags.duration * 1000
-    percentage = elapsed / duration
-    # print progress bar
-    # like the following:
-    # ──────────────────────█──────
-    # length of bar is 30 characters with a █ at the percentage
-    bar_length = 30
-    bar = "─" * bar_length
-    bar = list(bar)
-    try:
-        bar[int(bar_length * percentage)] = "█"
-    except IndexError:
-        # song is done
-        return
-    final_bar = "".join(bar)
-
-    # get volume from config
-
-    volume = int(config["volume"])
-
-    # calculate volume slider (volume is 0-100, so 70% would be 70% of 4 characters)
-    # ex:
-    # ──○─ 🔊 70%
-
-    if volume > 100:
-        volume = 100
-        # reset volume to 100 in config file
-        with open(CONFIG_FILE, "w") as f:
-            config["volume"] = 100
-            f.write(json.dumps(config, indent=4))
-    elif volume < 0:
-        volume = 0
-        with open(CONFIG_FILE, "w") as f:
-            config["volume"] = 0
-            f.write(json.dumps(config, indent=4))
-    slider_length = 5
-    slider = "─" * slider_length
-    slider = list(slider)
-    # position the slider "○" at the volume percentage
-    slider[
-        min(max(math.floor((volume / 100) * slider_length), 0), slider_length - 1)
-    ] = "○"
-    final_slider = "".join(slider) + " 🔊 " + str(volume) + "%"
-
-    # get the time elapsed (in minutes and seconds) (xx:xx)
-    elapsed_seconds = elapsed / 1000
-    elapsed_minutes = elapsed_seconds // 60
-    elapsed_seconds %= 60
-    # get the duration (in minutes and seconds) (xx:xx)
-    duration_seconds = tags.duration
-    duration_minutes = duration_seconds // 60
-    duration_seconds %= 60
-
-    # get state of music (paused, or playing)
-    state = "|>" if not pygame.mixer.music.get_busy() else "||"
-    # this line is a disaster
-    # please don't touch it
-    final_playing = f"NOW PLAYING: {song_data[2] if song_data[2] is not None else tags.title if tags.title is not None else song_data[1].split('/')[-1].split('.')[0]} by {song_data[3] if song_data[3] is not None else tags.artist} {f'({song_data[4]})' if song_data[4] not in ['None', None] else f'({tags.album})' if tags.album not in ['None', None] else ''}"
-
-    new_state = f"\r{final_playing}\n{final_bar}\n<< {state} >> {proper(int(elapsed_minutes))}:{proper(int(elapsed_seconds))} / {proper(int(duration_minutes))}:{proper(int(duration_seconds))} {final_slider} {'🔁' if looped else ''}{'🔀' if shuffle else ''}"
-    return "\033c" + new_state
-
-
-def play(
-        song_path, song_data, looped, shuffle, config
-):  # will error if config is not passed, idk why
-    """play a song."""
-    # get the song path
-    if "TMUX" in os.environ:
-        bg = True
-    else:
-        bg = False
-    last_printed_state = None
-    if song_path is None:
-        MAIN.log(FileNotFoundError(f"Could not find song '{song_data[1]}' in library."))
-        raise FileNotFoundError(f"Could not find song '{song_data[2]}' in library.")
-    # play the song
-    MAIN.log(Info(f"Playing song '{song_path}'..."))
-    tags = TinyTag.get(song_path)
-    pygame.mixer.init()
-    pygame.mixer.music.load(song_path)
-    pygame.mixer.music.set_volume(config["volume"] / 100)
-    pygame.mixer.music.play()
-    key_thread = bg_threads.KeyHandler(bg)
-    try:
-        # start the key press listener
-        key_thread.start()
-        while pygame.mixer.music.get_pos() != -1:
-
-            # draw the interface
-            interface_frame = draw_interface(tags, song_data, looped, shuffle)
-            if interface_frame != last_printed_state:
-                print(interface_frame)
-                last_printed_state = interface_frame
-            # check config for volume changes
-            try:
-                with open(CONFIG_FILE) as f:
-                    config = json.load(f)
-                    pygame.mixer.music.set_volume(config["volume"] / 100)
-            except json.JSONDecodeError:
-                MAIN.log(
-                    Warn(
-                        "Unable to read config file, this may be due to changing the volume while the song is "
-                        "playing, ignoring."
-                    )
-                )
-            pygame.time.delay(100)
-
-        # song is done
-        # kill the key press listener
-        key_thread.stop()
-        key_thread.join()
-    except KeyboardInterrupt:
-        pygame.mixer.music.stop()
-        # kill the key press listener
-        if key_thread.is_alive():
-            key_thread.stop()
-            key_thread.join()
-        raise KeyboardInterrupt(
-            "User shutdown Program"
-        )  # re-raise the KeyboardInterrupt so the program can exit
-
-
 def pull_session(session_name):
     """Pull a tmux session to the foreground."""
     # check if the session exists
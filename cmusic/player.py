@@ -0,0 +1,629 @@
+"""music player for cmusic"""
+
+import os
+import sys
+import json
+import math
+import time
+import tty
+import select
+import termios
+import subprocess
+import contextlib
+
+from . import daemon
+from . import indexlib
+from .constants import config, write_config, CONFIG_FILE, LOG_FILE, QUEUE_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Info, Warn
+
+import pygame
+
+# this file plays the queue. the player sleeps until something happens, instead of waking up every few
+# milliseconds to check:
+#   - a key was pressed (stdin is readable, select() wakes up)
+#   - a command came in on the control socket (cmusic p, v, skip, ..., see daemon.py)
+#   - the song ended (pygame posts END_EVENT, looked at when the song is due to end)
+#   - the config changed, noticed by its mtime whenever the player is awake anyway
+#   - the interface needs a redraw, once a second while playing (the progress bar moves), never while paused
+# so a paused (or idle) player doesn't use any CPU (or read anything from disk) at all.
+# once the queue is empty the player waits for more songs (cmusic queue, cmusic play) until it's told to quit.
+# while a song plays, the next one is already loaded into the mixer (pygame.mixer.music.queue), so it starts
+# the moment the current one ends, without a gap (or any work) in between. the songs' tags and durations
+# come from the index, the files are only ever opened by the mixer.
+# the songs are played by a backend (player_backend in the config): MusicBackend (pygame.mixer.music) or
+# dsp.Engine ("numpy", crossfades, loudness normalization and the equalizer), the player only talks to it
+# through the methods MusicBackend has.
+
+log = objlog.LogNode("PLAYER", log_file=LOG_FILE)
+
+# posted by pygame when a song finishes (or is stopped)
+END_EVENT = pygame.USEREVENT + 1
+
+# how often (seconds) the interface is redrawn while a song plays
+REDRAW_INTERVAL = 1.0
+
+# number of bands of the equalizer (see dsp.EQ_BANDS)
+EQ_BANDS = 10
+
+
+class ConfigWatcher:
+    """notices when the config file changes (by its mtime, it's only parsed when it did)"""
+
+    def __init__(self, path: str = CONFIG_FILE):
+        self.path = path
+        self.mtime = self.current_mtime()
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self):
+        """reload the config into `config` if the file changed, returns True if it did"""
+        mtime = self.current_mtime()
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            with open(self.path) as f:
+                config.update(json.load(f))
+        except (OSError, ValueError) as e:
+            # config writes are atomic, this is someone editing it by hand
+            log.log(Warn(f"Unable to read the config file ({e}), ignoring the change."))
+            return False
+        log.log(Debug("Config file changed, reloaded."))
+        return True
+
+
+def init_mixer():
+    """start pygame's mixer and event queue (only once)"""
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    if not pygame.display.get_init():
+        # the event queue needs the video subsystem, the dummy driver never opens a window
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        pygame.display.init()
+    pygame.mixer.music.set_endevent(END_EVENT)
+
+
+@contextlib.contextmanager
+def keyboard():
+    """read single key presses from stdin (if it's a terminal), yields its fd to select() on (or None)"""
+    if not sys.stdin.isatty():
+        yield None
+        return
+    old_settings = termios.tcgetattr(sys.stdin)
+    try:
+        tty.setcbreak(sys.stdin.fileno())
+        yield sys.stdin.fileno()
+    finally:
+        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
+
+
+def load_queue():
+    """get the IDs of the songs in the queue"""
+    with open(QUEUE_FILE) as f:
+        queue = json.load(f)
+    # older versions kept whole songs in the queue, the ID is the first field
+    return [song[0] if isinstance(song, list) else song for song in queue]
+
+
+def save_queue(song_ids):
+    """replace the queue with these song IDs"""
+    with open(QUEUE_FILE, "w") as f:
+        json.dump(song_ids, f)
+
+
+def describe(song):
+    """a song as: title by artist (album)"""
+    return f"{song[2]} by {song[3]} {f'({song[4]})' if song[4] not in [None, 'None'] else ''}".strip()
+
+
+def set_volume(volume: int):
+    """set the volume (0-100), and save it to the config file (the player applies it)"""
+    config["volume"] = min(max(int(volume), 0), 100)
+    write_config(config)
+    log.log(Info(f"Volume set to {config['volume']}"))
+
+
+def eq_gains():
+    """the gains (dB) of the equalizer's bands, from the preset picked in the config"""
+    gains = config["eq_presets"].get(config["eq_preset"])
+    if not isinstance(gains, list) or len(gains) != EQ_BANDS:
+        log.log(Warn(f"Equalizer preset '{config['eq_preset']}' not found (or not {EQ_BANDS} gains), using flat."))
+        return [0] * EQ_BANDS
+    return gains
+
+
+def proper(time_int):
+    """
+    returns a proper time string (xx) from an integer
+
+    :param time_int:
+    :return:
+    """
+    # TODO: make this work for hours and up
+    return time_int if len(str(time_int)) >= 2 else "0" + str(time_int)
+
+
+def draw_interface(song_data, looped, shuffle, paused, position):
+    """draw the music player interface once."""
+    # build music player
+    # figure out percentage of song done
+    elapsed = position * 1000
+    duration = (song_data[5] or 0) * 1000
+    percentage = min(elapsed / duration, 1) if duration else 0
+    # print progress bar
+    # like the following:
+    # ──────────────────────█──────
+    # length of bar is 30 characters with a █ at the percentage
+    bar_length = 30
+    bar = list("─" * bar_length)
+    bar[min(int(bar_length * percentage), bar_length - 1)] = "█"
+    final_bar = "".join(bar)
+
+    # get volume from config
+    volume = int(config["volume"])
+
+    # calculate volume slider (volume is 0-100, so 70% would be 70% of 4 characters)
+    # ex:
+    # ──○─ 🔊 70%
+    slider_length = 5
+    slider = list("─" * slider_length)
+    # position the slider "○" at the volume percentage
+    slider[
+        min(max(math.floor((volume / 100) * slider_length), 0), slider_length - 1)
+    ] = "○"
+    final_slider = "".join(slider) + " 🔊 " + str(volume) + "%"
+
+    # get the time elapsed (in minutes and seconds) (xx:xx)
+    elapsed_seconds = elapsed / 1000
+    elapsed_minutes = elapsed_seconds // 60
+    elapsed_seconds %= 60
+    # get the duration (in minutes and seconds) (xx:xx)
+    duration_seconds = song_data[5] or 0
+    duration_minutes = duration_seconds // 60
+    duration_seconds %= 60
+
+    # get state of music (paused, or playing)
+    state = "|>" if paused else "||"
+    # this line is a disaster
+    # please don't touch it
+    final_playing = f"NOW PLAYING: {song_data[2] if song_data[2] is not None else song_data[1].split('/')[-1].split('.')[0]} by {song_data[3]} {f'({song_data[4]})' if song_data[4] not in ['None', None] else ''}"
+
+    new_state = f"\r{final_playing}\n{final_bar}\n<< {state} >> {proper(int(elapsed_minutes))}:{proper(int(elapsed_seconds))} / {proper(int(duration_minutes))}:{proper(int(duration_seconds))} {final_slider} {'🔁' if looped else ''}{'🔀' if shuffle else ''}"
+    return "\033c" + new_state
+
+
+class MusicBackend:
+    """plays songs with pygame.mixer.music (SDL_mixer streams them from the file)"""
+
+    def __init__(self):
+        # where (seconds) the song was started from, get_pos() counts from there (see seek)
+        self.offset = 0.0
+
+    def play(self, path: str, gain_db: float = 0.0):
+        """start a song (anything preloaded is dropped), the gain is only applied by the numpy backend"""
+        # an end event left over from the last song isn't about this one
+        pygame.event.clear(END_EVENT)
+        pygame.mixer.music.load(path)
+        pygame.mixer.music.play()
+        self.offset = 0.0
+
+    def preload(self, path: str, gain_db: float = 0.0):
+        """load the song that starts the moment the current one ends (replaces one preloaded before)"""
+        pygame.mixer.music.queue(path)
+
+    def equalize(self, gains: list):
+        """pygame.mixer.music has no equalizer"""
+        if any(gains):
+            log.log(Debug("The equalizer needs the numpy backend (player_backend), ignoring it."))
+
+    def service(self):
+        """nothing to do, SDL_mixer feeds itself"""
+
+    def timeout(self):
+        """seconds until service() has to be called again (None if it doesn't)"""
+        return None
+
+    def advanced(self):
+        """check if the current song ended (and the preloaded one, if any, took over) since the last call"""
+        if pygame.event.get(END_EVENT):
+            self.offset = 0.0
+            return True
+        return False
+
+    def busy(self):
+        return pygame.mixer.music.get_busy()
+
+    def position(self):
+        """seconds into the current song"""
+        return self.offset + max(pygame.mixer.music.get_pos(), 0) / 1000
+
+    def seek(self, position: float):
+        """jump to a position (seconds) in the current song"""
+        # play() restarts the song at the position (the preloaded one stays), get_pos() counts from there
+        pygame.mixer.music.play(start=position)
+        pygame.event.clear(END_EVENT)
+        self.offset = position
+
+    def pause(self):
+        pygame.mixer.music.pause()
+
+    def unpause(self):
+        pygame.mixer.music.unpause()
+
+    def stop(self):
+        """stop playing (stopping doesn't start the preloaded song)"""
+        pygame.mixer.music.stop()
+
+    def set_volume(self, volume: float):
+        pygame.mixer.music.set_volume(volume)
+
+    def close(self):
+        self.stop()
+
+
+def make_backend():
+    """the backend the config asks for (player_backend)"""
+    if config["player_backend"] == "numpy":
+        try:
+            from . import dsp
+        except ImportError as e:
+            log.log(Warn(f"The numpy backend needs numpy, install cmusic[dsp] ({e}). Using pygame.mixer.music."))
+        else:
+            return dsp.Engine(config["crossfade"], config["dsp_block_size"])
+    elif config["player_backend"] != "music":
+        log.log(Warn(f"Unknown player_backend '{config['player_backend']}', using pygame.mixer.music."))
+    return MusicBackend()
+
+
+class Session:
+    """plays the queue, controlled by key presses and by requests on the control socket"""
+
+    def __init__(self, looped: bool = False, shuffle: bool = False, server: daemon.ControlServer = None):
+        self.looped = looped
+        self.shuffle = shuffle
+        self.server = server
+        self.keys = None
+        self.watcher = ConfigWatcher()
+        self.paused = False
+        # the song playing (a row of the index)
+        self.song = None
+        # the song preloaded after it (a row of the index), the backend starts it by itself when this one ends
+        self.preloaded = None
+        self.backend = None
+        # cmusic analyze --idle, measuring the songs' loudness while this plays (see start_analysis)
+        self.analysis = None
+        # why the current song has to stop early: "skip", "replace" (new queue) or "quit"
+        self.action = None
+
+    def position(self):
+        """seconds into the current song"""
+        return self.backend.position()
+
+    def run(self):
+        """play the queue until told to quit"""
+        init_mixer()
+        self.backend = make_backend()
+        self.backend.equalize(eq_gains())
+        self.start_analysis()
+        with keyboard() as self.keys:
+            while self.action != "quit":
+                queue = load_queue()
+                if not queue:
+                    # the queue was emptied after the next song was preloaded
+                    self.backend.stop()
+                    self.preloaded = None
+                    if self.server is None:
+                        break
+                    self.idle()
+                    continue
+                song_id = queue[0]
+                if (
+                    self.preloaded is not None
+                    and self.preloaded[0] == song_id
+                    and self.backend.busy()
+                ):
+                    # the backend already moved on to it, the moment the last song ended
+                    song = self.preloaded
+                    continuing = True
+                else:
+                    found = indexlib.get_songs([song_id])
+                    song = found[0] if found else None
+                    continuing = False
+                self.preloaded = None
+                if song is not None:
+                    self.play_song(song, continuing)
+                else:
+                    log.log(Warn(f"Song {song_id} is no longer in the library, skipping."))
+                if self.action == "replace":
+                    # the queue was replaced while the song played, its first song is up next
+                    self.action = None
+                    continue
+                if self.action == "skip":
+                    self.action = None
+                # the queue can change while a song plays (cmusic queue), so it's read again
+                queue = load_queue()
+                if song_id in queue:
+                    queue.remove(song_id)
+                    # if loop is on, add the song back to the queue at the end
+                    if self.looped and song is not None:
+                        queue.append(song_id)
+                save_queue(queue)
+        self.stop_analysis()
+        self.backend.close()
+
+    def start_analysis(self):
+        """measure the loudness of songs that weren't yet in the background (numpy backend, analyze_while_playing)"""
+        if isinstance(self.backend, MusicBackend) or not config["analyze_while_playing"]:
+            return
+        try:
+            # its own process (at the lowest priority), so decoding never holds up the player
+            self.analysis = subprocess.Popen(
+                [sys.executable, "-m", "cmusic.cmusic", "analyze", "--idle"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            log.log(Warn(f"Unable to start the loudness analysis ({e})."))
+            return
+        log.log(Debug(f"Loudness analysis running in the background (pid {self.analysis.pid})."))
+
+    def stop_analysis(self):
+        if self.analysis is None:
+            return
+        # it keeps what it measured so far, the next player picks up from there
+        self.analysis.terminate()
+        try:
+            self.analysis.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.analysis.kill()
+        self.analysis = None
+
+    def idle(self):
+        """wait (without using any CPU) for something to play, or to be told to quit"""
+        self.song = None
+        print("\033c" + "Nothing to play, waiting for songs (cmusic queue <song>), cmusic q to quit.")
+        while self.action is None and not load_queue():
+            self.wait(None)
+        if self.action == "replace":
+            self.action = None
+
+    def upcoming(self):
+        """the ID of the song that plays after the current one (or None)"""
+        # the same as what run() does to the queue once the song is over
+        queue = load_queue()
+        if self.song is not None and self.song[0] in queue:
+            queue.remove(self.song[0])
+            if self.looped:
+                queue.append(self.song[0])
+        return queue[0] if queue else None
+
+    def gain(self, song_id: int):
+        """the gain (dB) a song is played with"""
+        if not config["normalize_loudness"]:
+            return 0.0
+        # songs that weren't analyzed play as they are
+        return indexlib.get_gain(song_id) or 0.0
+
+    def preload(self):
+        """preload the next song, so it starts the moment the current one ends"""
+        song_id = self.upcoming()
+        if song_id is None or (self.preloaded is not None and self.preloaded[0] == song_id):
+            # if the queue changed since, run() notices the backend playing the wrong song and replaces it
+            return
+        found = indexlib.get_songs([song_id])
+        if not found:
+            return
+        try:
+            self.backend.preload(found[0][1], self.gain(song_id))
+        except pygame.error as e:
+            log.log(Warn(f"Unable to preload '{found[0][1]}' ({e}), it'll be loaded when it's up."))
+            return
+        self.preloaded = found[0]
+        log.log(Debug(f"Preloaded '{found[0][1]}'"))
+
+    def play_song(self, song, continuing: bool = False):
+        """play a song, returns when it ended, was skipped, or the queue was replaced
+
+        continuing means the backend already started it (it was preloaded), so it isn't loaded again.
+        """
+        song_path = song[1]
+        log.log(Info(f"Playing song '{song_path}'..."))
+        self.song = song
+        if not continuing:
+            self.backend.play(song_path, self.gain(song[0]))
+            self.backend.set_volume(config["volume"] / 100)
+            if self.paused:
+                self.backend.pause()
+        started = time.monotonic()
+        self.preload()
+
+        last_printed_state = None
+        try:
+            while self.action is None:
+                self.backend.service()
+                if self.backend.advanced():
+                    break
+                self.reload_config()
+
+                interface_frame = draw_interface(
+                    song, self.looped, self.shuffle, self.paused, self.position()
+                )
+                if interface_frame != last_printed_state:
+                    print(interface_frame)
+                    last_printed_state = interface_frame
+
+                # sleep until something happens, the next redraw, or the song is due to end
+                # (while paused, only a key press or a request can change anything)
+                if self.paused:
+                    timeout = None
+                elif song[5]:
+                    remaining = song[5] - self.position()
+                    timeout = min(REDRAW_INTERVAL, max(remaining, 0.02))
+                else:
+                    timeout = REDRAW_INTERVAL
+                if self.backend.timeout() is not None:
+                    timeout = min(timeout or math.inf, self.backend.timeout())
+                self.wait(timeout)
+        except KeyboardInterrupt:
+            self.backend.stop()
+            raise KeyboardInterrupt("User shutdown Program")  # re-raise so the program can exit
+        if self.action is not None:
+            # stopping doesn't start the preloaded song, the next one is loaded again
+            self.backend.stop()
+            self.preloaded = None
+        log.log(Debug(f"Song finished after {time.monotonic() - started:.1f}s"))
+
+    def wait(self, timeout):
+        """sleep until a key press or a request comes in (or timeout seconds pass), and handle it"""
+        fds = ([self.keys] if self.keys is not None else []) + (self.server.fds() if self.server else [])
+        if not fds:
+            if timeout is None:
+                # nothing can wake us up, don't stay paused forever
+                self.set_paused(False)
+                return
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select(fds, [], [], timeout)
+        # keys and requests can change (and save) the config, so changes made from outside (cmusic eq, ...)
+        # are picked up first, or saving it would undo them
+        self.reload_config()
+        for fd in ready:
+            if fd == self.keys:
+                keys = os.read(self.keys, 32).decode(errors="ignore")
+                if keys == "":
+                    # stdin closed, keep playing without a keyboard
+                    self.keys = None
+                for key in keys:
+                    self.handle_key(key)
+            else:
+                self.server.handle(fd, self.handle_request)
+
+    def reload_config(self):
+        """apply the config file's changes, if it changed"""
+        if self.watcher.poll():
+            self.backend.set_volume(config["volume"] / 100)
+            self.backend.equalize(eq_gains())
+
+    def set_paused(self, paused: bool):
+        if paused and not self.paused:
+            log.log(Info("Pausing the song."))
+            self.backend.pause()
+        elif not paused and self.paused:
+            log.log(Info("Unpausing the song."))
+            self.backend.unpause()
+        self.paused = paused
+
+    def seek(self, position: float):
+        """jump to a position (seconds) in the current song"""
+        duration = self.song[5] or 0
+        position = min(max(position, 0.0), max(duration - 0.1, 0.0))
+        self.backend.seek(position)
+        if self.paused:
+            self.backend.pause()
+
+    def set_volume(self, volume: int):
+        """set the volume (0-100), save it and apply it right away"""
+        set_volume(volume)
+        self.backend.set_volume(config["volume"] / 100)
+
+    def handle_key(self, key: str):
+        """act on a key press"""
+        match key:
+            case "+":
+                self.set_volume(config["volume"] + 5)
+            case "_":  # seems weird, but it's the minus key (shift + -), just for consistency.
+                self.set_volume(config["volume"] - 5)
+            case " ":
+                # pause/unpause the song
+                self.set_paused(not self.paused)
+            case "e":
+                # detach tmux session (this process is within it)
+                log.log(Info("Detaching tmux session."))
+                subprocess.run(
+                    ["tmux", "detach", "-s", "cmusic_background"],
+                    stderr=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+            case "s":
+                # skip the song
+                log.log(Info("Stopping the song."))
+                self.action = self.action or "skip"
+
+    def status(self):
+        """what the player is doing"""
+        status = {
+            "paused": self.paused,
+            "volume": config["volume"],
+            "queue": len(load_queue()),
+            "looped": self.looped,
+            "shuffle": self.shuffle,
+            "song": None,
+        }
+        if self.song is not None:
+            status["song"] = {
+                "id": self.song[0],
+                "title": self.song[2],
+                "artist": self.song[3],
+                "album": self.song[4],
+                "path": self.song[1],
+            }
+            status["position"] = round(self.position(), 2)
+            status["duration"] = self.song[5]
+        return status
+
+    def handle_request(self, request: dict):
+        """answer a request from the control socket (see daemon.py)"""
+        try:
+            match request.get("cmd"):
+                case "status":
+                    pass
+                case "pause":
+                    self.set_paused(bool(request.get("paused", not self.paused)))
+                case "volume":
+                    self.set_volume(request["volume"])
+                case "skip":
+                    if self.song is None:
+                        return {"ok": False, "error": "Nothing is playing."}
+                    self.action = self.action or "skip"
+                case "seek":
+                    if self.song is None:
+                        return {"ok": False, "error": "Nothing is playing."}
+                    self.seek(float(request["position"]))
+                case "play":
+                    # a new queue, starting right away
+                    save_queue([int(song_id) for song_id in request["ids"]])
+                    self.set_paused(False)
+                    self.action = "replace"
+                case "enqueue":
+                    save_queue(load_queue() + [int(song_id) for song_id in request["ids"]])
+                    if self.song is not None:
+                        # the song after this one may have changed
+                        self.preload()
+                case "quit":
+                    self.action = "quit"
+                case command:
+                    return {"ok": False, "error": f"Unknown command '{command}'"}
+        except (KeyError, TypeError, ValueError) as e:
+            return {"ok": False, "error": f"Bad request ({e})"}
+        return {"ok": True, **self.status()}
+
+
+def run(looped: bool = False, shuffle: bool = False):
+    """run the player (the background process), until it's told to quit"""
+    try:
+        server = daemon.ControlServer()
+    except RuntimeError as e:
+        log.log(Warn(str(e)))
+        print(e)
+        return
+    try:
+        Session(looped, shuffle, server).run()
+    finally:
+        server.close()
@@ -0,0 +1,276 @@
+"""search query language for cmusic"""
+
+import re
+
+from . import db
+from . import indexlib
+from .constants import LOG_FILE
+
+import objlog
+from objlog.LogMessages import Debug
+
+# this file parses search queries like
+#   artist:"Daft Punk" year:>=2000 genre:house dur:<300
+#   (artist:radiohead OR artist:muse) NOT album:live*
+# and compiles them to a parameterized WHERE clause over the songs table.
+# every field condition is a comparison on a single column (title/artist/album/genre have NOCASE
+# indexes, year and duration plain ones), so sqlite can answer them with index lookups and range
+# scans instead of reading every song.
+#
+#   field:value        equal (case insensitive for text)
+#   field:value*       starts with (still uses the index)
+#   field:~value       contains (reads every song)
+#   field:>=n, >, <, <=, != and field:a..b (inclusive) for year, dur and id
+#   words              full-text search, like `cmusic search`
+#   AND (or nothing), OR, NOT (or -), parentheses
+
+log = objlog.LogNode("QUERY", log_file=LOG_FILE)
+
+
+class QueryError(ValueError):
+    """a query that can't be parsed"""
+
+
+# field name (and aliases): (column, kind)
+FIELDS = {
+    "title": ("title", "text"),
+    "t": ("title", "text"),
+    "artist": ("artist", "text"),
+    "a": ("artist", "text"),
+    "album": ("album", "text"),
+    "al": ("album", "text"),
+    "genre": ("genre", "text"),
+    "g": ("genre", "text"),
+    "year": ("year", "number"),
+    "y": ("year", "number"),
+    "dur": ("duration", "duration"),
+    "duration": ("duration", "duration"),
+    "id": ("id", "number"),
+    "path": ("path", "text"),
+}
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+_TOKEN = re.compile(
+    r"""
+    (?P<paren>[()])
+  | (?P<field>-?[A-Za-z]+:(?:[~<>=!]*"(?:[^"\\]|\\.)*"|[^\s()]*))
+  | (?P<quoted>-?"(?:[^"\\]|\\.)*")
+  | (?P<word>[^\s()]+)
+    """,
+    re.VERBOSE,
+)
+
+_COMPARISON = re.compile(r"^(>=|<=|!=|>|<|=)?(.*)$")
+
+
+def tokenize(text: str):
+    """split a query into tokens, returns [(kind, text)]"""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        if text[position].isspace():
+            position += 1
+            continue
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise QueryError(f"Unexpected '{text[position:]}'")
+        tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+    return tokens
+
+
+def unquote(value: str):
+    """remove the quotes around a value (if there are any)"""
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    return value
+
+
+def is_field(token: str):
+    """check if a token is a condition on a known field (field:value or -field:value)"""
+    name, colon, _ = token.partition(":")
+    return colon == ":" and name.lstrip("-").lower() in FIELDS
+
+
+def is_query(text: str):
+    """check if a search uses the query language
+
+    it takes a known field (artist:x, -year:2000, ...), operators and parentheses alone are just a
+    title like "Song (Remix)" or "Now OR Never".
+    """
+    try:
+        tokens = tokenize(text)
+    except QueryError:
+        return False
+    return any(kind == "field" and is_field(token) for kind, token in tokens)
+
+
+def parse_number(value: str, kind: str):
+    """parse the value of a numeric field (durations can be m:ss)"""
+    try:
+        if kind == "duration" and ":" in value:
+            minutes, seconds = value.split(":", 1)
+            return int(minutes) * 60 + float(seconds)
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    except ValueError:
+        raise QueryError(f"'{value}' is not a number")
+
+
+class Parser:
+    """recursive descent parser, every rule returns (sql, params)"""
+
+    def __init__(self, library_file: str, text: str):
+        self.library = library_file
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.fts = None
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            return "1", []
+        sql, params = self.or_expression()
+        if self.position < len(self.tokens):
+            raise QueryError(f"Unexpected '{self.tokens[self.position][1]}'")
+        return sql, params
+
+    def or_expression(self):
+        parts = [self.and_expression()]
+        while self.peek()[1] == "OR":
+            self.take()
+            parts.append(self.and_expression())
+        return self.join(parts, "OR")
+
+    def and_expression(self):
+        parts = [self.not_expression()]
+        while True:
+            kind, token = self.peek()
+            if kind is None or token == "OR" or token == ")":
+                break
+            if token == "AND":
+                self.take()
+            parts.append(self.not_expression())
+        return self.join(parts, "AND")
+
+    def not_expression(self):
+        kind, token = self.peek()
+        if token == "NOT":
+            self.take()
+            sql, params = self.not_expression()
+            return f"NOT ({sql})", params
+        if kind in ("word", "quoted", "field") and token.startswith("-") and len(token) > 1:
+            # -word (or -field:value) is NOT word
+            self.tokens[self.position : self.position + 1] = tokenize(token[1:])
+            sql, params = self.not_expression()
+            return f"NOT ({sql})", params
+        return self.atom()
+
+    def atom(self):
+        kind, token = self.take()
+        if kind is None:
+            raise QueryError("Query ends too early")
+        if token == "(":
+            sql, params = self.or_expression()
+            if self.take()[1] != ")":
+                raise QueryError("Missing ')'")
+            return f"({sql})", params
+        if token == ")" or token in KEYWORDS:
+            raise QueryError(f"Unexpected '{token}'")
+        if kind == "field":
+            name, value = token.split(":", 1)
+            if name.lower() in FIELDS:
+                return self.field(name.lower(), value)
+        return self.words(unquote(token), phrase=kind == "quoted")
+
+    def field(self, name: str, value: str):
+        column, kind = FIELDS[name]
+        if value == "":
+            raise QueryError(f"'{name}:' needs a value")
+        if kind == "text":
+            contains = value.startswith("~")
+            if contains:
+                value = value[1:]
+            # a * in quotes is just a *
+            prefix = value.endswith("*") and not value.endswith('"')
+            value = unquote(value)
+            if contains:
+                # contains, can't use an index
+                return f"{column} LIKE ? ESCAPE '\\'", ["%" + escape_like(value) + "%"]
+            if prefix:
+                # starts with, a range scan on the NOCASE index (sqlite's LIKE optimization)
+                return f"{column} LIKE ? ESCAPE '\\'", [escape_like(value[:-1]) + "%"]
+            # the collation goes on the column, sqlite's OR -> IN rewrite loses it when it's on the value
+            return f"{column} COLLATE NOCASE = ?", [value]
+
+        value = unquote(value)
+        if ".." in value:
+            low, high = value.split("..", 1)
+            return f"{column} BETWEEN ? AND ?", [parse_number(low, kind), parse_number(high, kind)]
+        operator, number = _COMPARISON.match(value).groups()
+        return f"{column} {operator or '='} ?", [parse_number(number, kind)]
+
+    def words(self, text: str, phrase: bool):
+        if self.fts is None:
+            c = db.cursor(self.library)
+            self.fts = (
+                indexlib.fts5_available()
+                and c.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_fts'"
+                ).fetchone()
+                is not None
+            )
+        if self.fts:
+            match = '"' + text.replace('"', '""') + '"' if phrase else indexlib.fts_query(text)
+            if match is not None:
+                return "id IN (SELECT rowid FROM songs_fts WHERE songs_fts MATCH ?)", [match]
+        pattern = "%" + escape_like(text) + "%"
+        return (
+            "(title LIKE ? ESCAPE '\\' OR artist LIKE ? ESCAPE '\\' OR album LIKE ? ESCAPE '\\' OR genre LIKE ? ESCAPE '\\')",
+            [pattern] * 4,
+        )
+
+    @staticmethod
+    def join(parts: list, operator: str):
+        if len(parts) == 1:
+            return parts[0]
+        sql = f" {operator} ".join(f"({part[0]})" for part in parts)
+        params = [param for part in parts for param in part[1]]
+        return sql, params
+
+
+def escape_like(text: str):
+    """escape the wildcards of LIKE in a value"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def compile_query(library_file: str, text: str):
+    """compile a query into a WHERE clause over songs, returns (sql, params)"""
+    parser = Parser(library_file, text)
+    sql, params = parser.parse()
+    log.log(Debug(f"Query '{text}' -> {sql} {params}"))
+    return sql, params
+
+
+def search(library_file: str, text: str, limit: int = None, offset: int = 0, sort: str = None):
+    """find the songs matching a query (sorted by artist, album and title unless sort says otherwise)
+
+    the query is compiled right away (so a bad one raises QueryError here), the songs are read
+    from the returned cursor as it's iterated.
+    """
+    sql, params = compile_query(library_file, text)
+    order = indexlib.order_by(sort) or "artist COLLATE NOCASE, album COLLATE NOCASE, title COLLATE NOCASE"
+    page, page_params = indexlib.limit_clause(limit, offset)
+    c = db.cursor(library_file)
+    return c.execute(f"SELECT * FROM songs WHERE {sql} ORDER BY {order}{page}", params + page_params)
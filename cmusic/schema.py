@@ -0,0 +1,175 @@
+"""index schema and migrations for cmusic"""
+
+import time
+
+from .constants import LOG_FILE
+
+import objlog
+from objlog.LogMessages import Info
+
+# this file contains the schema of the index, as a list of versioned migrations.
+# every index records the migrations it has been through in the schema_version table, and
+# migrate() applies whatever is missing, so old indexes are upgraded in place.
+# to change the schema, add a new migration at the end of MIGRATIONS (never edit an old one).
+
+log = objlog.LogNode("SCHEMA", log_file=LOG_FILE)
+
+# stat columns are used by sync_library to detect which files changed since they were indexed
+SONG_STAT_COLUMNS = {"size": "INTEGER", "mtime_ns": "INTEGER", "inode": "INTEGER"}
+
+
+def create_songs_table(c):
+    """create the songs table (and add any columns that older indexes are missing)"""
+    # create table to link tags to file paths
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, path TEXT, title TEXT, artist TEXT, album TEXT, duration REAL, genre TEXT, year INTEGER, size INTEGER, mtime_ns INTEGER, inode INTEGER)"
+    )
+    add_missing_columns(c, "songs", SONG_STAT_COLUMNS)
+
+
+def add_missing_columns(c, table: str, columns: dict):
+    """add the columns ({name: type}) a table doesn't have yet"""
+    existing = [row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()]
+    for column, column_type in columns.items():
+        if column not in existing:
+            log.log(Info(f"Adding missing column '{column}' to '{table}'"))
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _base_tables(c):
+    # indexes from before the migrations may already have (some of) these
+    create_songs_table(c)
+    # playlists (many to many)
+    c.execute("CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, name TEXT)")
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS playlist_songs (playlist_id INTEGER, song_id INTEGER)"
+    )
+
+
+def _playlist_foreign_keys(c):
+    # sqlite can't add foreign keys to an existing table, so playlist_songs is rebuilt.
+    # entries pointing to songs or playlists that no longer exist are dropped, the order is kept.
+    c.execute(
+        """
+    CREATE TABLE playlist_songs_new (
+        playlist_id INTEGER NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+        song_id INTEGER NOT NULL REFERENCES songs (id) ON DELETE CASCADE
+    )
+    """
+    )
+    c.execute(
+        """
+    INSERT INTO playlist_songs_new (playlist_id, song_id)
+    SELECT ps.playlist_id, ps.song_id
+    FROM playlist_songs ps
+    JOIN playlists ON playlists.id = ps.playlist_id
+    JOIN songs ON songs.id = ps.song_id
+    ORDER BY ps.rowid
+    """
+    )
+    c.execute("DROP TABLE playlist_songs")
+    c.execute("ALTER TABLE playlist_songs_new RENAME TO playlist_songs")
+
+
+def _lookup_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS songs_path ON songs (path)")
+    c.execute("CREATE INDEX IF NOT EXISTS songs_artist_album ON songs (artist, album)")
+    # rows of one playlist come out of this index in insertion (rowid) order, which is the playlist order
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS playlist_songs_playlist ON playlist_songs (playlist_id)"
+    )
+    # used by the ON DELETE CASCADE when songs are deleted
+    c.execute("CREATE INDEX IF NOT EXISTS playlist_songs_song ON playlist_songs (song_id)")
+
+
+def _content_hashes(c):
+    add_missing_columns(c, "songs", {"content_hash": "TEXT"})
+    c.execute("CREATE INDEX IF NOT EXISTS songs_content_hash ON songs (content_hash)")
+    # hashes of files (in or outside the library), valid as long as the file's size and mtime don't change
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS hash_cache (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT)"
+    )
+
+
+def _directories(c):
+    # the directories of the library and their mtime at the last walk (see walker), NULL = always read it
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)"
+    )
+
+
+def _query_indexes(c):
+    # the text fields are compared case insensitively by the query language, so their indexes are NOCASE
+    # (that also lets sqlite turn "starts with" LIKEs into range scans)
+    for column in ("title", "artist", "album", "genre"):
+        c.execute(f"CREATE INDEX IF NOT EXISTS songs_{column}_nocase ON songs ({column} COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS songs_year ON songs (year)")
+    c.execute("CREATE INDEX IF NOT EXISTS songs_duration ON songs (duration)")
+
+
+def _generation(c):
+    # a counter every change to the songs bumps, search results cached under an older value are stale
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)"
+    )
+    c.execute("INSERT OR IGNORE INTO generation (id, value) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(
+            f"""
+        CREATE TRIGGER IF NOT EXISTS songs_generation_{event.lower()} AFTER {event} ON songs BEGIN
+            UPDATE generation SET value = value + 1 WHERE id = 1;
+        END
+        """
+        )
+
+
+def _gains(c):
+    # the gain (dB) that brings a song to the normalized loudness, applied by the numpy player backend
+    # (NULL = not analyzed yet, played as it is)
+    add_missing_columns(c, "songs", {"gain_db": "REAL"})
+
+
+def _loudness(c):
+    # what cmusic analyze measured (integrated loudness in LUFS, sample peak in dBFS), and the size and mtime
+    # of the file it measured, so only songs that changed since are analyzed again
+    add_missing_columns(
+        c,
+        "songs",
+        {"loudness": "REAL", "peak_db": "REAL", "analyzed_size": "INTEGER", "analyzed_mtime_ns": "INTEGER"},
+    )
+
+
+# (version, description, migration), in order
+MIGRATIONS = [
+    (1, "songs, playlists and playlist_songs tables", _base_tables),
+    (2, "foreign keys on playlist_songs", _playlist_foreign_keys),
+    (3, "indexes on songs(path), songs(artist, album) and playlist_songs", _lookup_indexes),
+    (4, "content hashes of songs, and the hash cache", _content_hashes),
+    (5, "directory mtimes of the library", _directories),
+    (6, "indexes for the query language", _query_indexes),
+    (7, "index generation counter", _generation),
+    (8, "track gains for loudness normalization", _gains),
+    (9, "loudness analysis results", _loudness),
+]
+
+
+def schema_version(c):
+    """get the schema version of an index (0 if it has never been migrated)"""
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied REAL)"
+    )
+    return c.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+
+
+def migrate(c):
+    """bring an index up to the latest schema version (run inside a transaction)"""
+    current = schema_version(c)
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        log.log(Info(f"Migrating index to version {version}: {description}"))
+        migration(c)
+        c.execute(
+            "INSERT INTO schema_version (version, description, applied) VALUES (?, ?, ?)",
+            (version, description, time.time()),
+        )
@@ -0,0 +1,143 @@
+"""library walker for cmusic"""
+
+import os
+import time
+import concurrent.futures
+
+from . import db
+from .constants import config, LOG_FILE
+
+import objlog
+from objlog.LogMessages import Info, Warn
+
+# this file walks the library to find the songs in it, every scan of the library goes through here.
+# directories are read with os.scandir (the file type comes with the listing, only songs are stat'ed)
+# by a pool of threads, so a slow disk (or a NAS) always has several requests in flight.
+# the mtime of every directory is kept in the dirs table of the index: a directory's mtime changes when
+# a file is added, removed or renamed in it, so a directory with the same mtime as last time doesn't
+# have to be read again (its subdirectories still are, they have their own mtime).
+# a file edited in place (retagged) doesn't change its directory's mtime though, so the songs the index
+# has in those directories are still stat'ed (see stat_files), which is a lot cheaper than listing them.
+
+log = objlog.LogNode("WALKER", log_file=LOG_FILE)
+
+# directories modified this recently (seconds) are never pruned on the next walk, some filesystems only
+# keep mtimes to the second (or two), a file added right after the walk wouldn't change it.
+RACY_WINDOW = 2
+
+
+class WalkResult:
+    """what a walk of the library found"""
+
+    def __init__(self):
+        # path: (size, mtime_ns, inode) of the songs, in the directories that were read
+        self.files = {}
+        # files that are neither songs nor a part of the index
+        self.others = []
+        # path: (parent, mtime_ns) of every directory, as stored in the dirs table
+        self.dirs = {}
+        # directories that weren't read because they didn't change
+        self.pruned = set()
+        # number of directories that were read
+        self.visited = 0
+
+
+def _scan(directory: str, mtime_ns: int, known: dict, children: dict):
+    """read one directory (run in a thread), returns (pruned, mtime_ns, subdirectories, songs, others)"""
+    if mtime_ns is None:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    if directory in known and known[directory] == mtime_ns:
+        # unchanged, the subdirectories are the ones from last time (their own mtime is checked when they're scanned)
+        return True, mtime_ns, [(path, None) for path in children.get(directory, [])], {}, []
+
+    subdirectories = []
+    songs = {}
+    others = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append((entry.path, entry.stat(follow_symlinks=False).st_mtime_ns))
+            elif entry.name.endswith(".mp3"):
+                st = entry.stat()
+                songs[entry.path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            elif not db.is_index_file(entry.name):
+                others.append(entry.path)
+    return False, mtime_ns, subdirectories, songs, others
+
+
+def walk(root: str, known: dict = None, workers: int = None):
+    """walk a directory tree in parallel, returns a WalkResult
+
+    known is {path: (parent, mtime_ns)} of the directories from the last walk (see load_dirs),
+    directories that still have the same mtime are pruned. leave it out to read everything.
+    """
+    workers = workers or config["walk_workers"]
+    children = {}
+    mtimes = {}
+    for path, (parent, mtime_ns) in (known or {}).items():
+        children.setdefault(parent, []).append(path)
+        if mtime_ns is not None:
+            mtimes[path] = mtime_ns
+
+    started = time.time()
+    result = WalkResult()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_scan, root, None, mtimes, children): (root, None)}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                directory, parent = pending.pop(future)
+                try:
+                    pruned, mtime_ns, subdirectories, songs, others = future.result()
+                except OSError as e:
+                    log.log(Warn(f"Unable to scan '{directory}' ({e}), skipping."))
+                    continue
+                if pruned:
+                    result.pruned.add(directory)
+                else:
+                    result.visited += 1
+                    result.files.update(songs)
+                    result.others.extend(others)
+                # too recent to be trusted next time
+                racy = mtime_ns >= (started - RACY_WINDOW) * 1e9
+                result.dirs[directory] = (parent, None if racy else mtime_ns)
+                for path, sub_mtime in subdirectories:
+                    pending[pool.submit(_scan, path, sub_mtime, mtimes, children)] = (path, directory)
+
+    log.log(
+        Info(
+            f"Walked '{root}' in {time.time() - started:.2f}s: {result.visited} directories read, "
+            f"{len(result.pruned)} unchanged, {len(result.files)} songs"
+        )
+    )
+    return result
+
+
+def _stat(path: str):
+    """the (size, mtime_ns, inode) of a file (run in a thread), None if it's gone"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def stat_files(paths: list, workers: int = None):
+    """stat files in parallel, returns {path: (size, mtime_ns, inode)} of the ones that exist"""
+    workers = workers or config["walk_workers"]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return {path: stat for path, stat in zip(paths, pool.map(_stat, paths)) if stat is not None}
+
+
+def load_dirs(c):
+    """get the directories recorded by the last walk, {path: (parent, mtime_ns)}"""
+    return {row[0]: (row[1], row[2]) for row in c.execute("SELECT path, parent, mtime_ns FROM dirs")}
+
+
+def save_dirs(c, result: WalkResult):
+    """record the directories of a walk, once what it found is in the index"""
+    c.execute("DELETE FROM dirs")
+    c.executemany(
+        "INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+        ((path, parent, mtime_ns) for path, (parent, mtime_ns) in result.dirs.items()),
+    )
@@ -0,0 +1,351 @@
+"""library watcher for cmusic"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from . import db
+from . import indexlib
+from . import walker
+from .constants import config, LOG_FILE
+
+import objlog
+from objlog.LogMessages import Debug, Info, Warn, Error
+
+# this file keeps the index up to date while files are added to, changed in, moved around or removed
+# from the library (cmusic watch).
+# on linux the kernel tells us what changed (inotify, through ctypes), everywhere else (or when inotify
+# can't be used) the library is synced every few seconds instead, which only reads directories that changed.
+# events are collected until the library has been quiet for a moment (watch_debounce), then all of them
+# are applied in one transaction, a file that's written in ten chunks is only indexed once.
+
+log = objlog.LogNode("WATCHER", log_file=LOG_FILE)
+
+# inotify events (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+EVENT_HEADER = struct.Struct("iIII")
+
+# events are applied at the latest this long (seconds) after the first one, even if more keep coming
+MAX_DELAY = 10
+
+
+class Inotify:
+    """a recursive inotify watch on a directory tree"""
+
+    def __init__(self, root: str):
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # wd: path, and the other way around
+        self.paths = {}
+        self.wds = {}
+        self.add_tree(root)
+
+    def add(self, path: str):
+        """watch a single directory"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "inotify watch limit reached (fs.inotify.max_user_watches)")
+            log.log(Warn(f"Unable to watch '{path}' ({os.strerror(error)})"))
+            return
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def add_tree(self, root: str):
+        """watch a directory and everything under it"""
+        self.add(root)
+        for path in walker.walk(root).dirs:
+            if path not in self.wds:
+                self.add(path)
+
+    def remove_tree(self, root: str):
+        """stop watching a directory (that moved out of the library) and everything under it"""
+        for path in [path for path in self.wds if path == root or path.startswith(root + os.sep)]:
+            wd = self.wds.pop(path)
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def move_tree(self, old: str, new: str):
+        """a watched directory was renamed (the watches follow it, only their paths change)"""
+        for path in [path for path in self.wds if path == old or path.startswith(old + os.sep)]:
+            wd = self.wds.pop(path)
+            moved = new + path[len(old):]
+            self.paths[wd] = moved
+            self.wds[moved] = wd
+
+    def read(self, timeout: float):
+        """wait (up to timeout seconds) for events, returns [(mask, cookie, path)]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                # the directory is gone (or was unwatched)
+                path = self.paths.pop(wd, None)
+                if path is not None and self.wds.get(path) == wd:
+                    del self.wds[path]
+                continue
+            directory = self.paths.get(wd)
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            events.append((mask, cookie, path))
+        return events
+
+    def close(self):
+        """stop watching everything"""
+        os.close(self.fd)
+
+
+def is_song(path: str):
+    """check if a path is a song (the only files the index cares about)"""
+    return path.endswith(".mp3") and not db.is_index_file(os.path.basename(path))
+
+
+def under(path: str, directory: str):
+    """check if a path is a directory or inside it"""
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class Batch:
+    """the events collected since the last time the index was updated"""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # ("move", old, new, is_dir) and ("delete", path, is_dir), in the order they happened
+        self.operations = []
+        # songs that were written (or showed up), indexed from whatever is on disk when the batch is applied
+        self.dirty = set()
+        # cookie: (path, is_dir) of renames we've only seen the first half of
+        self.moved_from = {}
+        self.first = None
+        self.last = None
+
+    def touch(self):
+        """an event came in"""
+        now = time.monotonic()
+        self.first = self.first or now
+        self.last = now
+
+    def __bool__(self):
+        return bool(self.operations or self.dirty or self.moved_from)
+
+    def write(self, path: str):
+        self.dirty.add(path)
+        self.touch()
+
+    def delete(self, path: str, is_dir: bool):
+        self.operations.append(("delete", path, is_dir))
+        self.dirty = {song for song in self.dirty if not under(song, path)}
+        self.touch()
+
+    def move(self, old: str, new: str, is_dir: bool):
+        self.operations.append(("move", old, new, is_dir))
+        # songs written before they were moved are indexed under their new path
+        self.dirty = {new + song[len(old):] if under(song, old) else song for song in self.dirty}
+        self.touch()
+
+    def rename(self, old: str, new: str, is_dir: bool):
+        """both halves of a rename inside the library"""
+        if is_dir or (is_song(old) and is_song(new)):
+            self.move(old, new, is_dir)
+        elif is_song(new):
+            # a file that became a song (downloads, rsync, scp and editors write to a temporary name first)
+            self.write(new)
+        elif is_song(old):
+            # a song that isn't one anymore (song.mp3 -> song.mp3.bak)
+            self.delete(old, False)
+
+    def due(self, debounce: float):
+        """check if it's time to apply the batch"""
+        if not self:
+            return False
+        now = time.monotonic()
+        return now - self.last >= debounce or now - self.first >= MAX_DELAY
+
+
+def apply_batch(library_file: str, batch: Batch):
+    """apply a batch of events to the index in one transaction, returns (updated, moved, removed)"""
+    # renames whose second half never came moved out of the library
+    for path, is_dir in batch.moved_from.values():
+        batch.delete(path, is_dir)
+    batch.moved_from.clear()
+
+    # parse first, so the write lock is only held for the writes themselves
+    parsed = {}
+    gone = []
+    for path in sorted(batch.dirty):
+        if not os.path.isfile(path):
+            gone.append(path)
+            continue
+        _, tags, error = indexlib._read_tags(path)
+        if tags is None:
+            log.log(Error(f"Unable to read tags of '{path}' ({error}), skipping."))
+            continue
+        parsed[path] = tags
+
+    moved = removed = 0
+    with db.transaction(library_file) as c:
+        for operation in batch.operations:
+            if operation[0] == "move":
+                _, old, new, is_dir = operation
+                if is_dir:
+                    # everything under the directory, the '/' keeps 'a/b' from matching 'a/bc'
+                    c.execute(
+                        "UPDATE songs SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+                        (new, len(old) + 1, len(old) + 1, old + os.sep),
+                    )
+                else:
+                    # a rename over an existing song replaces it
+                    c.execute("DELETE FROM songs WHERE path = ?", (new,))
+                    c.execute("UPDATE songs SET path = ? WHERE path = ?", (new, old))
+                moved += c.rowcount
+            else:
+                _, path, is_dir = operation
+                if is_dir:
+                    c.execute(
+                        "DELETE FROM songs WHERE substr(path, 1, ?) = ?", (len(path) + 1, path + os.sep)
+                    )
+                else:
+                    c.execute("DELETE FROM songs WHERE path = ?", (path,))
+                removed += c.rowcount
+        for path in gone:
+            c.execute("DELETE FROM songs WHERE path = ?", (path,))
+            removed += c.rowcount
+        for path, tags in parsed.items():
+            indexlib.index_file(library_file, path, c, tags=tags)
+
+    batch.clear()
+    return len(parsed), moved, removed
+
+
+def report(updated: int, moved: int, removed: int):
+    """print what a batch changed (if anything)"""
+    if updated or moved or removed:
+        message = f"Index updated: {updated} added/changed, {moved} moved, {removed} removed."
+        log.log(Info(message))
+        print(time.strftime("[%H:%M:%S] ") + message)
+
+
+def watch_inotify(library_file: str, inotify: Inotify, debounce: float):
+    """keep the index in sync from inotify events (runs until interrupted)"""
+    batch = Batch()
+    try:
+        while True:
+            if batch:
+                timeout = max(0.0, min(batch.last + debounce, batch.first + MAX_DELAY) - time.monotonic())
+            else:
+                timeout = None
+            for mask, cookie, path in inotify.read(timeout):
+                is_dir = bool(mask & IN_ISDIR)
+                log.log(Debug(f"inotify {mask:#x} {path}"))
+                if mask & IN_Q_OVERFLOW:
+                    # the kernel dropped events, sync catches up with whatever we missed
+                    log.log(Warn("inotify queue overflowed, syncing the library"))
+                    report(*apply_batch(library_file, batch))
+                    indexlib.sync_library(library_file, quiet=True)
+                elif mask & IN_MOVED_FROM:
+                    batch.moved_from[cookie] = (path, is_dir)
+                    batch.touch()
+                elif mask & IN_MOVED_TO:
+                    source = batch.moved_from.pop(cookie, None)
+                    if source is not None:
+                        batch.rename(source[0], path, is_dir)
+                        if is_dir:
+                            inotify.move_tree(source[0], path)
+                    elif is_dir:
+                        # moved in from outside the library
+                        inotify.add_tree(path)
+                        for song in walker.walk(path).files:
+                            batch.write(song)
+                    elif is_song(path):
+                        batch.write(path)
+                elif mask & IN_CREATE and is_dir:
+                    # files can land in it before the watch is set up, so read it once
+                    inotify.add_tree(path)
+                    for song in walker.walk(path).files:
+                        batch.write(song)
+                elif mask & IN_CLOSE_WRITE and is_song(path):
+                    batch.write(path)
+                elif mask & IN_DELETE and (is_dir or is_song(path)):
+                    batch.delete(path, is_dir)
+
+            if batch.due(debounce):
+                # a directory that moved out of the library isn't ours to watch anymore
+                for path, is_dir in batch.moved_from.values():
+                    if is_dir:
+                        inotify.remove_tree(path)
+                report(*apply_batch(library_file, batch))
+    finally:
+        if batch:
+            report(*apply_batch(library_file, batch))
+
+
+def watch_polling(library_file: str, interval: float):
+    """keep the index in sync by syncing the library every interval seconds (runs until interrupted)"""
+    while True:
+        indexlib.sync_library(library_file, quiet=True)
+        time.sleep(interval)
+
+
+def watch(library_file: str):
+    """watch the library and keep the index in sync with it, until interrupted"""
+    library_file = os.path.abspath(library_file)
+    # catch up with what changed while nobody was watching
+    indexlib.sync_library(library_file, quiet=True)
+    inotify = None
+    if sys.platform.startswith("linux"):
+        try:
+            inotify = Inotify(library_file)
+        except (OSError, AttributeError) as e:
+            log.log(Warn(f"inotify unavailable ({e}), falling back to polling"))
+    try:
+        if inotify is not None:
+            print(f"Watching '{library_file}' ({len(inotify.wds)} directories), press Ctrl+C to stop.")
+            watch_inotify(library_file, inotify, config["watch_debounce"])
+        else:
+            print(
+                f"Watching '{library_file}' (checking every {config['watch_poll_interval']}s), press Ctrl+C to stop."
+            )
+            watch_polling(library_file, config["watch_poll_interval"])
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        if inotify is not None:
+            inotify.close()
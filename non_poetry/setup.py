@@ -8,5 +8,6 @@ setup(
     author_email='kokonico@duck.com',
     packages=['cmusic'],
     install_requires=['objlog', 'pygame', 'tinytag', 'mutagen', 'inquirer'],
+    extras_require={'dsp': ['numpy']},
     scripts=["cmusic/cmusic.py"]
 )
@@ -0,0 +1,75 @@
+"""tests for the library watcher's renames"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+# cmusic keeps its config (and log) in ~/.cmusic, the tests get their own
+os.environ["HOME"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mutagen.id3
+
+from cmusic import db
+from cmusic import indexlib
+from cmusic import watcher
+
+
+def make_song(path: str, title: str):
+    """write a small (silent) mp3 with a title tag"""
+    frame = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+    with open(path, "wb") as f:
+        f.write(frame * 50)
+    tags = mutagen.id3.ID3()
+    tags["TIT2"] = mutagen.id3.TIT2(encoding=3, text=[title])
+    tags.save(path)
+
+
+class RenameTest(unittest.TestCase):
+    def setUp(self):
+        self.library = tempfile.mkdtemp()
+        indexlib.init_index(self.library)
+
+    def songs(self):
+        return [row[0] for row in db.cursor(self.library).execute("SELECT path FROM songs ORDER BY path")]
+
+    def rename(self, old: str, new: str):
+        """rename a file in the library, and apply it like watch_inotify would"""
+        os.rename(old, new)
+        batch = watcher.Batch()
+        batch.rename(old, new, False)
+        return watcher.apply_batch(self.library, batch)
+
+    def test_renamed_to_a_song(self):
+        # downloaders (and rsync, scp, ...) write to a temporary name, then rename it
+        part = os.path.join(self.library, "new.mp3.part")
+        song = os.path.join(self.library, "new.mp3")
+        make_song(part, "New")
+        self.assertEqual(self.rename(part, song), (1, 0, 0))
+        self.assertEqual(self.songs(), [song])
+
+    def test_renamed_from_a_song(self):
+        song = os.path.join(self.library, "one.mp3")
+        backup = os.path.join(self.library, "one.mp3.bak")
+        make_song(song, "One")
+        batch = watcher.Batch()
+        batch.write(song)
+        watcher.apply_batch(self.library, batch)
+        self.assertEqual(self.songs(), [song])
+        self.assertEqual(self.rename(song, backup), (0, 0, 1))
+        self.assertEqual(self.songs(), [])
+
+    def test_renamed_song(self):
+        song = os.path.join(self.library, "one.mp3")
+        renamed = os.path.join(self.library, "two.mp3")
+        make_song(song, "One")
+        batch = watcher.Batch()
+        batch.write(song)
+        watcher.apply_batch(self.library, batch)
+        self.assertEqual(self.rename(song, renamed), (0, 1, 0))
+        self.assertEqual(self.songs(), [renamed])
+
+
+if __name__ == "__main__":
+    unittest.main()